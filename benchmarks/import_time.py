@@ -0,0 +1,117 @@
+"""
+Quantiphyse - Benchmark of the time taken to load the plugin
+
+Measures the time Quantiphyse spends on this plugin at startup by creating the
+real Quantiphyse main window, which creates every widget in the plugin manifest,
+with and without the plugin's manifest. Plugins are found through their
+package entry points, so the manifest is added to the Quantiphyse plugin
+manifest in the same way here. The lazy ``QP_MANIFEST`` is compared with a
+manifest of eagerly imported classes, as the plugin used before it listed
+lazily imported classes. Each measurement is made in a fresh interpreter in
+which Qt, the main window module and the core Quantiphyse plugins have already
+been loaded, so the difference from the ``none`` case is the plugin's own cost.
+Also reports the time to the command line tool being ready to run.
+
+Usage::
+
+    python benchmarks/import_time.py [--repeats 10]
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Loaded by Quantiphyse before the main window is created
+PREAMBLE = """
+import warnings
+warnings.filterwarnings("ignore")
+from PySide2 import QtWidgets
+app = QtWidgets.QApplication(["quantiphyse"])
+from quantiphyse.gui.main_window import MainWindow
+from quantiphyse.utils import get_plugins, plugins, set_local_file_path
+set_local_file_path()
+get_plugins()
+"""
+
+# Adds a plugin manifest as Quantiphyse does for plugins found through entry points
+# and creates the main window
+MAIN_WINDOW = """
+for key, val in manifest.items():
+    plugins.PLUGIN_MANIFEST[key] = plugins.PLUGIN_MANIFEST.get(key, []) + val
+window = MainWindow()
+"""
+
+CASES = [
+    ("none", PREAMBLE, "manifest = {}" + MAIN_WINDOW),
+    ("eager", PREAMBLE, """
+import os
+import quantiphyse_t1.widgets, quantiphyse_t1.process, quantiphyse_t1.fabber_process, quantiphyse_t1.tests
+manifest = {
+    "widgets" : [quantiphyse_t1.widgets.T10Widget, quantiphyse_t1.widgets.FabberT1Widget],
+    "widget-tests" : [quantiphyse_t1.tests.T10WidgetTest],
+    "processes" : [quantiphyse_t1.process.T10Process, quantiphyse_t1.fabber_process.FabberT1Process],
+    "fabber_dirs" : [os.path.dirname(quantiphyse_t1.__file__)],
+}""" + MAIN_WINDOW),
+    ("lazy", PREAMBLE, """
+import quantiphyse_t1
+manifest = dict(quantiphyse_t1.QP_MANIFEST)""" + MAIN_WINDOW),
+    ("cli", "", """
+import quantiphyse_t1.cli
+"""),
+]
+
+# Modules whose loading is reported
+HEAVY_MODULES = ["quantiphyse_t1.widgets", "quantiphyse_t1.loading", "quantiphyse_t1.t1_model",
+                 "quantiphyse_t1.process", "scipy.ndimage", "quantiphyse.test.widget_test", "PySide2"]
+
+TIMER = """
+import sys, time
+%s
+before = set(sys.modules)
+start = time.time()
+%s
+elapsed = time.time() - start
+print(elapsed)
+print(",".join([name for name in %r if name in sys.modules and name not in before]))
+"""
+
+def run(setup, code):
+    """
+    Time code in a fresh interpreter
+
+    :return: Tuple of (time in seconds, list of heavy modules loaded by ``code``)
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root, env.get("PYTHONPATH", "")])
+    # The main window is created without a display
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    output = subprocess.check_output([sys.executable, "-c", TIMER % (setup, code, HEAVY_MODULES)],
+                                     env=env, stderr=subprocess.DEVNULL).decode("utf-8").split("\n")
+    return float(output[0]), [name for name in output[1].split(",") if name]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plugin load time")
+    parser.add_argument("--repeats", type=int, default=10, help="Number of timed runs, median is reported")
+    args = parser.parse_args()
+
+    # Cases are interleaved so changes in machine load affect them all equally
+    results = dict([(name, []) for name, _, _ in CASES])
+    for _ in range(args.repeats):
+        for name, setup, code in CASES:
+            results[name].append(run(setup, code))
+
+    medians = {}
+    for name, setup, _ in CASES:
+        times = sorted([elapsed for elapsed, _ in results[name]])
+        medians[name] = 1000 * times[len(times) // 2]
+        plugin = "(plugin %+.1f ms)" % (medians[name] - medians["none"]) if setup is PREAMBLE and name != "none" else ""
+        print("%-6s %8.1f ms %-18s loaded: %s" % (name, medians[name], plugin, ", ".join(results[name][0][1]) or "-"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Quantiphyse - Benchmark of the C++ T1 mapping kernel
+
+Times ``t1_model.t10_map`` on a synthetic SPGR phantom for each fitting
+method, with and without AFI correction. A second build of the extension
+(e.g. from an earlier revision) can be given with ``--reference`` to
+compare kernels, together with the largest difference between their outputs.
+
+Usage::
+
+    python benchmarks/kernel.py [--shape 128,128,64] [--fas 2,5,10,15,20]
+                                [--threads 1] [--repeats 3]
+                                [--reference /path/to/t1_model.so]
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from quantiphyse_t1 import t1_model
+
+from phantom import phantom, TR, FA_AFI, TR_AFI
+
+def load_extension(fname):
+    """
+    :return: Extension module loaded from a file path
+    """
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location("t1_model", fname)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_dynamic("t1_model", fname)
+
+def run(module, vols, fas, afi_vols, method, threads, repeats):
+    """
+    :return: Tuple of (output, best time in s over repeats)
+    """
+    kwargs = {}
+    if afi_vols is not None:
+        kwargs = {"afi_vols" : afi_vols, "fa_afi" : FA_AFI, "TR_afi" : TR_AFI}
+    if method != "linear":
+        kwargs["method"] = method
+    if threads is not None:
+        kwargs["threads"] = threads
+
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        out = module.t10_map(vols, fas, TR, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return out, best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the C++ T1 mapping kernel")
+    parser.add_argument("--shape", default="128,128,64", help="Phantom shape")
+    parser.add_argument("--fas", default="2,5,10,15,20", help="Flip angles (degrees)")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed runs, best is reported")
+    parser.add_argument("--reference", help="Path to another build of t1_model to compare against")
+    args = parser.parse_args()
+
+    shape = tuple(int(dim) for dim in args.shape.split(","))
+    fas = [float(fa) for fa in args.fas.split(",")]
+    vfa, afi = phantom(shape, fas)
+    vols = [np.ascontiguousarray(vfa[..., idx]) for idx in range(len(fas))]
+    afi_vols = [np.ascontiguousarray(afi[..., idx]) for idx in range(2)]
+    nvoxels = np.prod(shape)
+
+    reference = None
+    if args.reference:
+        reference = load_extension(args.reference)
+
+    print("%i voxels, %i flip angles, %i thread(s)" % (nvoxels, len(fas), args.threads))
+    for method in ("linear", "nlls"):
+        for afi in (None, afi_vols):
+            if reference is not None and method not in getattr(reference, "METHODS", ("linear",)):
+                continue
+            desc = "%s%s" % (method, " + AFI" if afi is not None else "")
+            out, elapsed = run(t1_model, vols, fas, afi, method, args.threads, args.repeats)
+            line = "%-14s %8.3f s  %6.2f Mvox/s" % (desc, elapsed, nvoxels / elapsed / 1e6)
+            if reference is not None:
+                ref_out, ref_elapsed = run(reference, vols, fas, afi, method, args.threads, args.repeats)
+                line += "  reference %8.3f s  speed-up x%.1f  max difference %.1e" % (
+                    ref_elapsed, ref_elapsed / elapsed, np.max(np.abs(out - ref_out)))
+            print(line)
+
+if __name__ == "__main__":
+    main()
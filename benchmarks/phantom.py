@@ -0,0 +1,48 @@
+"""
+Quantiphyse - Deterministic synthetic VFA phantoms for benchmarking
+
+T1, M0 and B1 are random but reproducible for a given seed. Signals follow
+the SPGR signal equation with Gaussian noise, and AFI signals are generated
+from the same B1 map.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import numpy as np
+
+TR = 0.005
+FA_AFI = 60
+TR_AFI = (0.02, 0.1)
+NOISE = 5.0
+
+def phantom(shape, fas, seed=0, dtype=np.float64):
+    """
+    Generate a phantom a z slice at a time, so temporary memory is small
+    compared to the phantom itself
+
+    :param shape: 3D shape
+    :param fas: Flip angles in degrees
+    :param seed: Random seed
+    :param dtype: Data type of the signal volumes
+    :return: Tuple of (4D SPGR array with one volume per flip angle, 4D AFI
+             array with two volumes), both Fortran ordered as if loaded from
+             a NIFTI file
+    """
+    shape = tuple(shape)
+    vfa = np.empty(shape + (len(fas),), dtype=dtype, order="F")
+    afi = np.empty(shape + (2,), dtype=dtype, order="F")
+    n = TR_AFI[1] / TR_AFI[0]
+    for z in range(shape[2]):
+        rng = np.random.RandomState([seed, z])
+        t1 = rng.uniform(0.2, 3, shape[:2])
+        m0 = rng.uniform(500, 2000, shape[:2])
+        b1 = rng.uniform(0.8, 1.2, shape[:2])
+        e1 = np.exp(-TR / t1)
+        for idx, fa in enumerate(fas):
+            fa_rad = np.radians(fa) * b1
+            vfa[:, :, z, idx] = m0 * np.sin(fa_rad) * (1 - e1) / (1 - np.cos(fa_rad) * e1) + rng.normal(0, NOISE, shape[:2])
+
+        cosa = np.cos(np.radians(FA_AFI) * b1)
+        afi[:, :, z, 0] = 1000.0
+        afi[:, :, z, 1] = 1000.0 * (1 + n * cosa) / (n + cosa)
+    return vfa, afi
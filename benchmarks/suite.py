@@ -0,0 +1,259 @@
+"""
+Quantiphyse - Benchmark suite for T1 mapping
+
+Runs ``t10_map`` (for each engine) and the full ``T10Process.run`` path on
+deterministic synthetic phantoms over a range of sizes and numbers of flip
+angles, with and without AFI B1 correction. For each case the wall time of
+each stage (for the process path, the stages recorded in ``T10Process.stats``),
+the voxel counts reported by the engine, voxels fitted per second and peak
+memory are recorded and written to a JSON file. Each case runs in a fresh worker process so peak
+memory is not affected by earlier cases.
+
+A results file from an earlier run can be given with ``--compare`` to
+report the change in fitting speed for matching cases.
+
+Usage::
+
+    python benchmarks/suite.py [--sizes 64,128,256,512] [--nfas 2,5,10,20]
+                               [--afi both] [--engines cpp,numpy,dictionary]
+                               [--paths t10_map,process] [--method linear]
+                               [--threads N] [--dtype float64] [--repeats 1]
+                               [--output results.json] [--compare old.json]
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import platform
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+import numpy as np
+
+from phantom import phantom, TR, FA_AFI, TR_AFI
+from quantiphyse_t1.engines import ENGINE_METHODS
+
+def flip_angles(nfa):
+    """
+    :return: ``nfa`` flip angles evenly spaced between 2 and 20 degrees
+    """
+    return [float(fa) for fa in np.linspace(2, 20, nfa)]
+
+def _max_rss_mb():
+    """
+    :return: Peak resident memory of this process in Mb, or None if not available
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        # Bytes on Mac, kb elsewhere
+        rss /= 1024
+    return rss / 1024.0
+
+def _fit_t10_map(case, vfa, afi):
+    """
+    Time the engine's ``t10_map`` function
+
+    :return: Tuple of (dictionary of stage timings, dictionary of voxel counts, wall time)
+    """
+    from quantiphyse_t1.engines import get_engine
+    t10_map = get_engine(case["engine"])
+
+    fas = flip_angles(case["nfa"])
+    counts = {}
+    kwargs = {"threads" : case["threads"], "method" : case["method"], "dtype" : case["dtype"], "counts" : counts}
+    if afi is not None:
+        kwargs.update({"afi_vols" : [afi[..., 0], afi[..., 1]], "fa_afi" : FA_AFI, "TR_afi" : TR_AFI})
+
+    start = time.time()
+    t10_map([vfa[..., idx] for idx in range(len(fas))], fas, TR, **kwargs)
+    wall_time = time.time() - start
+    return {"fit" : wall_time}, counts, wall_time
+
+def _fit_process(case, vfa, afi):
+    """
+    Time ``T10Process.run`` on data in an ivm
+
+    :return: Tuple of (dictionary of stage timings, dictionary of voxel counts, wall time).
+             Stages are those recorded by the process, e.g. ``load``, ``resample``,
+             ``mask``, ``fit``, ``postprocess`` and ``output``, plus ``setup`` of the ivm
+    """
+    from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+    from quantiphyse_t1.process import T10Process
+
+    stages = {}
+    start = time.time()
+    ivm = ImageVolumeManagement()
+    grid = DataGrid(vfa.shape[:3], np.identity(4))
+    ivm.add(NumpyData(vfa, grid=grid, name="vfa"))
+    options = {
+        "vfa" : {"vfa" : flip_angles(case["nfa"])},
+        "tr" : TR * 1000,
+        "threads" : case["threads"],
+        "engine" : case["engine"],
+        "method" : case["method"],
+        "dtype" : case["dtype"],
+    }
+    if afi is not None:
+        ivm.add(NumpyData(afi, grid=grid, name="afi"))
+        options.update({"afi" : {"afi" : [tr * 1000 for tr in TR_AFI]}, "fa-afi" : FA_AFI})
+    setup_time = time.time() - start
+
+    start = time.time()
+    process = T10Process(ivm)
+    process.run(options)
+    wall_time = setup_time + time.time() - start
+    stages = dict(process.stats["stages"])
+    stages["setup"] = setup_time
+    return stages, dict(process.stats["counts"]), wall_time
+
+def run_case(case):
+    """
+    Run a single benchmark case
+
+    :return: Copy of the case dictionary with results added
+    """
+    result = dict(case)
+
+    # Import what the case uses first so imports are not included in memory use.
+    # Only the process path needs Quantiphyse and Qt
+    if case["path"] == "process":
+        from quantiphyse_t1 import process
+    else:
+        from quantiphyse_t1.engines import get_engine
+        get_engine(case["engine"])
+    rss_before = _max_rss_mb()
+    start = time.time()
+    vfa, afi = phantom([case["size"]] * 3, flip_angles(case["nfa"]), seed=case["seed"], dtype=np.float32)
+    if not case["afi"]:
+        afi = None
+    phantom_time = time.time() - start
+    rss_phantom = _max_rss_mb()
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+    fit = _fit_t10_map if case["path"] == "t10_map" else _fit_process
+    best = None
+    for _ in range(case["repeats"]):
+        run = fit(case, vfa, afi)
+        if best is None or run[2] < best[2]:
+            best = run
+    if tracemalloc is not None:
+        result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024
+        tracemalloc.stop()
+
+    stages, counts, wall_time = best
+    result["stages"] = dict(stages)
+    result["stages"]["phantom"] = phantom_time
+    result["counts"] = counts
+    result["wall_time"] = wall_time
+    result["voxels"] = case["size"] ** 3
+    result["voxels_per_second"] = result["voxels"] / result["wall_time"]
+    result["peak_rss_mb"] = _max_rss_mb()
+    if rss_phantom is not None:
+        # Memory used by the fit beyond the phantom data itself
+        result["fit_rss_mb"] = max(0, result["peak_rss_mb"] - max(rss_before, rss_phantom))
+    return result
+
+def case_key(case):
+    """
+    :return: Tuple identifying a benchmark case for comparison between runs
+    """
+    return (case["path"], case["engine"], case["method"], case["size"], case["nfa"], case["afi"], case["threads"],
+            case.get("dtype", "float64"))
+
+def _csv(text, conv=int):
+    return [conv(item) for item in text.split(",") if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="T1 mapping benchmark suite")
+    parser.add_argument("--sizes", default="64,128", help="Phantom sizes (cube side in voxels), e.g. 64,128,256,512")
+    parser.add_argument("--nfas", default="2,5,10,20", help="Numbers of flip angles")
+    parser.add_argument("--afi", default="both", choices=("both", "on", "off"), help="AFI B1 correction")
+    parser.add_argument("--engines", default="cpp,numpy", help="Fitting engines")
+    parser.add_argument("--paths", default="t10_map,process", help="Code paths to time")
+    parser.add_argument("--method", help="Fitting method, default is the first supported by each engine")
+    parser.add_argument("--threads", type=int, default=0, help="Threads, 0 for one per core")
+    parser.add_argument("--dtype", default="float64", choices=("float64", "float32"), help="Calculation precision")
+    parser.add_argument("--repeats", type=int, default=1, help="Timed runs per case, fastest is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Phantom random seed")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON output file")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    afi_modes = {"both" : (False, True), "on" : (True,), "off" : (False,)}[args.afi]
+    cases = []
+    for path in _csv(args.paths, str):
+        for engine in _csv(args.engines, str):
+            for size in _csv(args.sizes):
+                for nfa in _csv(args.nfas):
+                    for afi in afi_modes:
+                        method = args.method or ENGINE_METHODS[engine][0]
+                        cases.append({"path" : path, "engine" : engine, "method" : method, "size" : size,
+                                      "nfa" : nfa, "afi" : afi, "threads" : args.threads, "dtype" : args.dtype,
+                                      "repeats" : args.repeats, "seed" : args.seed})
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as infile:
+            previous = dict([(case_key(result), result) for result in json.load(infile)["results"]])
+
+    if hasattr(multiprocessing, "get_context"):
+        # Fresh interpreter for each case so peak memory is measured independently
+        ctx = multiprocessing.get_context("spawn")
+    else:
+        ctx = multiprocessing
+
+    results = []
+    for case in cases:
+        pool = ctx.Pool(1)
+        try:
+            result = pool.apply(run_case, (case,))
+        finally:
+            pool.terminate()
+        results.append(result)
+        line = "%-8s %-6s %4i^3 %3i FAs AFI=%-5s %8.3f s %8.2f Mvox/s" % (
+            case["path"], case["engine"], case["size"], case["nfa"], case["afi"],
+            result["wall_time"], result["voxels_per_second"] / 1e6)
+        if result.get("peak_rss_mb", None) is not None:
+            line += " peak %7.0f Mb" % result["peak_rss_mb"]
+        if case_key(case) in previous:
+            line += "  x%.2f vs previous" % (result["voxels_per_second"] / previous[case_key(case)]["voxels_per_second"])
+        print(line)
+
+    metadata = {
+        "date" : datetime.datetime.now().isoformat(),
+        "platform" : platform.platform(),
+        "python" : platform.python_version(),
+        "numpy" : np.__version__,
+        "cpu_count" : multiprocessing.cpu_count(),
+    }
+    try:
+        from quantiphyse_t1._version import __version__
+        metadata["version"] = __version__
+    except ImportError:
+        pass
+
+    with open(args.output, "w") as outfile:
+        json.dump({"metadata" : metadata, "results" : results}, outfile, indent=2, sort_keys=True)
+    print("Results written to %s" % args.output)
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,18 @@ Copyright (c) 2016-2017 University of Oxford, Martin Craig
 """
 import os
 
-from .widgets import FabberT1Widget, T10Widget
-from .process import T10Process
-from .tests import T10WidgetTest
+from .lazy import lazy_class
+from .names import T10_PROCESS, FABBER_T1_PROCESS
 
+# Modules are only imported when the classes are used, so the command line tool
+# can import the package without Qt. Quantiphyse creates every widget when the
+# main window starts, so widgets.py is imported then, but it only imports Qt and
+# Quantiphyse GUI modules which are already loaded. The process and test modules
+# (compiled model, scipy, test framework) are only imported when used
 QP_MANIFEST = {
-    "widgets" : [T10Widget, FabberT1Widget],
-    "widget-tests" : [T10WidgetTest,],
-    "processes" : [T10Process],
+    "widgets" : [lazy_class(".widgets", "T10Widget"), lazy_class(".widgets", "FabberT1Widget")],
+    "widget-tests" : [lazy_class(".tests", "T10WidgetTest"),],
+    "processes" : [lazy_class(".process", "T10Process", PROCESS_NAME=T10_PROCESS),
+                   lazy_class(".fabber_process", "FabberT1Process", PROCESS_NAME=FABBER_T1_PROCESS)],
     "fabber_dirs" : [os.path.dirname(__file__)],
 }
@@ -0,0 +1,150 @@
+"""
+Quantiphyse - Cache of flip angle ratio (B1) maps calculated from AFI data
+
+The same AFI acquisition is often used for several T10 runs, e.g. with
+different VFA subsets, clamping or smoothing. The ratio of actual to nominal
+flip angle is cached so it is only calculated once. In memory, maps are keyed
+by a cheap identity of the AFI data supplied by the caller (e.g. data set
+identity and grid) where available, so a cache hit does not touch the AFI data.
+Otherwise, and for maps stored on disk, the key is a hash of the AFI data, AFI
+flip angle and TRs. Maps in memory are evicted least recently used first.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from . import numpy_model
+from .cache import ArrayCache
+
+#: Default limit on the memory used by cached maps (bytes)
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+#: Default limit on the disk space used by cached maps in a cache directory (bytes)
+DEFAULT_MAX_DISK_BYTES = 2 * 1024 * 1024 * 1024
+
+def b1_key(afi_vols, fa_afi, TR_afi):
+    """
+    :return: Hex digest identifying the B1 map calculated from the given AFI data
+    """
+    digest = hashlib.sha1()
+    for vol in afi_vols:
+        digest.update(("%s %s;" % (vol.dtype.str, vol.shape)).encode("ascii"))
+        _hash_array(digest, vol)
+    digest.update(("%r %r %r" % (float(fa_afi), float(TR_afi[0]), float(TR_afi[1]))).encode("ascii"))
+    return digest.hexdigest()
+
+def _hash_array(digest, arr):
+    """
+    Add the data in an array to a digest in C order without a contiguous copy of the
+    whole array. Non-contiguous arrays, e.g. a volume of a 4D array, are hashed one
+    2D slice at a time so the key does not depend on the memory layout
+    """
+    if arr.flags.c_contiguous:
+        digest.update(arr.data)
+    elif arr.ndim <= 2:
+        digest.update(np.ascontiguousarray(arr).data)
+    else:
+        for sub in arr:
+            _hash_array(digest, sub)
+
+class B1Cache(object):
+    """
+    Least recently used cache of B1 maps
+
+    Cached maps are read-only and must not be modified by the caller
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_disk_bytes = max_disk_bytes
+        self.hits, self.misses = 0, 0
+        self._maps = ArrayCache(max_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, afi_vols, fa_afi, TR_afi, cache_dir=None, source_key=None):
+        """
+        Get the B1 map for AFI data, calculating it if it is not cached
+
+        :param afi_vols: Sequence of the two AFI volumes
+        :param fa_afi: Flip angle of the AFI acquisition in degrees
+        :param TR_afi: Sequence of the two TRs of the AFI acquisition
+        :param cache_dir: Optional directory to also look for and store maps in
+        :param source_key: Optional hashable key identifying the AFI volumes, e.g.
+                           their data sets and grid. If given, the AFI data is only
+                           hashed if the map is not in memory and ``cache_dir`` is given.
+                           Data modified in place is not detected
+        :return: Array of flip angle ratios with the same shape as the AFI volumes
+        """
+        if source_key is not None:
+            key = ("source", source_key, float(fa_afi), tuple([float(tr) for tr in TR_afi]))
+        else:
+            key = b1_key(afi_vols, fa_afi, TR_afi)
+        b1 = self._maps.get(key)
+        if b1 is None and cache_dir is not None:
+            file_key = key if source_key is None else b1_key(afi_vols, fa_afi, TR_afi)
+            b1 = self._load(cache_dir, file_key)
+        else:
+            file_key = None
+        if b1 is not None:
+            with self._lock:
+                self.hits += 1
+            return self._maps.put(key, b1)
+
+        b1 = numpy_model.afi_ratio(afi_vols, fa_afi, TR_afi)
+        self._save(cache_dir, file_key, b1)
+        with self._lock:
+            self.misses += 1
+        return self._maps.put(key, b1)
+
+    def resize(self, max_bytes):
+        """
+        Change the memory limit, evicting maps if required
+        """
+        self._maps.resize(max_bytes)
+
+    def clear(self):
+        """
+        Remove all maps from memory. Maps stored on disk are not removed
+        """
+        self._maps.clear()
+
+    def _load(self, cache_dir, key):
+        if cache_dir is None:
+            return None
+        fname = os.path.join(cache_dir, "%s.npy" % key)
+        try:
+            b1 = np.load(fname)
+            # Record the access so recently used maps are evicted last
+            os.utime(fname, None)
+            return b1
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, cache_dir, key, b1):
+        if cache_dir is None or b1.nbytes > self.max_disk_bytes:
+            return
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Write to a temporary file first so other processes never see a partial map
+        fname = os.path.join(cache_dir, "%s.npy" % key)
+        tmpname = "%s.%i.tmp" % (fname, os.getpid())
+        with open(tmpname, "wb") as npyfile:
+            np.save(npyfile, b1)
+        os.rename(tmpname, fname)
+
+        files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".npy")]
+        files.sort(key=os.path.getmtime)
+        total = sum([os.path.getsize(name) for name in files])
+        for name in files:
+            if total <= self.max_disk_bytes:
+                break
+            total -= os.path.getsize(name)
+            os.remove(name)
+
+#: Cache shared by all T10 processes
+B1_CACHE = B1Cache()
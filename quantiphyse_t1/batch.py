@@ -0,0 +1,162 @@
+"""
+Quantiphyse - Batch T10 mapping of multiple subjects
+
+Each subject is described by a dictionary of ``T10Process`` options (``vfa``,
+``afi``, ``tr``, etc) with optional ``id``, ``indir`` and ``outdir`` entries.
+Subjects are fitted in parallel in a pool of worker processes. Each worker
+runs the streaming (slab-wise) T10 calculation so outputs are written
+directly to NIFTI files in the subject's output folder rather than held in
+memory. While subjects are being fitted, the input files of the next subjects
+are read ahead into the operating system's file cache.
+
+Example::
+
+    subjects = [
+        {"id" : "sub01", "indir" : "data/sub01", "tr" : 4.108,
+         "vfa" : {"vfa.nii.gz" : [3, 9, 14]}},
+        {"id" : "sub02", "indir" : "data/sub02", "tr" : 4.108,
+         "vfa" : {"vfa.nii.gz" : [3, 9, 14]}},
+    ]
+    results = run_batch(subjects, outdir="output", processes=4)
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+LOG = logging.getLogger(__name__)
+
+#: Default number of z slices fitted at a time by each worker
+DEFAULT_SLAB = 8
+
+#: Size of reads used to prefetch files where the OS does not support read-ahead hints
+PREFETCH_BLOCK = 4 * 1024 * 1024
+
+def subject_files(spec):
+    """
+    :return: List of the input files of a subject which exist on disk
+    """
+    indir = spec.get("indir", "")
+    fnames = list(spec.get("vfa", {}).keys()) + list(spec.get("afi", {}).keys())
+    if spec.get("roi", None):
+        fnames.append(spec["roi"])
+    fnames = [os.path.join(indir, fname) for fname in fnames]
+    return [fname for fname in fnames if os.path.isfile(fname)]
+
+def prefetch(fnames):
+    """
+    Read files into the operating system's file cache so they can be loaded quickly later
+    """
+    for fname in fnames:
+        try:
+            with open(fname, "rb") as infile:
+                if hasattr(os, "posix_fadvise"):
+                    # Asynchronous read-ahead by the kernel
+                    os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                else:
+                    while infile.read(PREFETCH_BLOCK):
+                        pass
+        except (IOError, OSError):
+            # Not fatal, the error will be reported when the file is loaded
+            pass
+
+def _subject_options(idx, spec, outdir, slab, threads):
+    """
+    :return: Copy of a subject spec with defaults filled in
+    """
+    spec = dict(spec)
+    spec.setdefault("id", "subject%i" % (idx+1))
+    spec.setdefault("indir", "")
+    spec.setdefault("outdir", os.path.join(outdir, spec["id"]))
+    spec.setdefault("slab", slab)
+    spec.setdefault("threads", threads)
+    spec.setdefault("output-file", "T10.nii")
+    return spec
+
+def _run_subject(spec):
+    """
+    Fit a single subject in a worker process
+
+    :return: Dictionary describing the result. Exceptions are caught and
+             returned as ``error`` so one failed subject does not stop the batch
+    """
+    from quantiphyse.data import ImageVolumeManagement
+    from .process import T10Process
+
+    options = dict(spec)
+    subj_id, indir, outdir = options.pop("id"), options.pop("indir"), options.pop("outdir")
+    result = {"id" : subj_id, "outdir" : outdir, "outputs" : {}, "error" : None}
+    start = time.time()
+    try:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        ivm = ImageVolumeManagement()
+        process = T10Process(ivm, indir=indir, outdir=outdir)
+        process.run(options)
+        for name, data in ivm.data.items():
+            result["outputs"][name] = getattr(data, "fname", None)
+    except Exception as exc:
+        result["error"] = "%s\n%s" % (exc, traceback.format_exc())
+    result["time"] = time.time() - start
+    return result
+
+def run_batch(subjects, outdir="", processes=None, slab=DEFAULT_SLAB, threads=None, read_ahead=True):
+    """
+    Run T10 mapping on multiple subjects in parallel
+
+    :param subjects: Sequence of subject specs, each a dictionary of ``T10Process``
+                     options with optional ``id`` (default ``subjectN``), ``indir``
+                     (folder containing the input files) and ``outdir`` (folder
+                     to write outputs to, default ``<outdir>/<id>``)
+    :param outdir: Base output folder
+    :param processes: Number of worker processes, default one per core
+    :param slab: Number of z slices fitted at a time, unless given in the subject spec
+    :param threads: Number of threads each worker uses for fitting. Default divides
+                    the cores between the workers
+    :param read_ahead: If True, prefetch the input files of queued subjects
+    :return: List of result dictionaries in the same order as ``subjects`` containing
+             ``id``, ``outdir``, ``outputs`` (mapping of output name to file),
+             ``error`` (None if successful) and ``time`` (seconds)
+    """
+    cpus = multiprocessing.cpu_count()
+    if processes is None:
+        processes = cpus
+    processes = max(1, min(int(processes), len(subjects)))
+    if threads is None:
+        threads = max(1, cpus // processes)
+    specs = [_subject_options(idx, spec, outdir, slab, threads) for idx, spec in enumerate(subjects)]
+    results = [None] * len(specs)
+
+    # Limits subjects which are queued or running to one more than the number of
+    # workers, so the next subject's files are read while the current ones are fitted
+    window = threading.Semaphore(processes + 1)
+
+    def _finished(idx):
+        def _callback(result):
+            results[idx] = result
+            if result["error"]:
+                LOG.warning("Subject %s failed: %s", result["id"], result["error"])
+            else:
+                LOG.debug("Subject %s done in %.1fs", result["id"], result["time"])
+            window.release()
+        return _callback
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for idx, spec in enumerate(specs):
+            window.acquire()
+            if read_ahead:
+                thread = threading.Thread(target=prefetch, args=(subject_files(spec),))
+                thread.daemon = True
+                thread.start()
+            pool.apply_async(_run_subject, (spec,), callback=_finished(idx))
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    return results
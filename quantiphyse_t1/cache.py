@@ -0,0 +1,141 @@
+"""
+Quantiphyse - Memory-bounded cache of arrays
+
+Used to avoid repeating expensive calculations, e.g. resampling inputs or
+calculating B1 maps, when a T10 calculation is rerun on the same data.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import collections
+import os
+import threading
+import weakref
+
+import numpy as np
+
+class ArrayCache(object):
+    """
+    Least recently used cache of Numpy arrays with a limit on their total size
+
+    Arrays are made read-only when stored so cached values cannot be
+    modified by accident. Arrays larger than the limit are not stored.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self._arrays = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """
+        Total size of cached arrays
+        """
+        return self._nbytes
+
+    def get(self, key):
+        """
+        :return: Cached array, or None if not cached
+        """
+        with self._lock:
+            arr = self._arrays.pop(key, None)
+            if arr is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._arrays[key] = arr
+            return arr
+
+    def put(self, key, arr):
+        """
+        Store an array in the cache
+
+        :return: The array, which is now read-only
+        """
+        arr.flags.writeable = False
+        with self._lock:
+            if key not in self._arrays and arr.nbytes <= self.max_bytes:
+                self._arrays[key] = arr
+                self._nbytes += arr.nbytes
+                self._evict()
+        return arr
+
+    def resize(self, max_bytes):
+        """
+        Change the size limit, evicting arrays if required
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """
+        Remove all arrays from the cache
+        """
+        with self._lock:
+            self._arrays.clear()
+            self._nbytes = 0
+
+    def _evict(self):
+        while self._arrays and self._nbytes > self.max_bytes:
+            _, arr = self._arrays.popitem(last=False)
+            self._nbytes -= arr.nbytes
+
+class _Identity(object):
+    """
+    Cache key component which matches only the same live object
+    """
+
+    def __init__(self, obj):
+        self._id = id(obj)
+        self._ref = weakref.ref(obj)
+
+    def __hash__(self):
+        return self._id
+
+    def __eq__(self, other):
+        obj = self._ref()
+        return isinstance(other, _Identity) and obj is not None and obj is other._ref()
+
+    def __ne__(self, other):
+        return not self == other
+
+def data_key(data):
+    """
+    :return: Hashable key identifying a data set. Data loaded from a file is identified
+             by the file name, modification time and size so the key is the same each
+             time the file is loaded. Otherwise the key matches only the same object
+    """
+    fname = getattr(data, "fname", None)
+    if fname and os.path.isfile(fname):
+        return file_key(fname)
+    return ("object", _Identity(data))
+
+def file_key(fname):
+    """
+    :return: Hashable key identifying a file by its name, modification time and size
+    """
+    if not os.path.isfile(fname):
+        return ("missing", os.path.abspath(fname))
+    stat = os.stat(fname)
+    return ("file", os.path.abspath(fname), stat.st_mtime, stat.st_size)
+
+def options_key(value):
+    """
+    :return: Hashable equivalent of a value made of nested dictionaries and lists,
+             e.g. process options
+    """
+    if isinstance(value, dict):
+        return tuple(sorted([(key, options_key(val)) for key, val in value.items()]))
+    elif isinstance(value, (list, tuple)):
+        return tuple([options_key(val) for val in value])
+    return value
+
+def grid_key(grid):
+    """
+    :return: Hashable key identifying a data grid by its shape and affine
+    """
+    return (tuple(grid.shape), np.asarray(grid.affine, dtype=np.float64).tobytes())
@@ -0,0 +1,263 @@
+"""
+Quantiphyse - Command line VFA T1 mapping
+
+Runs VFA T1 mapping, optionally with AFI B1 correction, without Quantiphyse.
+Only numpy, scipy, nibabel and the fitting engines are used - never Qt or
+the Quantiphyse GUI - so it starts quickly and can be used on headless
+systems and in minimal containers. Inputs are read from NIFTI files and
+fitted in slabs of z slices, and outputs are written to NIFTI files.
+
+Options can be given in a YAML file using the same names as ``T10Process``
+options, e.g.::
+
+    tr: 4.108
+    vfa:
+      vfa.nii.gz: [3, 9, 14]
+    afi:
+      afi.nii.gz: [20, 100]
+    fa-afi: 64
+    clamp: {min: 0, max: 5}
+    outputs: [m0]
+    output-file: T10.nii.gz
+
+Relative file names in a YAML file are relative to the folder containing it.
+Command line options override options in the file.
+
+Usage::
+
+    quantiphyse-t1 --vfa vfa.nii.gz 3,9,14 --tr 4.108 --outdir output
+    quantiphyse-t1 spec.yml --outdir output
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+import nibabel as nib
+
+from . import engines
+from .engines import ENGINE_METHODS, EXTRA_OUTPUTS
+from .postprocess import postprocess, postprocess_options
+from .streaming import NiftiSource, create_output, fit_slabs
+
+LOG = logging.getLogger(__name__)
+
+#: Default number of z slices fitted at a time
+DEFAULT_SLAB = 8
+
+#: Default name of the T10 output file
+DEFAULT_OUTPUT = "T10.nii.gz"
+
+def run_t10(options, indir="", outdir=""):
+    """
+    Run T10 mapping on NIFTI files
+
+    :param options: Dictionary of options with the same names as ``T10Process``
+                    options: ``tr``, ``vfa``, ``afi``, ``fa-afi``, ``roi``, ``auto-mask``,
+                    ``fill``, ``engine``, ``method``, ``t1-grid``, ``b1-grid``, ``dtype``,
+                    ``threads``, ``slab``, ``outputs``, ``smooth``, ``clamp``, ``nan-value``
+                    and ``output-file``.
+                    Inputs must all be on the same grid
+    :param indir: Folder containing the input files
+    :param outdir: Folder to write outputs to
+    :return: Mapping from output name (e.g. ``T10``, ``M0``) to file name
+    """
+    options = dict(options)
+    tr, fill, t10_map, fit_options, outputs = engines.fit_options(options)
+    slab_size = int(options.pop("slab", DEFAULT_SLAB))
+
+    sources = {}
+    def _source(fname):
+        if fname not in sources:
+            source = NiftiSource(os.path.join(indir, fname))
+            for other in sources.values():
+                if source.shape != other.shape or not np.allclose(source.affine, other.affine):
+                    raise ValueError("Input files must all be on the same grid: %s" % fname)
+            sources[fname] = source
+        return sources[fname]
+
+    fa_sources, fas = [], []
+    for fname, idx, fa in engines.input_volumes(options.pop("vfa")):
+        fas.append(fa)
+        fa_sources.append((_source(fname), idx))
+
+    afi_sources = None
+    if options.get("afi", None):
+        afi_sources, trs = [], []
+        # AFI TRs specified in ms but pass in s
+        for fname, idx, afi_tr in engines.input_volumes(options.pop("afi"), scale=0.001):
+            trs.append(afi_tr)
+            afi_sources.append((_source(fname), idx))
+        fit_options.update({"fa_afi" : options.pop("fa-afi"), "TR_afi" : trs})
+    options.pop("afi", None)
+
+    roi_source = None
+    if options.get("roi", None):
+        roi_source = _source(options.pop("roi"))
+        if roi_source.nvols > 1:
+            raise ValueError("ROI must be a 3D volume")
+    options.pop("roi", None)
+    threshold = options.pop("auto-mask", None)
+
+    post_options = postprocess_options(options)
+    output_file = os.path.join(outdir, options.pop("output-file", DEFAULT_OUTPUT))
+    if options:
+        raise ValueError("Unrecognized options: %s" % ", ".join(sorted(options.keys())))
+
+    shape, affine = fa_sources[0][0].shape, fa_sources[0][0].affine
+    files = {"T10" : output_file}
+    ext = ".nii.gz" if output_file.endswith(".nii.gz") else ".nii"
+    for name in outputs:
+        files[EXTRA_OUTPUTS[name]] = os.path.join(os.path.dirname(output_file), EXTRA_OUTPUTS[name] + ext)
+    arrays = {}
+    for name, fname in files.items():
+        # Compressed files cannot be memory mapped so are written at the end
+        arrays[name] = create_output(shape, affine, fname if ext == ".nii" else None, dtype=fit_options["dtype"])
+    T10 = arrays["T10"]
+    extras = dict([(name, arrays[EXTRA_OUTPUTS[name]]) for name in outputs])
+
+    fit_mask = None
+    if (roi_source is not None or threshold is not None) and (post_options["smooth"] or {}).get("masked", False):
+        # Masked smoothing needs the mask of fitted voxels for the whole volume
+        fit_mask = np.ones(shape, dtype=bool)
+    fit_slabs(t10_map, slab_size, fill, fa_sources, fas, tr, T10, extras, afi_sources=afi_sources,
+              roi_source=roi_source, threshold=threshold, fit_mask=fit_mask, **fit_options)
+
+    if any([value is not None for value in post_options.values()]):
+        LOG.info("Post-processing")
+        postprocess(T10, mask=fit_mask, slab_size=slab_size, **post_options)
+
+    for name, fname in files.items():
+        if ext == ".nii":
+            arrays[name].flush()
+        else:
+            nib.save(nib.Nifti1Image(arrays[name], affine), fname)
+        LOG.info("Saved %s: %s", name, fname)
+    return files
+
+def _numbers(value):
+    """
+    :return: List of numbers from a comma separated string
+    """
+    try:
+        return [float(item) for item in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected comma separated numbers: %s" % value)
+
+def _load_spec(fname):
+    """
+    :return: Options dictionary from a YAML file
+    """
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError("PyYAML is required to read option files")
+    with open(fname) as spec_file:
+        spec = yaml.safe_load(spec_file) or {}
+    if not isinstance(spec, dict):
+        raise ValueError("%s: Options file must contain a mapping of option names to values" % fname)
+    return spec
+
+def _parser():
+    parser = argparse.ArgumentParser(prog="quantiphyse-t1",
+                                     description="T1 mapping from variable flip angle images, " +
+                                                 "optionally with AFI B1 correction")
+    parser.add_argument("spec", nargs="?", help="YAML file of options")
+    parser.add_argument("--vfa", nargs=2, action="append", metavar=("FILE", "FAS"),
+                        help="VFA data file and its flip angles in degrees, comma separated " +
+                             "for multi-volume files. May be given more than once")
+    parser.add_argument("--tr", type=float, help="TR of the VFA data (ms)")
+    parser.add_argument("--afi", nargs=2, action="append", metavar=("FILE", "TRS"),
+                        help="AFI data file and its TRs in ms, comma separated for multi-volume files")
+    parser.add_argument("--fa-afi", type=float, help="Flip angle of the AFI acquisition in degrees")
+    parser.add_argument("--roi", help="Only fit voxels in this ROI file")
+    parser.add_argument("--auto-mask", type=float, help="Only fit voxels whose signal exceeds this value in any VFA volume")
+    parser.add_argument("--fill", type=float, help="Value given to voxels which are not fitted")
+    parser.add_argument("--engine", choices=sorted(ENGINE_METHODS.keys()), help="Fitting engine")
+    parser.add_argument("--method", choices=sorted(set(sum(ENGINE_METHODS.values(), ()))),
+                        help="Fitting method, default is the first supported by the engine")
+    parser.add_argument("--t1-grid", type=float, nargs=3, metavar=("MIN", "MAX", "NUM"),
+                        help="T1 values (s) of the dictionary engine")
+    parser.add_argument("--b1-grid", type=float, nargs=3, metavar=("MIN", "MAX", "NUM"),
+                        help="Flip angle ratios of the dictionary engine, used with AFI data")
+    parser.add_argument("--dtype", choices=["float32", "float64"], help="Precision of the calculation and outputs")
+    parser.add_argument("--threads", type=int, help="Number of threads used for fitting")
+    parser.add_argument("--slab", type=int, help="Number of z slices fitted at a time")
+    parser.add_argument("--outputs", help="Comma separated additional outputs: %s" % ", ".join(sorted(EXTRA_OUTPUTS.keys())))
+    parser.add_argument("--smooth", type=float, metavar="SIGMA", help="Gaussian smoothing of the T1 map")
+    parser.add_argument("--smooth-truncate", type=float, default=3, help="Truncate smoothing kernel at this many sigma")
+    parser.add_argument("--smooth-masked", action="store_true", help="Only smooth fitted voxels")
+    parser.add_argument("--clamp", type=float, nargs=2, metavar=("MIN", "MAX"), help="Clamp T1 values to this range")
+    parser.add_argument("--nan-value", type=float, help="Value given to NaN and infinite voxels")
+    parser.add_argument("--output", help="T1 map output file, default %s. Additional outputs are " % DEFAULT_OUTPUT +
+                                         "written to the same folder")
+    parser.add_argument("--indir", help="Folder containing input files")
+    parser.add_argument("--outdir", default="", help="Folder to write outputs to")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Report progress")
+    return parser
+
+def get_options(args):
+    """
+    Combine options from a YAML file and the command line
+
+    :return: Tuple of (options dictionary, input folder)
+    """
+    options, indir = {}, ""
+    if args.spec:
+        options = _load_spec(args.spec)
+        indir = os.path.dirname(os.path.abspath(args.spec))
+    if args.indir is not None:
+        indir = args.indir
+
+    if args.vfa:
+        options["vfa"] = dict([(fname, _numbers(fas)) for fname, fas in args.vfa])
+    if args.afi:
+        options["afi"] = dict([(fname, _numbers(trs)) for fname, trs in args.afi])
+    for name in ("tr", "fa_afi", "roi", "auto_mask", "fill", "engine", "method", "dtype", "threads", "slab",
+                 "nan_value", "t1_grid", "b1_grid"):
+        value = getattr(args, name)
+        if value is not None:
+            options[name.replace("_", "-")] = value
+    if args.outputs:
+        options["outputs"] = [name.strip() for name in args.outputs.split(",")]
+    if args.smooth is not None:
+        options["smooth"] = {"sigma" : args.smooth, "truncate" : args.smooth_truncate, "masked" : args.smooth_masked}
+    if args.clamp is not None:
+        options["clamp"] = {"min" : args.clamp[0], "max" : args.clamp[1]}
+    if args.output is not None:
+        options["output-file"] = args.output
+
+    for name in ("tr", "vfa"):
+        if name not in options:
+            raise ValueError("%s must be specified" % name)
+    if options.get("afi", None) and "fa-afi" not in options:
+        raise ValueError("fa-afi must be specified when using AFI data")
+    return options, indir
+
+def main(argv=None):
+    """
+    Entry point for the ``quantiphyse-t1`` command
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+    try:
+        options, indir = get_options(args)
+        if args.outdir and not os.path.isdir(args.outdir):
+            os.makedirs(args.outdir)
+        files = run_t10(options, indir=indir, outdir=args.outdir)
+    except (ValueError, IOError, OSError) as exc:
+        sys.stderr.write("quantiphyse-t1: error: %s\n" % exc)
+        return 1
+    for name in sorted(files.keys()):
+        print("%s: %s" % (name, files[name]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
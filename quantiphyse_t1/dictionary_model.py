@@ -0,0 +1,266 @@
+"""
+Quantiphyse - Dictionary matching VFA T1 mapping
+
+For given flip angles and TR the shape of the SPGR signal across flip angles
+depends only on T1 (and the flip angle ratio B1), while M0 only scales it. The
+normalised signal is precomputed for a grid of T1 values - and B1 values if AFI
+data or a B1 map is given - and each voxel is matched to the entry with the
+largest inner product with its signal. The T1 value is refined by parabolic
+interpolation of the inner products around the best match. With B1 correction
+voxels are matched to the entries for the two grid values either side of their
+flip angle ratio and log T1 is interpolated linearly between them. M0 is then
+the least squares scaling of the signal equation at the matched T1.
+
+This is not limited by the noise amplification of the linear fit, so is close
+to the accuracy of the nonlinear fit at the cost of a matrix product per voxel.
+Dictionaries are cached by flip angles, TR and grid so repeated runs with the
+same protocol do not recalculate them.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import numpy as np
+
+from .cache import ArrayCache
+from .numpy_model import (T1_MAX, EXTRA_OUTPUTS, afi_ratio, fit_statistics,
+                          _prepare_output, _finish_output)
+
+#: Default T1 grid (s): minimum, maximum and number of logarithmically spaced values.
+#: With interpolation T1 is within 1e-3 relative of the noiseless value
+DEFAULT_T1_GRID = (0.01, T1_MAX, 100)
+
+#: Default B1 grid used with AFI data or a B1 map: minimum, maximum and number of
+#: linearly spaced flip angle ratios. Ratios outside the range are clamped to it
+DEFAULT_B1_GRID = (0.3, 1.7, 57)
+
+#: Number of voxels matched at once. Limits the size of the array of inner products
+CHUNK_SIZE = 4096
+
+#: Cache of normalised dictionaries
+DICTIONARY_CACHE = ArrayCache(64 * 1024 * 1024)
+
+def t1_values(t1_grid=DEFAULT_T1_GRID):
+    """
+    :return: Array of the T1 values of a dictionary grid
+    """
+    return np.geomspace(t1_grid[0], t1_grid[1], int(t1_grid[2]))
+
+def b1_values(b1_grid=DEFAULT_B1_GRID):
+    """
+    :return: Array of the flip angle ratios of a dictionary grid
+    """
+    return np.linspace(b1_grid[0], b1_grid[1], int(b1_grid[2]))
+
+def signal_dictionary(fa, TR, t1_grid=DEFAULT_T1_GRID, b1_grid=None, dtype="float64"):
+    """
+    Normalised SPGR signals for a grid of T1 and B1 values
+
+    Dictionaries are cached and must not be modified by the caller
+
+    :param fa: Flip angles in degrees
+    :param TR: Repetition time (s)
+    :param t1_grid: Tuple of (minimum, maximum, number) of T1 values
+    :param b1_grid: Optional tuple of (minimum, maximum, number) of flip angle ratios
+    :return: Array of shape [number of B1 values, number of T1 values, number of
+             flip angles]. The B1 dimension has size 1 if ``b1_grid`` is None
+    """
+    dtype = np.dtype(dtype)
+    key = (tuple([float(angle) for angle in fa]), float(TR), tuple(t1_grid),
+           None if b1_grid is None else tuple(b1_grid), dtype.str)
+    dictionary = DICTIONARY_CACHE.get(key)
+    if dictionary is not None:
+        return dictionary
+
+    ratios = np.ones(1) if b1_grid is None else b1_values(b1_grid)
+    fa_rad = np.radians(np.array(fa, dtype=np.float64))[np.newaxis, np.newaxis, :] * ratios[:, np.newaxis, np.newaxis]
+    e1 = np.exp(-float(TR) / t1_values(t1_grid))[np.newaxis, :, np.newaxis]
+    signal = np.sin(fa_rad) * (1 - e1) / (1 - np.cos(fa_rad) * e1)
+    signal /= np.sqrt(np.sum(np.square(signal), axis=2))[:, :, np.newaxis]
+    return DICTIONARY_CACHE.put(key, signal.astype(dtype))
+
+def match(signal, dictionary, t1):
+    """
+    Match voxel signals to a dictionary
+
+    :param signal: Array of shape [num_fa, num_voxels]
+    :param dictionary: Normalised dictionary of shape [num_t1, num_fa]
+    :param t1: T1 values of the dictionary, logarithmically spaced
+    :return: Tuple of (T1, index of best match) arrays of shape [num_voxels].
+             T1 is zero where the signal does not match any entry
+    """
+    # Inner products are [num_voxels, num_t1] so the search over T1 is along contiguous memory
+    scores = np.dot(signal.T, dictionary.T)
+    best = np.argmax(scores, axis=1)
+    voxels = np.arange(signal.shape[1])
+    peak = scores[voxels, best]
+
+    # Parabolic interpolation of the inner products on the log T1 grid
+    inside = (best > 0) & (best < len(t1) - 1)
+    lower = scores[voxels, np.maximum(best - 1, 0)]
+    upper = scores[voxels, np.minimum(best + 1, len(t1) - 1)]
+    curvature = lower - 2 * peak + upper
+    offset = np.zeros(peak.shape, dtype=scores.dtype)
+    fit = inside & (curvature < 0)
+    offset[fit] = np.clip(0.5 * (lower[fit] - upper[fit]) / curvature[fit], -0.5, 0.5)
+
+    log_step = np.log(t1[-1] / t1[0]) / (len(t1) - 1)
+    matched = (t1[0] * np.exp((best + offset) * log_step)).astype(signal.dtype)
+    matched[~(peak > 0)] = 0
+    return matched, best
+
+def t10_map(fa_vols, fa, TR, afi_vols=None, fa_afi=None, TR_afi=None, out=None, threads=None, method="match",
+            extras=None, b1=None, counts=None, progress=None, dtype="float64", t1_grid=DEFAULT_T1_GRID,
+            b1_grid=DEFAULT_B1_GRID):
+    """
+    Dictionary matching equivalent of ``t1_model.t10_map``
+
+    Args:
+        fa_vols: List of volumes
+        fa: Corresponding flip angles of each volume
+        TR: Repetition time (s)
+        afi_vols: Optional list of the two AFI volumes for B1 correction
+        fa_afi: Flip angle of AFI acquisition
+        TR_afi: Sequence of the two TRs of the AFI acquisition (s)
+        out: Optional preallocated array of type ``dtype`` with the same shape
+             as the volumes which the T10 map will be written to
+        threads: Ignored, accepted for compatibility with the C++ wrapper
+        method: Fitting method. Only ``match`` is supported
+        extras: Optional dictionary of additional outputs as for
+                ``t1_model.t10_map``
+        b1: Optional precomputed flip angle ratio map used instead of AFI volumes
+        counts: Optional dictionary which counts are added to, as for
+                ``t1_model.t10_map``. Voxels matched to the largest T1 in the
+                dictionary are counted as clamped
+        progress: Optional progress callback as for ``t1_model.t10_map``,
+                  called after each chunk of ``CHUNK_SIZE`` voxels
+        dtype: Precision of the calculation and outputs, ``float64`` or ``float32``
+        t1_grid: Tuple of (minimum, maximum, number) of dictionary T1 values
+        b1_grid: Tuple of (minimum, maximum, number) of dictionary flip angle
+                 ratios, used with AFI volumes or a B1 map
+
+    Returns:
+        T10 map with the same shape as the input volumes
+    """
+    if method != "match":
+        raise ValueError("Unsupported fitting method for dictionary engine: %s" % method)
+    if len(fa_vols) != len(fa):
+        raise ValueError("Number of flip angles (%i) does not match number of volumes (%i)" % (len(fa), len(fa_vols)))
+    if afi_vols is not None and (len(afi_vols) != 2 or len(TR_afi) != 2):
+        raise ValueError("AFI correction requires two volumes and two TRs")
+    if afi_vols is not None and b1 is not None:
+        raise ValueError("Cannot specify both AFI volumes and a B1 map")
+    if t1_grid[0] <= 0 or t1_grid[1] <= t1_grid[0] or t1_grid[2] < 3:
+        raise ValueError("Invalid dictionary T1 grid: %s" % str(t1_grid))
+    if b1_grid[0] < 0 or b1_grid[1] <= b1_grid[0] or b1_grid[2] < 2:
+        raise ValueError("Invalid dictionary B1 grid: %s" % str(b1_grid))
+    for name in (extras or {}):
+        if name not in EXTRA_OUTPUTS:
+            raise ValueError("Unknown output: %s" % name)
+
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("Unsupported calculation type: %s" % dtype)
+    TR = dtype.type(TR)
+
+    use_b1 = afi_vols is not None or b1 is not None
+    dictionary = signal_dictionary(fa, TR, t1_grid, b1_grid if use_b1 else None, dtype)
+    t1 = t1_values(t1_grid)
+    ratios = b1_values(b1_grid)
+
+    shape = np.shape(fa_vols[0])
+    allocated = 0 if out is None else -out.nbytes
+    out, out_flat = _prepare_output(out, shape, dtype)
+    allocated += out.nbytes
+    extras_flat = {}
+    for name in list(extras or {}):
+        if extras[name] is None:
+            allocated += int(np.prod(shape)) * dtype.itemsize
+        extras[name], extras_flat[name] = _prepare_output(extras[name], shape, dtype)
+    fitted, clamped, rejected = 0, 0, 0
+
+    fa_flat = [np.reshape(vol, -1) for vol in fa_vols]
+    if afi_vols is not None:
+        ratio_flat = np.reshape(afi_ratio(afi_vols, fa_afi, TR_afi).astype(dtype), -1)
+        allocated += ratio_flat.nbytes
+    elif b1 is not None:
+        ratio_flat = np.reshape(np.asarray(b1, dtype=dtype), -1)
+    else:
+        ratio_flat = None
+
+    fa_rad = np.radians(np.array(fa, dtype=dtype))[:, np.newaxis]
+    done = 0
+    for voxels, b1_idx in _voxel_chunks(out_flat.size, ratio_flat, ratios):
+        signal = np.array([vol[voxels] for vol in fa_flat], dtype=dtype)
+        signal[:, ~np.all(np.isfinite(signal), axis=0)] = 0
+        if ratio_flat is not None:
+            ratio = ratio_flat[voxels]
+            # Match to the two neighbouring B1 entries and interpolate log T1 between them
+            weight = (np.clip(np.nan_to_num(ratio), ratios[0], ratios[-1]) - ratios[b1_idx]) / (ratios[1] - ratios[0])
+            t1_lower, best = match(signal, dictionary[b1_idx], t1)
+            t1_upper, best_upper = match(signal, dictionary[b1_idx+1], t1)
+            # Voxels with no valid flip angle ratio, e.g. zero AFI signal, are
+            # rejected as in the other engines rather than matched at the edge of the grid
+            matched = (t1_lower > 0) & (t1_upper > 0) & np.isfinite(ratio) & (ratio > 0)
+            t1_chunk = np.zeros(t1_lower.shape, dtype=dtype)
+            t1_chunk[matched] = np.exp((1 - weight[matched]) * np.log(t1_lower[matched]) +
+                                       weight[matched] * np.log(t1_upper[matched]))
+            best = np.where(weight < 0.5, best, best_upper)
+        else:
+            ratio = 1
+            t1_chunk, best = match(signal, dictionary[0], t1)
+
+        # Least squares M0 for the matched T1 and the actual flip angles
+        angles = fa_rad * ratio
+        with np.errstate(divide="ignore", invalid="ignore"):
+            e1 = np.exp(-TR / t1_chunk)
+            f = np.sin(angles) * (1 - e1) / (1 - np.cos(angles) * e1)
+            m0 = np.sum(signal * f, axis=0) / np.sum(f * f, axis=0)
+
+        if done == 0:
+            allocated += signal.nbytes + t1_chunk.nbytes + m0.nbytes + len(t1) * signal.nbytes // len(fa)
+        if "b1" in extras_flat:
+            extras_flat["b1"][voxels] = ratio
+        if set(extras_flat) - set(["b1"]):
+            stats = fit_statistics(signal, angles, TR, m0, t1_chunk)
+            for name, flat in extras_flat.items():
+                if name in stats:
+                    flat[voxels] = stats[name]
+        fitted += t1_chunk.size
+        rejected += np.count_nonzero(~(t1_chunk > 0))
+        clamped += np.count_nonzero((best == len(t1) - 1) & (t1_chunk > 0))
+        out_flat[voxels] = np.minimum(t1_chunk, T1_MAX)
+        done += t1_chunk.size
+        if progress is not None and progress(float(done) / out_flat.size):
+            break
+
+    if counts is not None:
+        for name, value in (("fitted", fitted), ("clamped", clamped), ("rejected", rejected),
+                            ("bytes_allocated", allocated)):
+            counts[name] = counts.get(name, 0) + int(value)
+    _finish_output(out, out_flat)
+    for name, flat in extras_flat.items():
+        _finish_output(extras[name], flat)
+    return out
+
+def _voxel_chunks(size, ratio_flat, ratios):
+    """
+    Divide the voxels into chunks of at most ``CHUNK_SIZE`` to be matched together
+
+    With B1 correction, voxels are grouped by their position in the B1 grid so
+    each chunk is matched against a single pair of neighbouring B1 entries
+
+    :return: Generator of (voxels, B1 grid index) where voxels is a slice or
+             an index array and the index is None without B1 correction
+    """
+    if ratio_flat is None:
+        for start in range(0, size, CHUNK_SIZE):
+            yield slice(start, start + CHUNK_SIZE), None
+        return
+
+    position = (np.clip(np.nan_to_num(ratio_flat), ratios[0], ratios[-1]) - ratios[0]) / (ratios[1] - ratios[0])
+    lower = np.minimum(position.astype(np.intp), len(ratios) - 2)
+    order = np.argsort(lower, kind="mergesort")
+    bounds = np.searchsorted(lower[order], np.arange(len(ratios)))
+    for idx in range(len(ratios) - 1):
+        for start in range(bounds[idx], bounds[idx+1], CHUNK_SIZE):
+            yield order[start:min(start + CHUNK_SIZE, bounds[idx+1])], idx
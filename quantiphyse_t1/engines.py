@@ -0,0 +1,209 @@
+"""
+Quantiphyse - Selection of T1 fitting engines
+
+This module, like ``numpy_model``, ``streaming`` and ``postprocess``, does not
+import Qt or the Quantiphyse GUI so it can be used by the command line tool
+as well as ``T10Process``.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import numpy as np
+
+from . import numpy_model, dictionary_model
+
+try:
+    from . import t1_model
+except ImportError:
+    t1_model = None
+
+# Fitting methods supported by each engine
+ENGINE_METHODS = {
+    "cpp" : ("linear", "nlls"),
+    "numpy" : ("linear",),
+    "dictionary" : ("match",),
+}
+
+# Options only supported by some engines, and the ``t10_map`` argument they set
+ENGINE_OPTIONS = {
+    "dictionary" : {"t1-grid" : "t1_grid", "b1-grid" : "b1_grid"},
+}
+
+# Additional outputs which can be requested using the ``outputs`` option,
+# and the names they are given in the ivm or output files
+EXTRA_OUTPUTS = {
+    "m0" : "M0",
+    "r2" : "T10_r2",
+    "resvar" : "T10_resvar",
+    "t1_se" : "T10_se",
+    "b1" : "B1",
+}
+
+def get_engine(name):
+    """
+    :return: t10_map function for the named fitting engine
+    """
+    if name == "cpp":
+        if t1_model is None:
+            raise ValueError("Compiled T1 model is not available - use the numpy engine instead")
+        return t1_model.t10_map
+    elif name == "numpy":
+        return numpy_model.t10_map
+    elif name == "dictionary":
+        return dictionary_model.t10_map
+    else:
+        raise ValueError("Unknown T1 fitting engine: %s" % name)
+
+def engine_options(name, options):
+    """
+    Remove options specific to a fitting engine from an options dictionary
+
+    Dictionary grids are given as a sequence of (minimum, maximum, number of values)
+
+    :return: Dictionary of additional keyword arguments for the engine's ``t10_map``
+    """
+    kwargs = {}
+    for engine, names in ENGINE_OPTIONS.items():
+        for option, arg in names.items():
+            if option not in options:
+                continue
+            if engine != name:
+                raise ValueError("Option %s is not supported by the %s engine" % (option, name))
+            value = options.pop(option)
+            if arg in ("t1_grid", "b1_grid"):
+                if len(value) != 3:
+                    raise ValueError("%s must be given as minimum, maximum and number of values" % option)
+                value = (float(value[0]), float(value[1]), int(value[2]))
+            kwargs[arg] = value
+    return kwargs
+
+def fit_options(options):
+    """
+    Remove the options which control the fit from an options dictionary: ``tr``,
+    ``fill``, ``engine``, ``method``, ``dtype``, ``threads``, ``outputs`` and
+    options specific to the engine
+
+    :return: Tuple of (VFA TR in s, value given to voxels which are not fitted,
+             ``t10_map`` function, dictionary of keyword arguments for it,
+             list of additional outputs)
+    """
+    # TR specified in ms but pass in s
+    tr = float(options.pop("tr")) / 1000
+    fill = float(options.pop("fill", 0))
+    engine = options.pop("engine", "cpp")
+    t10_map = get_engine(engine)
+    method = options.pop("method", ENGINE_METHODS[engine][0])
+    if method not in ENGINE_METHODS[engine]:
+        raise ValueError("Fitting method %s is not supported by the %s engine" % (method, engine))
+    # Precision of the calculation and outputs
+    dtype = options.pop("dtype", "float64")
+    if dtype not in ("float32", "float64"):
+        raise ValueError("Unsupported data type for T1 calculation: %s" % dtype)
+    threads = options.pop("threads", None)
+    if threads is not None:
+        threads = int(threads)
+    kwargs = {"threads" : threads, "method" : method, "dtype" : dtype}
+    # e.g. the T1 and B1 grids of the dictionary engine
+    kwargs.update(engine_options(engine, options))
+
+    outputs = options.pop("outputs", [])
+    for name in outputs:
+        if name not in EXTRA_OUTPUTS:
+            raise ValueError("Unknown output: %s" % name)
+    if "b1" in outputs and not options.get("afi", None):
+        raise ValueError("B1 output requires AFI data")
+    return tr, fill, t10_map, kwargs, outputs
+
+def input_volumes(spec, scale=1):
+    """
+    Expand the ``vfa`` or ``afi`` option into individual volumes
+
+    :param spec: Mapping from data name to a value, e.g. a flip angle, or a list
+                 of values for each volume of 4D data
+    :param scale: Multiplier for the values, e.g. 0.001 to convert TRs from ms to s
+    :return: List of (data name, volume index or None for 3D data, value)
+    """
+    vols = []
+    for name, values in spec.items():
+        if isinstance(values, (list, tuple)) and len(values) > 1:
+            for idx, value in enumerate(values):
+                vols.append((name, idx, float(value) * scale))
+        else:
+            if isinstance(values, (list, tuple)):
+                values = values[0]
+            vols.append((name, None, float(values) * scale))
+    return vols
+
+def auto_mask(threshold, fa_vols, mask=None):
+    """
+    Restrict a mask to voxels whose signal exceeds ``threshold`` in any of the VFA volumes
+
+    :return: Combined mask, or ``mask`` unchanged if ``threshold`` is None
+    """
+    if threshold is None:
+        return mask
+
+    threshold = float(threshold)
+    signal_mask = np.zeros(fa_vols[0].shape, dtype=bool)
+    for vol in fa_vols:
+        signal_mask |= vol > threshold
+    if mask is None:
+        return signal_mask
+    else:
+        return mask & signal_mask
+
+def fit_masked(t10_map, mask, fill, fa_vols, fas, tr, out=None, extras=None, **kwargs):
+    """
+    Run ``t10_map``, restricted to the voxels in ``mask`` if specified
+
+    Masked voxels are gathered into compact 1D arrays, fitted and scattered
+    back into the output, with other voxels set to ``fill``. If ``out`` is
+    given the output is written to it. Additional outputs in ``extras`` are
+    zero outside the mask
+
+    :return: T10 map
+    """
+    if mask is None:
+        return t10_map(fa_vols, fas, tr, out=out, extras=extras, **kwargs)
+
+    dtype = kwargs.get("dtype", np.float64)
+    fa_vols = [vol[mask] for vol in fa_vols]
+    if kwargs.get("afi_vols", None) is not None:
+        kwargs["afi_vols"] = [vol[mask] for vol in kwargs["afi_vols"]]
+    if kwargs.get("b1", None) is not None:
+        kwargs["b1"] = kwargs["b1"][mask]
+    masked_extras = dict.fromkeys(extras) if extras else None
+    fitted = t10_map(fa_vols, fas, tr, extras=masked_extras, **kwargs)
+
+    if out is None:
+        out = np.empty(mask.shape, dtype=dtype)
+    out[...] = fill
+    out[mask] = fitted
+    for name in (extras or {}):
+        if extras[name] is None:
+            extras[name] = np.zeros(mask.shape, dtype=dtype)
+        else:
+            extras[name][...] = 0
+        extras[name][mask] = masked_extras[name]
+    return out
+
+def linear_estimates(fa_vols, fa, TR, threads=None):
+    """
+    Fast linear fit of T1 and M0, e.g. to initialize an iterative fit
+
+    Voxels where the fit fails are given the median of the voxels which
+    were fitted, so the estimates are positive and finite everywhere
+
+    :param fa_vols: List of volumes
+    :param fa: Corresponding flip angles of each volume
+    :param TR: Repetition time (s)
+    :return: Tuple of (T1, M0) arrays
+    """
+    t10_map = get_engine("cpp" if t1_model is not None else "numpy")
+    extras = {"m0" : None}
+    t1 = t10_map(fa_vols, fa, TR, extras=extras, threads=threads)
+    m0 = extras["m0"]
+    valid = (t1 > 0) & np.isfinite(m0) & (m0 > 0)
+    for arr, default in ((t1, 1.0), (m0, 1.0)):
+        arr[~valid] = np.median(arr[valid]) if np.any(valid) else default
+    return t1, m0
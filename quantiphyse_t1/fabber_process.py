@@ -0,0 +1,288 @@
+"""
+Quantiphyse - Parallel Fabber T1 mapping
+
+The Fabber process fits all voxels in a single worker. This process splits
+the voxels to be fitted into chunks and runs a Fabber process on each chunk
+at the same time, so the chunks are fitted in separate worker processes.
+Each chunk runs in its own ivm, which shares the user's data and adds an
+ROI selecting the chunk's voxels, so chunk ROIs and partial outputs never
+appear in the user's ivm. When all the chunks have finished, their outputs
+(e.g. ``mean_T1`` and ``modelfit``) are stitched together and added to the
+ivm under the usual names. Progress is the average over the chunks.
+
+With the ``init-linear`` option, linear T1 and M0 estimates are calculated in
+a background thread before the chunks are started and set as image priors for
+the Fabber VFA model, so voxels start from the linear fit. The estimates are
+only added to the chunk ivms.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import functools
+import multiprocessing
+import threading
+
+import numpy as np
+
+from quantiphyse.data import ImageVolumeManagement, NumpyData
+from quantiphyse.processes import Process
+from quantiphyse.utils import QpException, get_plugins
+
+from .engines import linear_estimates
+from .names import FABBER_T1_PROCESS
+
+# Name of the ROI which selects the voxels of a chunk in the chunk's ivm
+CHUNK_ROI_NAME = "_fabber_t1_chunk"
+
+# Names of the Fabber VFA model parameters which can be initialized from the
+# linear fit, and the names of the linear estimates in the chunk ivms
+FABBER_INIT = [("T1", "_fabber_t1_init_T1"), ("sig0", "_fabber_t1_init_M0")]
+
+def split_mask(mask, chunks):
+    """
+    Split a mask into masks with equal numbers of voxels (to within one)
+
+    Voxels are assigned in order so each chunk is a compact region
+
+    :return: List of boolean masks, with fewer than ``chunks`` if there are not enough voxels
+    """
+    voxels = np.flatnonzero(mask)
+    masks = []
+    for chunk in np.array_split(voxels, max(1, min(int(chunks), len(voxels)))):
+        chunk_mask = np.zeros(mask.shape, dtype=bool)
+        chunk_mask.flat[chunk] = True
+        masks.append(chunk_mask)
+    return masks
+
+def initial_estimates(ivm, data_names, fas, tr):
+    """
+    Calculate linear T1 and M0 estimates from VFA data to initialize the Fabber VFA model
+
+    :param data_names: Name of a 4D data set with a volume for each flip angle,
+                       or list of names of 3D data sets
+    :return: Tuple of (T1, M0) arrays on the grid of the first data set
+    """
+    if not isinstance(data_names, list):
+        data_names = [data_names]
+    grid = ivm.data[data_names[0]].grid
+    if len(data_names) == 1:
+        arr = ivm.data[data_names[0]].raw()
+        vols = [arr[..., idx] for idx in range(len(fas))] if arr.ndim > 3 else [arr]
+    else:
+        vols = [ivm.data[name].resample(grid).raw() for name in data_names]
+    return linear_estimates(vols, fas, tr)
+
+class ChunkIvm(ImageVolumeManagement):
+    """
+    Private ivm for a chunk, which records the names of the data the chunk adds
+    """
+
+    def __init__(self, ivm, mask, grid, estimates=()):
+        ImageVolumeManagement.__init__(self)
+        # Data items are shared with the user's ivm rather than copied
+        self.data.update(ivm.data)
+        self.main = ivm.main
+        ImageVolumeManagement.add(self, NumpyData(mask.astype(np.int8), grid=grid, name=CHUNK_ROI_NAME, roi=True))
+        for data in estimates:
+            ImageVolumeManagement.add(self, data)
+        self.outputs = []
+
+    def add(self, data, name=None, **kwargs):
+        ImageVolumeManagement.add(self, data, name=name, **kwargs)
+        name = name or data.name
+        if name not in self.outputs:
+            self.outputs.append(name)
+
+class FabberT1Process(Process):
+    """
+    Runs Fabber on chunks of the voxels in parallel
+
+    Options are those of the Fabber process, plus ``chunks``, the number of
+    chunks (default is one per core), and ``init-linear``, which initializes
+    the model parameters from a linear fit
+    """
+
+    PROCESS_NAME = FABBER_T1_PROCESS
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, **kwargs)
+        self._chunks, self._masks, self._chunk_ivms = [], [], []
+        self._progress, self._done = [], set()
+        self._outputs = {}
+        self._grid = None
+        # Options of the chunks while the linear estimates are calculated
+        self._pending = None
+        self._stop = threading.Event()
+
+    def run(self, options):
+        try:
+            fabber_process = get_plugins("processes", "FabberProcess")[0]
+        except IndexError:
+            raise QpException("Fabber core library not found")
+
+        chunks = int(options.pop("chunks", multiprocessing.cpu_count()))
+        data_names = options.get("data", None)
+        if not data_names:
+            raise QpException("No data specified")
+        if not isinstance(data_names, list):
+            data_names = [data_names]
+        if data_names[0] not in self.ivm.data:
+            raise QpException("Data not found: %s" % data_names[0])
+        self._grid = self.ivm.data[data_names[0]].grid
+        roi = self.get_roi(options, self._grid)
+        self._masks = split_mask(roi.raw() > 0, chunks)
+        self.debug("Fitting %i voxels in %i chunks", sum([np.count_nonzero(mask) for mask in self._masks]),
+                   len(self._masks))
+
+        self._outputs, self._done = {}, set()
+        self._progress = [0.0] * len(self._masks)
+        self._chunks, self._chunk_ivms = [], []
+        # A previous run which is still calculating estimates must not start its chunks
+        self._stop.set()
+        self._stop = threading.Event()
+        self._pending = None
+        self.status = Process.RUNNING
+        if options.pop("init-linear", False):
+            fas = []
+            while "fa%i" % (len(fas)+1) in options:
+                fas.append(float(options["fa%i" % (len(fas)+1)]))
+            for name in data_names:
+                if name not in self.ivm.data:
+                    raise QpException("Data not found: %s" % name)
+            nvols = self.ivm.data[data_names[0]].nvols if len(data_names) == 1 else len(data_names)
+            if nvols != len(fas):
+                raise QpException("Number of flip angles must match the number of volumes (%i)" % nvols)
+
+            # The chunks are started by _complete when the estimates are ready
+            self._pending = options
+            self._workers, self._worker_output = [None], [None]
+            thread = threading.Thread(target=self._estimate, args=(data_names, fas, float(options["tr"]), self._stop))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._start_chunks(fabber_process, options)
+
+    def _start_chunks(self, fabber_process, options, estimates=()):
+        """
+        Create a Fabber process for each chunk and start them
+
+        :param estimates: Sequence of QpData to add to each chunk ivm
+        """
+        for idx, data in enumerate(estimates):
+            options["PSP_byname%i" % (idx+1)] = FABBER_INIT[idx][0]
+            options["PSP_byname%i_type" % (idx+1)] = "I"
+            options["PSP_byname%i_image" % (idx+1)] = data.name
+
+        for idx, mask in enumerate(self._masks):
+            chunk_ivm = ChunkIvm(self.ivm, mask, self._grid, estimates)
+            self._chunk_ivms.append(chunk_ivm)
+            process = fabber_process(chunk_ivm, proc_id="%s_chunk%i" % (self.proc_id or self.PROCESS_NAME, idx))
+            process.sig_progress.connect(functools.partial(self._chunk_progress, idx))
+            process.sig_finished.connect(functools.partial(self._chunk_finished, idx))
+            self._chunks.append(process)
+
+        for idx, process in enumerate(self._chunks):
+            chunk_options = dict(options)
+            chunk_options["roi"] = CHUNK_ROI_NAME
+            process.execute(chunk_options)
+            if self.status != Process.RUNNING:
+                # A chunk failed to start
+                break
+
+    def _estimate(self, data_names, fas, tr, stop):
+        """
+        Calculate the linear estimates in a background thread and pass them
+        to the main thread through the worker completion callback
+        """
+        try:
+            result = (0, True, initial_estimates(self.ivm, data_names, fas, tr))
+        except Exception as exc:
+            result = (0, False, exc)
+        if not stop.is_set():
+            self._worker_finished_cb(result)
+
+    def _complete(self):
+        """
+        Start the chunks once the linear estimates are ready, otherwise complete the process
+        """
+        if self._pending is not None and self.status == Process.SUCCEEDED:
+            options, self._pending = self._pending, None
+            estimates = [NumpyData(arr, grid=self._grid, name=name)
+                         for (_, name), arr in zip(FABBER_INIT, self._worker_output[0])]
+            self._workers, self._worker_output = [], []
+            self.status = Process.RUNNING
+            try:
+                self._start_chunks(get_plugins("processes", "FabberProcess")[0], options, estimates)
+            except Exception as exc:
+                self.status = Process.FAILED
+                self.exception = exc
+                self._stop_chunks()
+                Process._complete(self)
+        elif self.status != Process.RUNNING:
+            # A queued completion from a previous run is ignored
+            Process._complete(self)
+
+    def cancel(self):
+        """
+        Cancel all the chunks
+        """
+        self._stop.set()
+        # The estimates may be ready but the chunks not started yet
+        if self.status == Process.RUNNING or self._pending is not None:
+            self._pending = None
+            self.status = Process.CANCELLED
+            self.exception = Exception("Process was cancelled")
+            self._stop_chunks()
+        self._complete()
+
+    def finished(self, worker_output):
+        """
+        Add the stitched outputs to the ivm
+        """
+        for name, arr in self._outputs.items():
+            self.ivm.add(arr, grid=self._grid, name=name)
+        self._outputs, self._chunk_ivms = {}, []
+
+    def _chunk_progress(self, idx, fraction):
+        self._progress[idx] = fraction
+        self.sig_progress.emit(sum(self._progress) / len(self._progress))
+
+    def _chunk_finished(self, idx, status, log, exception):
+        self.log(log)
+        if self.status != Process.RUNNING:
+            # Already failed or cancelled
+            return
+
+        if status == Process.SUCCEEDED:
+            self._collect(idx)
+            self._done.add(idx)
+            self._chunk_progress(idx, 1)
+            if len(self._done) == len(self._chunks):
+                self.status = Process.SUCCEEDED
+                self._complete()
+        else:
+            # If one chunk fails they all fail
+            self.status = status
+            self.exception = exception
+            self._stop_chunks()
+            self._complete()
+
+    def _collect(self, idx):
+        """
+        Copy the voxels of a chunk from the data items the chunk has output
+        """
+        mask, chunk_ivm = self._masks[idx], self._chunk_ivms[idx]
+        for name in chunk_ivm.outputs:
+            data = chunk_ivm.data[name]
+            if not data.grid.matches(self._grid):
+                data = data.resample(self._grid)
+            arr = data.raw()
+            if name not in self._outputs:
+                self._outputs[name] = np.zeros(arr.shape, dtype=arr.dtype)
+            self._outputs[name][mask] = arr[mask]
+
+    def _stop_chunks(self):
+        for process in self._chunks:
+            if process.status == Process.RUNNING:
+                process.cancel()
+        self._outputs, self._chunk_ivms = {}, []
@@ -0,0 +1,53 @@
+"""
+Quantiphyse - Lazily imported classes for the plugin manifest
+
+Quantiphyse loads the manifest of every plugin at startup. Listing classes
+directly would import their modules, and everything they depend on, even
+if they are never used. Instead the manifest lists proxy classes which only
+import the module when the class is first instantiated or an attribute
+which was not given to the proxy is accessed.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import importlib
+
+class _LazyClass(type):
+    """
+    Metaclass of the proxies. Using a metaclass means the proxies are classes
+    themselves, so they can be used where a class is expected, e.g. by the
+    unittest loader
+    """
+
+    def resolve(cls):
+        """
+        :return: The real class, importing its module if required
+        """
+        if cls._lazy_class is None:
+            module = importlib.import_module(cls._lazy_module, __package__)
+            cls._lazy_class = getattr(module, cls.__name__)
+        return cls._lazy_class
+
+    def __call__(cls, *args, **kwargs):
+        return cls.resolve()(*args, **kwargs)
+
+    def __getattr__(cls, name):
+        # Only called for attributes not defined on the proxy
+        if name.startswith("_lazy"):
+            raise AttributeError(name)
+        return getattr(cls.resolve(), name)
+
+    def __dir__(cls):
+        return dir(cls.resolve())
+
+def lazy_class(module, name, **attrs):
+    """
+    Create a proxy for a class which is imported on first use
+
+    :param module: Module containing the class, relative to this package, e.g. ``.process``
+    :param name: Name of the class
+    :param attrs: Class attributes which are available without importing the module
+    :return: Proxy class
+    """
+    attrs.update({"_lazy_module" : module, "_lazy_class" : None, "__module__" : __package__ + module})
+    return _LazyClass(name, (object,), attrs)
@@ -0,0 +1,70 @@
+"""
+Quantiphyse - Loading of VFA and AFI input files
+
+Input files are often on network storage, so validation only reads file
+headers and the image data of multiple files is read concurrently.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+import nibabel as nib
+
+from quantiphyse.data import load
+from quantiphyse.utils import QpException
+
+#: Maximum number of files read at the same time. Reading is limited by I/O
+#: rather than CPU so this does not depend on the number of cores
+MAX_LOAD_THREADS = 8
+
+def read_header(fname):
+    """
+    Get the dimensions of a data file without reading the image data
+
+    :return: Tuple of (3D grid shape, number of volumes)
+    """
+    if os.path.isdir(fname):
+        # DICOM folder - no header-only access so fall back to the full loader
+        data = load(fname)
+        return tuple(data.grid.shape), data.nvols
+    elif not (fname.endswith(".nii") or fname.endswith(".nii.gz")):
+        raise QpException("%s: Unrecognized file type" % fname)
+
+    try:
+        shape = list(nib.load(fname).shape)
+    except Exception as exc:
+        raise QpException("%s: Could not read NIFTI header: %s" % (fname, exc))
+    while len(shape) < 3:
+        shape.append(1)
+    nvols = shape[3] if len(shape) > 3 else 1
+    return tuple(shape[:3]), nvols
+
+def _load_data(fname):
+    data = load(fname)
+    data.raw()
+    return data
+
+def load_files(fnames, threads=None):
+    """
+    Load data files, reading their image data concurrently
+
+    :param fnames: Sequence of file names
+    :param threads: Number of files to read at the same time. Default is one
+                    per file up to ``MAX_LOAD_THREADS``
+    :return: List of QpData instances in the same order as ``fnames`` whose image
+             data has already been read
+    """
+    fnames = list(fnames)
+    if threads is None:
+        threads = MAX_LOAD_THREADS
+    threads = max(1, min(int(threads), len(fnames)))
+    if threads == 1:
+        return [_load_data(fname) for fname in fnames]
+
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(_load_data, fnames)
+    finally:
+        pool.terminate()
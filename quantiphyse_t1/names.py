@@ -0,0 +1,14 @@
+"""
+Quantiphyse - Names of the plugin's processes
+
+Used by the process classes and by the plugin manifest, which gives the names
+without importing the process modules
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+#: Name of the T10 calculation process (``T10Process``) in batch scripts
+T10_PROCESS = "T10"
+
+#: Name of the chunked Fabber T1 process (``FabberT1Process``) in batch scripts
+FABBER_T1_PROCESS = "FabberT1"
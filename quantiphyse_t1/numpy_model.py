@@ -0,0 +1,239 @@
+"""
+Quantiphyse - Pure Numpy implementation of VFA T1 mapping
+
+This computes the same linear (DESPOT1) fit as the C++ code in ``t1_model``
+but for blocks of voxels at once using array operations. It does not require
+the compiled extension and also serves as a reference implementation for
+checking the C++ code.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import numpy as np
+
+#: Number of voxels fitted at once. Limits the size of the
+#: temporary arrays used in the fit
+CHUNK_SIZE = 65536
+
+#: T1 values (s) are clamped to the range [0, T1_MAX] as in the C++ code
+T1_MAX = 5.0
+
+#: Goodness of fit outputs calculated by ``fit_statistics``
+FIT_STATISTICS = ("m0", "r2", "resvar", "t1_se")
+
+#: Additional outputs which can be calculated alongside T1
+EXTRA_OUTPUTS = FIT_STATISTICS + ("b1",)
+
+def afi_ratio(afi_vols, fa_afi, TR_afi):
+    """
+    Calculate the ratio of actual to nominal flip angle from AFI data
+
+    :param afi_vols: Sequence of two arrays containing the AFI signals
+    :param fa_afi: Flip angle of the AFI acquisition in degrees
+    :param TR_afi: Sequence of the two TRs of the AFI acquisition
+    :return: Array of flip angle ratios. Voxels where the ratio is undefined
+             (e.g. zero AFI signal) are set to zero. Ref: DOI 10.1002/mrm.21120
+    """
+    n = float(TR_afi[1]) / float(TR_afi[0])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = np.asarray(afi_vols[1], dtype=np.float64) / np.asarray(afi_vols[0], dtype=np.float64)
+        # Eq 6 of Ref. Values outside [-1, 1] take the real part of the complex
+        # inverse cosine, i.e. 0 or pi
+        alpha = np.arccos(np.clip((r*n - 1) / (n - r), -1, 1))
+    alpha[np.isnan(alpha)] = 0
+    return alpha / np.radians(fa_afi)
+
+def linear_fit(signal, fa_rad, TR):
+    """
+    Linear VFA fit for a block of voxels
+
+    :param signal: Array of shape [num_fa, num_voxels]
+    :param fa_rad: Flip angles in radians, either shape [num_fa, 1] or
+                   [num_fa, num_voxels] if they vary between voxels
+    :param TR: Repetition time in s
+    :return: Tuple of (unclamped T1, M0) arrays of shape [num_voxels]
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = signal / np.tan(fa_rad)
+        y = signal / np.sin(fa_rad)
+
+        # Gradient and intercept from linear regression of y against x
+        x_mean, y_mean = np.mean(x, axis=0), np.mean(y, axis=0)
+        x -= x_mean
+        y -= y_mean
+        b = np.sum(x * y, axis=0) / np.sum(x * x, axis=0)
+        a = y_mean - b * x_mean
+
+        # Requiring gradient to be greater than 0
+        t1 = np.zeros(b.shape, dtype=b.dtype)
+        positive = b > 0
+        t1[positive] = -TR / np.log(b[positive])
+        m0 = a / (1 - b)
+
+    return t1, m0
+
+def clamp_t1(t1):
+    """
+    Clamp T1 values in place to [0, T1_MAX]
+    """
+    t1[t1 > T1_MAX] = T1_MAX
+    t1[~(t1 >= 0)] = 0
+    return t1
+
+def fit_statistics(signal, fa_rad, TR, m0, t1):
+    """
+    Goodness of fit of the SPGR signal equation for fitted M0 and T1
+
+    Voxels where the fit failed have all outputs set to zero
+
+    :return: Dictionary of ``m0``, ``r2``, ``resvar`` and ``t1_se`` arrays
+    """
+    num_fa = signal.shape[0]
+    stats = dict([(name, np.zeros(t1.shape, dtype=t1.dtype)) for name in FIT_STATISTICS])
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        valid = (t1 > 0) & np.isfinite(t1) & np.isfinite(m0)
+        signal = signal[:, valid]
+        t1, m0 = t1[valid], m0[valid]
+        if fa_rad.shape[1] > 1:
+            fa_rad = fa_rad[:, valid]
+
+        e1 = np.exp(-TR / t1)
+        sina, cosa = np.sin(fa_rad), np.cos(fa_rad)
+        denom = 1 - cosa * e1
+        f = sina * (1 - e1) / denom
+        ssres = np.sum(np.square(signal - m0 * f), axis=0)
+        sstot = np.sum(np.square(signal - np.mean(signal, axis=0)), axis=0)
+
+        # Analytic Jacobian with respect to M0 and T1
+        dm0 = f
+        dt1 = m0 * sina * (cosa - 1) / np.square(denom) * e1 * TR / np.square(t1)
+        jtj00, jtj01, jtj11 = np.sum(dm0 * dm0, axis=0), np.sum(dm0 * dt1, axis=0), np.sum(dt1 * dt1, axis=0)
+        det = jtj00 * jtj11 - jtj01 * jtj01
+
+        stats["m0"][valid] = m0
+        stats["r2"][valid] = np.where(sstot > 0, 1 - ssres / sstot, 0)
+        if num_fa > 2:
+            resvar = ssres / (num_fa - 2)
+            stats["resvar"][valid] = resvar
+            stats["t1_se"][valid] = np.where(det > 0, np.sqrt(resvar * jtj00 / det), 0)
+    return stats
+
+def t10_map(fa_vols, fa, TR, afi_vols=None, fa_afi=None, TR_afi=None, out=None, threads=None, method="linear",
+            extras=None, b1=None, counts=None, progress=None, dtype="float64"):
+    """
+    Numpy equivalent of ``t1_model.t10_map``
+
+    Args:
+        fa_vols: List of volumes
+        fa: Corresponding flip angles of each volume
+        TR: Repetition time (s)
+        afi_vols: Optional list of the two AFI volumes for B1 correction
+        fa_afi: Flip angle of AFI acquisition
+        TR_afi: Sequence of the two TRs of the AFI acquisition (s)
+        out: Optional preallocated array of type ``dtype`` with the same shape
+             as the volumes which the T10 map will be written to
+        threads: Ignored, accepted for compatibility with the C++ wrapper
+        method: Fitting method. Only ``linear`` is supported
+        extras: Optional dictionary of additional outputs as for
+                ``t1_model.t10_map``
+        b1: Optional precomputed flip angle ratio map used instead of AFI volumes
+        counts: Optional dictionary which counts are added to, as for
+                ``t1_model.t10_map``. ``bytes_allocated`` includes the
+                arrays for the first chunk of voxels, but not other temporaries
+        progress: Optional progress callback as for ``t1_model.t10_map``,
+                  called after each chunk of ``CHUNK_SIZE`` voxels
+        dtype: Precision of the calculation and outputs, ``float64`` or ``float32``
+
+    Returns:
+        T10 map with the same shape as the input volumes
+    """
+    if method != "linear":
+        raise ValueError("Unsupported fitting method for Numpy engine: %s" % method)
+    if len(fa_vols) != len(fa):
+        raise ValueError("Number of flip angles (%i) does not match number of volumes (%i)" % (len(fa), len(fa_vols)))
+    if afi_vols is not None and (len(afi_vols) != 2 or len(TR_afi) != 2):
+        raise ValueError("AFI correction requires two volumes and two TRs")
+    if afi_vols is not None and b1 is not None:
+        raise ValueError("Cannot specify both AFI volumes and a B1 map")
+    for name in (extras or {}):
+        if name not in EXTRA_OUTPUTS:
+            raise ValueError("Unknown output: %s" % name)
+
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("Unsupported calculation type: %s" % dtype)
+    # So a float64 TR does not promote the calculation to double precision
+    TR = dtype.type(TR)
+
+    shape = np.shape(fa_vols[0])
+    allocated = 0 if out is None else -out.nbytes
+    out, out_flat = _prepare_output(out, shape, dtype)
+    allocated += out.nbytes
+    extras_flat = {}
+    for name in list(extras or {}):
+        if extras[name] is None:
+            allocated += int(np.prod(shape)) * dtype.itemsize
+        extras[name], extras_flat[name] = _prepare_output(extras[name], shape, dtype)
+    fitted, clamped, rejected = 0, 0, 0
+
+    fa_flat = [np.reshape(vol, -1) for vol in fa_vols]
+    if afi_vols is not None:
+        afi_flat = [np.reshape(vol, -1) for vol in afi_vols]
+    if b1 is not None:
+        b1_flat = np.reshape(np.asarray(b1, dtype=dtype), -1)
+
+    fa_rad = np.radians(np.array(fa, dtype=dtype))[:, np.newaxis]
+    for start in range(0, out_flat.size, CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        signal = np.array([vol[chunk] for vol in fa_flat], dtype=dtype)
+        if afi_vols is not None:
+            ratio = afi_ratio([vol[chunk] for vol in afi_flat], fa_afi, TR_afi).astype(dtype)
+        elif b1 is not None:
+            ratio = b1_flat[chunk]
+        else:
+            ratio = 1
+        angles = fa_rad * ratio
+        t1, m0 = linear_fit(signal, angles, TR)
+        if start == 0:
+            allocated += signal.nbytes + angles.nbytes + t1.nbytes + m0.nbytes
+        if "b1" in extras_flat:
+            extras_flat["b1"][chunk] = ratio
+        if set(extras_flat) - set(["b1"]):
+            stats = fit_statistics(signal, angles, TR, m0, t1)
+            for name, flat in extras_flat.items():
+                if name in stats:
+                    flat[chunk] = stats[name]
+        fitted += t1.size
+        clamped += np.count_nonzero(t1 > T1_MAX)
+        rejected += np.count_nonzero(~(t1 > 0))
+        out_flat[chunk] = clamp_t1(t1)
+        if progress is not None and progress(float(min(start + CHUNK_SIZE, out_flat.size)) / out_flat.size):
+            break
+
+    if counts is not None:
+        for name, value in (("fitted", fitted), ("clamped", clamped), ("rejected", rejected),
+                            ("bytes_allocated", allocated)):
+            counts[name] = counts.get(name, 0) + int(value)
+    _finish_output(out, out_flat)
+    for name, flat in extras_flat.items():
+        _finish_output(extras[name], flat)
+    return out
+
+def _prepare_output(arr, shape, dtype):
+    """
+    Allocate an output array if not given
+
+    :return: Tuple of (output array, 1D array to write to)
+    """
+    if arr is None:
+        arr = np.empty(shape, dtype=dtype)
+    elif arr.shape != shape or arr.dtype != dtype:
+        raise ValueError("Output array must be %s with shape %s" % (dtype.name, str(shape)))
+    return arr, np.reshape(arr, -1)
+
+def _finish_output(arr, flat):
+    """
+    Copy output into the output array if it could not be written to directly
+    """
+    if not np.shares_memory(flat, arr):
+        arr[...] = np.reshape(flat, arr.shape)
@@ -0,0 +1,117 @@
+"""
+Quantiphyse - Post-processing of T1 maps
+
+Smoothing, clamping and replacement of non-finite values are done in place,
+a slab of z slices at a time, so the only temporary arrays are the size of a
+slab and memory use does not grow with the size of the map. This works for
+in-memory arrays and memory-mapped outputs of streamed runs.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import numpy as np
+
+from .streaming import slab_ranges
+
+#: Approximate number of voxels processed at a time if the slab size is not given
+SLAB_VOXELS = 1024 * 1024
+
+def postprocess_options(options):
+    """
+    Remove the post-processing options from an options dictionary: ``nan-value``
+    replaces NaN and infinite values, ``smooth`` (``sigma``, ``truncate`` and
+    ``masked`` to only smooth fitted voxels) and ``clamp`` (``min`` and ``max``)
+
+    :return: Keyword arguments for ``postprocess``
+    """
+    nan_value = options.pop("nan-value", None)
+    if nan_value is not None:
+        nan_value = float(nan_value)
+    return {"smooth" : options.pop("smooth", None), "clamp" : options.pop("clamp", None),
+            "nan_value" : nan_value}
+
+def postprocess(arr, smooth=None, clamp=None, nan_value=None, mask=None, slab_size=None):
+    """
+    Post-process a 3D map in place
+
+    Non-finite values are replaced first so they are not spread by smoothing,
+    and clamping is done last
+
+    :param arr: 3D array to modify
+    :param smooth: Optional dictionary of smoothing options: ``sigma``, ``truncate``
+                   and ``masked`` to restrict smoothing to ``mask``
+    :param clamp: Optional dictionary with ``min`` and ``max`` values
+    :param nan_value: If not None, value given to NaN and infinite voxels
+    :param mask: Optional boolean mask of fitted voxels used for masked smoothing
+    :param slab_size: Number of z slices processed at a time
+    :return: ``arr``
+    """
+    if slab_size is None:
+        slab_size = max(1, SLAB_VOXELS // max(1, arr.shape[0] * arr.shape[1]))
+    if nan_value is not None:
+        replace_nonfinite(arr, nan_value, slab_size)
+    if smooth is not None:
+        gaussian_smooth(arr, smooth.get("sigma", 0.5), smooth.get("truncate", 3),
+                        mask=mask if smooth.get("masked", False) else None, slab_size=slab_size)
+    if clamp is not None:
+        clamp_values(arr, clamp["min"], clamp["max"], slab_size)
+    return arr
+
+def replace_nonfinite(arr, value, slab_size):
+    """
+    Replace NaN and infinite values in place
+    """
+    for start, end in slab_ranges(arr.shape[2], slab_size):
+        slab = arr[:, :, start:end]
+        np.copyto(slab, value, where=~np.isfinite(slab))
+
+def clamp_values(arr, vmin, vmax, slab_size):
+    """
+    Clamp values in place to the range [vmin, vmax]
+    """
+    for start, end in slab_ranges(arr.shape[2], slab_size):
+        slab = arr[:, :, start:end]
+        np.clip(slab, vmin, vmax, out=slab)
+
+def gaussian_smooth(arr, sigma, truncate=3, mask=None, slab_size=1):
+    """
+    Separable Gaussian smoothing in place
+
+    Each slab is smoothed together with the neighbouring slices within the
+    filter radius, so the result is the same as ``scipy.ndimage.gaussian_filter``.
+    The original values of slices overwritten by the previous slab which are
+    needed by the next are kept in a buffer.
+
+    If ``mask`` is given, only voxels in the mask are smoothed and they are
+    only affected by other voxels in the mask (normalized convolution)
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    nz = arr.shape[2]
+    saved = None
+    for start, end in slab_ranges(nz, slab_size):
+        lo, hi = max(0, start - radius), min(nz, end + radius)
+        block = np.empty(arr.shape[:2] + (hi - lo,), dtype=arr.dtype)
+        if saved is not None:
+            block[:, :, :start-lo] = saved
+        block[:, :, start-lo:] = arr[:, :, start:hi]
+        # Original values of the slices the next slab needs from this one
+        saved = block[:, :, max(lo, end - radius)-lo:end-lo].copy()
+
+        if mask is None:
+            _smooth_block(block, sigma, truncate)
+            arr[:, :, start:end] = block[:, :, start-lo:end-lo]
+        else:
+            weights = mask[:, :, lo:hi].astype(arr.dtype)
+            block *= weights
+            _smooth_block(block, sigma, truncate)
+            _smooth_block(weights, sigma, truncate)
+            inside = mask[:, :, start:end] & (weights[:, :, start-lo:end-lo] > 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                smoothed = block[:, :, start-lo:end-lo] / weights[:, :, start-lo:end-lo]
+            np.copyto(arr[:, :, start:end], smoothed, where=inside)
+
+def _smooth_block(block, sigma, truncate):
+    # scipy.ndimage is slow to import so is only loaded if smoothing is used
+    from scipy.ndimage import gaussian_filter1d
+    for axis in range(3):
+        gaussian_filter1d(block, sigma=sigma, axis=axis, truncate=truncate, output=block)
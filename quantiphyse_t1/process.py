@@ -5,15 +5,52 @@ Copyright (c) 2013-2018 University of Oxford
 """
 
 import os
+import time
+import cProfile
+import pstats
+import contextlib
+import collections
+import threading
 
-import numpy as np
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
-from scipy.ndimage.filters import gaussian_filter
+import numpy as np
 
-from quantiphyse.data import load
+from quantiphyse.data import load, DataGrid
 from quantiphyse.processes import Process
+from quantiphyse.utils import QpException
+
+from .b1_cache import B1_CACHE
+from .cache import ArrayCache, data_key, file_key, grid_key, options_key
+from .engines import EXTRA_OUTPUTS, auto_mask, fit_options, fit_masked, input_volumes
+from .loading import load_files
+from .names import T10_PROCESS
+from .postprocess import postprocess, postprocess_options
+from .streaming import NiftiSource, ArraySource, create_output, fit_slabs
+
+# Inputs resampled onto the output grid are cached so reruns on the same
+# data do not repeat the resampling. Default size limit in bytes
+RESAMPLE_CACHE_BYTES = 256 * 1024 * 1024
+RESAMPLE_CACHE = ArrayCache(RESAMPLE_CACHE_BYTES)
+
+# Time in seconds to wait for a cancelled background run to stop before
+# refusing to start a new run
+STOP_TIMEOUT = 5
 
-from .t1_model import t10_map
+# Options which do not affect the result of the fit, so changing them does not
+# prevent the previous fit being reused
+NON_FIT_OPTIONS = ("smooth", "clamp", "nan-value", "threads", "load-threads", "reuse-fit", "b1-cache", "b1-cache-dir",
+                   "b1-cache-size", "resample-cache", "resample-cache-size", "profile")
+
+# Environment variable which enables profiling of T10 runs if the ``profile``
+# option is not given. Values are interpreted as for the ``profile`` option
+PROFILE_ENV = "QP_T1_PROFILE"
+
+# Number of functions shown when profiling output is logged
+PROFILE_LINES = 25
 
 def _get_filepath(fname, folder):
     if os.path.isabs(fname):
@@ -26,74 +63,486 @@ class T10Process(Process):
     Process which calculates T1 map from VFA images
     """
 
-    PROCESS_NAME = "T10"
-    
+    PROCESS_NAME = T10_PROCESS
+
+
     def __init__(self, ivm, **kwargs):
+        # If True, run() returns immediately and the calculation is done in a
+        # background thread, with progress reported using sig_progress
+        self._background = kwargs.pop("background", False)
         Process.__init__(self, ivm, **kwargs)
+        self._thread = None
+        # Set when the current run is cancelled. Each run has its own event, as
+        # execute() resets the status before a new run checks the old one has stopped
+        self._stop = threading.Event()
+        self._b1_cache, self._b1_cache_dir = None, None
+        self._resample_cache = None
+        self._progress_range = (0, 1)
+        self._outputs = None
+        # Key identifying the inputs of the last fit and the unsmoothed, unclamped
+        # outputs, so a rerun which only changes post-processing can skip the fit
+        self._last_fit = None
+        self.stats = {}
 
     def run(self, options):
-        # TR specified in ms but pass in s
-        tr = float(options.pop("tr"))/1000
-        fa_vols, fas = [], []
-        grid = None
-        for fname, fa in options.pop("vfa").items():
-            self.debug("FA=%f: %s", fa, fname)
-            if fname in self.ivm.data:
-                data = self.ivm.data[fname]
-            else:
-                data = load(_get_filepath(fname, self.indir))
-            
-            if grid is None: 
-                grid = data.grid
+        """
+        Run the T10 calculation
+
+        Time spent in each stage and counts of voxels fitted are stored in the
+        ``stats`` attribute and written to the debug log. If the ``profile``
+        option (or the QP_T1_PROFILE environment variable) is set, the run is
+        also profiled. The profile is saved to the file named by the option or,
+        if it is True, the most expensive functions are written to the debug log
+        """
+        # A cancelled background run stops at its next progress update. It must
+        # have stopped before the process state is reused for a new run
+        if self._thread is not None:
+            self._thread.join(STOP_TIMEOUT)
+            if self._thread.is_alive():
+                raise QpException("Previous T10 calculation is still stopping - try again later")
+            self._thread = None
+
+        self._stop = threading.Event()
+        if self._background:
+            # The thread is the single worker of the base class, so it completes
+            # like a multiprocessing run. The ivm is not thread safe, so outputs
+            # are added by finished() in this thread
+            self._workers, self._worker_output = [None], [None]
+            self.status = Process.RUNNING
+            self._outputs = []
+            self._thread = threading.Thread(target=self._run_background, args=(options, self._stop))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._run_timed(options)
+
+    def _run_background(self, options, stop):
+        try:
+            self._run_timed(options)
+            result = (0, True, self._outputs)
+        except Exception as exc:
+            result = (0, False, exc)
+        # A cancelled run has already completed
+        if not stop.is_set():
+            self._worker_finished_cb(result)
+
+    def _complete(self):
+        """
+        Ignore a completion queued by a background run which has been replaced
+        by a new run before the completion was delivered
+        """
+        if self.status != Process.RUNNING:
+            Process._complete(self)
+
+    def cancel(self):
+        """
+        Cancel the current run. A background run stops at its next progress update
+        """
+        self._stop.set()
+        Process.cancel(self)
+
+    def finished(self, worker_output):
+        """
+        Add the outputs of a background run to the ivm
+        """
+        for outputs in worker_output:
+            for data, kwargs in outputs:
+                self.ivm.add(data, **kwargs)
+        self._outputs = None
+
+    def _add_output(self, data, **kwargs):
+        """
+        Add output data to the ivm, or save it to be added when a background run finishes
+        """
+        if self._outputs is not None:
+            self._outputs.append((data, kwargs))
+        else:
+            self.ivm.add(data, **kwargs)
+
+    def _fit_progress(self, fraction):
+        """
+        Progress callback for the fitting engine. The fraction of the current fit
+        done is scaled into the part of the run given by ``_progress_range``
+
+        :return: True if the process has been cancelled, to stop the fit
+        """
+        start, width = self._progress_range
+        self.sig_progress.emit(start + width * fraction)
+        return self._stop.is_set()
+
+    def _run_timed(self, options):
+        """
+        Run the T10 calculation, recording stage timings and optionally profiling
+        """
+        self.stats = {"stages" : collections.OrderedDict(), "counts" : {}}
+        self._progress_range = (0, 1)
+        profile = options.pop("profile", os.environ.get(PROFILE_ENV, None))
+        profiler = None
+        if profile and profile not in ("0", "false", "False"):
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = time.time()
+        try:
+            self._run(options)
+        finally:
+            self.stats["total"] = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profile_output(profiler, profile)
+            self.debug("Stage timings (s): %s", ", ".join(["%s=%.3f" % item for item in self.stats["stages"].items()]))
+            self.debug("Voxel counts: %s", self.stats["counts"])
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        """
+        Context manager which adds the time spent in the block to the named stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            stages = self.stats["stages"]
+            stages[name] = stages.get(name, 0) + time.time() - start
+
+    def _profile_output(self, profiler, profile):
+        """
+        Save profiling output to a file or the debug log
+        """
+        if profile in (True, "1", "true", "True"):
+            stream = StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            self.debug("Profile:\n%s", stream.getvalue())
+        else:
+            fname = _get_filepath(profile, self.outdir)
+            profiler.dump_stats(fname)
+            self.debug("Profile saved to %s", fname)
+
+    def _run(self, options):
+        fit_key = self._fit_key(options)
+        # Number of input files read at the same time
+        load_threads = options.pop("load-threads", None)
+        try:
+            tr, fill, t10_map, fit_kwargs, outputs = fit_options(options)
+        except ValueError as exc:
+            raise QpException(str(exc))
+
+        # B1 maps calculated from AFI data are cached so repeated runs with the
+        # same AFI data do not recalculate them. The maps are keyed by the identity
+        # of the AFI data sets so a cached map is found without reading the data
+        self._b1_cache = B1_CACHE if options.pop("b1-cache", True) else None
+        self._b1_cache_dir = options.pop("b1-cache-dir", None)
+        if self._b1_cache_dir is not None:
+            self._b1_cache_dir = _get_filepath(self._b1_cache_dir, self.outdir)
+        cache_size = options.pop("b1-cache-size", None)
+        if cache_size is not None:
+            # Size in Mb
+            B1_CACHE.resize(int(float(cache_size) * 1024 * 1024))
+
+        # Similarly for inputs which need to be resampled
+        self._resample_cache = RESAMPLE_CACHE if options.pop("resample-cache", True) else None
+        cache_size = options.pop("resample-cache-size", None)
+        if cache_size is not None:
+            RESAMPLE_CACHE.resize(int(float(cache_size) * 1024 * 1024))
+
+        slab = options.pop("slab", None)
+        if slab is not None:
+            self._run_slabs(int(slab), options, tr, fill, t10_map, fit_kwargs, outputs)
+            return
+
+        post_options = postprocess_options(options)
+        if not options.pop("reuse-fit", True):
+            self._last_fit = None
+        if self._last_fit is not None and self._last_fit[0] == fit_key:
+            self.debug("Fit inputs unchanged - reusing previous fit")
+            _, grid, T10, extras, mask = self._last_fit
+            for key in ("vfa", "afi", "fa-afi", "roi", "auto-mask"):
+                options.pop(key, None)
+            self.stats["reused"] = True
+        else:
+            # Release the previous fit before doing another
+            self._last_fit = None
+            grid, T10, extras, mask = self._fit_inputs(options, tr, load_threads, fill, t10_map, fit_kwargs, outputs)
+            if fit_key is not None:
+                self._last_fit = (fit_key, grid, T10, extras, mask)
+            self.stats["reused"] = False
+
+        if self._last_fit is not None:
+            # Keep the unprocessed fit for reuse. The outputs must not share its
+            # buffers, or changes to the output data would change the next reused fit
+            with self._stage("output"):
+                T10 = T10.copy()
+                extras = dict([(name, extras[name].copy()) for name in outputs])
+        if any([value is not None for value in post_options.values()]):
+            with self._stage("postprocess"):
+                postprocess(T10, mask=mask, **post_options)
+        with self._stage("output"):
+            self._add_output(T10, grid=grid, name="T10", make_current=True)
+            for name in outputs:
+                self._add_output(extras[name], grid=grid, name=EXTRA_OUTPUTS[name])
+
+    def _fit_key(self, options):
+        """
+        :return: Hashable key identifying the inputs of the fit, i.e. all options which
+                 affect the fitted values and the identity of the input data, or None
+                 if the fit cannot be reused. Data modified in place is not detected
+        """
+        if options.get("slab", None) is not None:
+            # Outputs are written to files so there is nothing to reuse
+            return None
+        names = list(options.get("vfa", {})) + list(options.get("afi", None) or {})
+        if options.get("roi", None):
+            names.append(options["roi"])
+        inputs = []
+        for name in names:
+            if name in self.ivm.data:
+                inputs.append(data_key(self.ivm.data[name]))
             else:
-                data = data.resample(grid)
-            
-            arr = data.raw()
-            if isinstance(fa, list):
-                if len(fa) > 1:
-                    for i, a in enumerate(fa):
-                        fas.append(a)
-                        fa_vols.append(arr[:, :, :, i])
+                inputs.append(file_key(_get_filepath(name, self.indir)))
+        fit_opts = dict([(key, value) for key, value in options.items() if key not in NON_FIT_OPTIONS])
+        return (options_key(fit_opts), tuple(inputs))
+
+    def _fit_inputs(self, options, tr, load_threads, fill, t10_map, fit_kwargs, outputs):
+        """
+        Load the input data and do the fit, without post-processing
+
+        :return: Tuple of (output grid, T10 map, dictionary of extra outputs,
+                 mask of fitted voxels or None if all voxels were fitted)
+        """
+        extras = dict.fromkeys(outputs)
+        fit_kwargs["extras"] = extras
+
+        vfa = input_volumes(options.pop("vfa"))
+        # AFI TRs specified in ms but pass in s
+        afi = input_volumes(options.pop("afi", None) or {}, scale=0.001)
+        with self._stage("load"):
+            inputs = self._load_inputs(list(set([fname for fname, _, _ in vfa + afi])), load_threads)
+
+        # Inputs are resampled onto the grid of the first VFA data
+        grid, arrays = None, {}
+        def _volume(fname, idx):
+            if fname not in arrays:
+                data = inputs[fname]
+                if grid is None:
+                    with self._stage("load"):
+                        arrays[fname] = data.raw()
                 else:
-                    fas.append(fa[0])
-                    fa_vols.append(arr)
-            else:
-                fas.append(fa)
-                fa_vols.append(arr)
+                    arrays[fname] = self._resample(data, grid)
+            arr = arrays[fname]
+            return arr if idx is None else arr[:, :, :, idx]
 
-        if "afi" in options:
+        fa_vols, fas = [], []
+        for fname, idx, fa in vfa:
+            self.debug("FA=%s: %s", fa, fname)
+            fa_vols.append(_volume(fname, idx))
+            fas.append(fa)
+            if grid is None:
+                grid = inputs[fname].grid
+
+        if afi:
             # We are doing a B0 correction (preclinical)
-            afi_vols, trs = [], []
-            for fname, t in options.pop("afi").items():
-                if fname in self.ivm.data:
-                    data = self.ivm.data[fname]
-                else:
-                    data = load(_get_filepath(fname, self.indir))
-                    
-                if grid is None: 
-                    grid = data.grid
-                else:
-                    data = data.resample(grid)
-            
-                arr = data.raw()
-                if isinstance(t, list):
-                    for i, a in enumerate(t):
-                        trs.append(float(a)/1000)
-                        afi_vols.append(arr[:, :, :, i])
-                else:
-                    trs.append(t)
-                    afi_vols.append(arr)
-
-            fa_afi = options.pop("fa-afi")
-            T10 = t10_map(fa_vols, fas, TR=tr, afi_vols=afi_vols, fa_afi=fa_afi, TR_afi=trs)
-            smooth = options.pop("smooth", None)
-            if smooth is not None:
-                T10 = gaussian_filter(T10, sigma=smooth.get("sigma", 0.5), 
-                                      truncate=smooth.get("truncate", 3))
+            fit_kwargs["afi_vols"] = [_volume(fname, idx) for fname, idx, _ in afi]
+            fit_kwargs["TR_afi"] = [afi_tr for _, _, afi_tr in afi]
+            fit_kwargs["fa_afi"] = options.pop("fa-afi")
+            fit_kwargs["afi_key"] = (tuple([(data_key(inputs[fname]), idx) for fname, idx, _ in afi]), grid_key(grid))
+
+        mask = self._get_mask(options, grid, fa_vols)
+        T10 = self._fit(t10_map, mask, fill, fa_vols, fas, tr, **fit_kwargs)
+        return grid, T10, extras, mask
+
+    def _load_inputs(self, fnames, threads=None):
+        """
+        Get input data from the ivm or, if not there, load it from files.
+        Files are read concurrently
+
+        :return: Mapping from name to QpData
+        """
+        inputs = dict([(fname, self.ivm.data[fname]) for fname in fnames if fname in self.ivm.data])
+        to_load = [fname for fname in fnames if fname not in inputs]
+        if to_load:
+            self.debug("Loading %i files", len(to_load))
+            paths = [_get_filepath(fname, self.indir) for fname in to_load]
+            inputs.update(zip(to_load, load_files(paths, threads)))
+        return inputs
+
+    def _resample(self, data, grid):
+        """
+        :return: Raw data resampled onto ``grid``. If the resampling cache is enabled,
+                 the array is read-only and may be taken from the cache. Data
+                 already on ``grid`` is returned without resampling or caching
+        """
+        if data.grid.matches(grid):
+            return data.raw()
+        elif self._resample_cache is None:
+            with self._stage("resample"):
+                return data.resample(grid).raw()
+
+        key = (data_key(data), grid_key(grid))
+        arr = self._resample_cache.get(key)
+        if arr is None:
+            with self._stage("resample"):
+                arr = self._resample_cache.put(key, data.resample(grid).raw())
+        else:
+            self.debug("Using cached resampled data: %s", data.name)
+        return arr
+
+    def _get_mask(self, options, grid, fa_vols):
+        """
+        Get the mask of voxels to fit, or None if all voxels are to be fitted
+
+        The mask combines the ``roi`` option (name of an ROI or an ROI file)
+        and the ``auto-mask`` option, which excludes background voxels whose
+        signal does not exceed the given threshold in any of the VFA volumes
+        """
+        with self._stage("mask"):
+            mask = self._get_roi_mask(options, grid)
+            mask = auto_mask(options.pop("auto-mask", None), fa_vols, mask)
+        if mask is not None:
+            self.debug("Fitting %i of %i voxels", np.count_nonzero(mask), mask.size)
+        return mask
+
+    def _get_roi_mask(self, options, grid):
+        """
+        :return: Boolean mask from the ``roi`` option on ``grid``, or None if not specified
+        """
+        roi_name = options.pop("roi", None)
+        if not roi_name:
+            return None
+
+        if roi_name in self.ivm.rois:
+            roi = self.ivm.rois[roi_name]
         else:
-            T10 = t10_map(fa_vols, fas, tr)
+            roi = load(_get_filepath(roi_name, self.indir))
+        mask = self._resample(roi, grid) > 0
+        if mask.ndim > 3:
+            raise QpException("ROI must be a 3D volume")
+        return mask
+
+    def _fit(self, t10_map, mask, fill, fa_vols, fas, tr, out=None, **kwargs):
+        """
+        Run the T10 fit using the selected engine, restricted to the voxels in ``mask`` if specified
+
+        See ``engines.fit_masked``. If AFI data is given and the B1 cache is
+        enabled, the B1 map calculated from it is taken from the cache where possible.
+        ``afi_key`` identifies the AFI data in the cache
+        """
+        kwargs["counts"] = self.stats["counts"]
+        kwargs["progress"] = self._fit_progress
+        afi_key = kwargs.pop("afi_key", None)
+        if kwargs.get("afi_vols", None) is not None and self._b1_cache is not None:
+            with self._stage("b1"):
+                kwargs["b1"] = self._b1_cache.get(kwargs.pop("afi_vols"), kwargs.pop("fa_afi"), kwargs.pop("TR_afi"),
+                                                  self._b1_cache_dir, source_key=afi_key)
+        with self._stage("fit"):
+            out = fit_masked(t10_map, mask, fill, fa_vols, fas, tr, out=out, **kwargs)
+        self._check_cancelled()
+        return out
+
+    def _check_cancelled(self):
+        """
+        Stop the calculation if the process has been cancelled
+        """
+        if self._stop.is_set():
+            raise QpException("T10 calculation cancelled")
+
+    def _get_source(self, fname, grid):
+        """
+        Get a slab-readable source for an input data set
+
+        Files are memory-mapped so only the slabs being processed are read. Data
+        already in the ivm is resampled onto the output grid if required
+        """
+        if fname in self.ivm.data:
+            data = self.ivm.data[fname]
+            if grid is None:
+                grid = data.grid
+            elif not data.grid.matches(grid):
+                return ArraySource(self._resample(data, grid)), grid
+            return ArraySource(data.raw()), grid
+
+        source = NiftiSource(_get_filepath(fname, self.indir))
+        source_grid = DataGrid(source.shape, source.affine)
+        if grid is None:
+            grid = source_grid
+        elif not source_grid.matches(grid):
+            raise QpException("Streamed input files must all be on the same grid: %s" % fname)
+        return source, grid
 
-        clamp = options.pop("clamp", None)
-        if clamp is not None:
-            np.clip(T10, clamp["min"], clamp["max"], out=T10)
-        self.ivm.add(T10, grid=grid, name="T10", make_current=True)
+    def _run_slabs(self, slab_size, options, tr, fill, t10_map, fit_kwargs, outputs):
+        """
+        Streaming version of the T10 calculation for data sets which do not fit in memory
+
+        The inputs are read and fitted in slabs of ``slab_size`` z slices and the output is
+        written to a memory-mapped file, either the ``output-file`` option or a temporary
+        file, so memory use is bounded by the slab size rather than the data size. Additional
+        outputs are written to files in the same folder as ``output-file``, named after the
+        output, e.g. ``M0.nii``. B1 maps are not cached, so memory use does not
+        grow with the number of slabs
+        """
+        self._b1_cache = None
+        grid = None
+        fa_sources, fas = [], []
+        for fname, idx, fa in input_volumes(options.pop("vfa")):
+            source, grid = self._get_source(fname, grid)
+            fas.append(fa)
+            fa_sources.append((source, idx))
+
+        afi_sources = None
+        if options.get("afi", None):
+            afi_sources, trs = [], []
+            # AFI TRs specified in ms but pass in s
+            for fname, idx, afi_tr in input_volumes(options.pop("afi"), scale=0.001):
+                source, grid = self._get_source(fname, grid)
+                trs.append(afi_tr)
+                afi_sources.append((source, idx))
+            fit_kwargs.update({"fa_afi" : options.pop("fa-afi"), "TR_afi" : trs})
+        options.pop("afi", None)
+
+        with self._stage("mask"):
+            roi_mask = self._get_roi_mask(options, grid)
+        threshold = options.pop("auto-mask", None)
+        post_options = postprocess_options(options)
+        fit_mask = None
+        if (roi_mask is not None or threshold is not None) and (post_options["smooth"] or {}).get("masked", False):
+            # Masked smoothing needs the mask of fitted voxels for the whole volume
+            fit_mask = np.ones(grid.shape, dtype=bool)
+        output_file = options.pop("output-file", None)
+        if output_file is not None:
+            output_file = _get_filepath(output_file, self.outdir)
+        try:
+            T10 = create_output(grid.shape, grid.affine, output_file, dtype=fit_kwargs["dtype"])
+        except ValueError as exc:
+            raise QpException(str(exc))
+        extras = {}
+        for name in outputs:
+            # Additional outputs are written alongside the output file if given
+            extra_file = None
+            if output_file is not None:
+                extra_file = os.path.join(os.path.dirname(output_file), "%s.nii" % EXTRA_OUTPUTS[name])
+            extras[name] = create_output(grid.shape, grid.affine, extra_file, dtype=fit_kwargs["dtype"])
+
+        def _progress(start, end):
+            nz = grid.shape[2]
+            self._progress_range = (float(start) / nz, float(end - start) / nz)
+
+        fit_slabs(t10_map, slab_size, fill, fa_sources, fas, tr, T10, extras, afi_sources=afi_sources,
+                  roi_source=None if roi_mask is None else ArraySource(roi_mask), threshold=threshold,
+                  fit_mask=fit_mask, fit=self._fit, progress=_progress, **fit_kwargs)
+
+        if any([value is not None for value in post_options.values()]):
+            with self._stage("postprocess"):
+                postprocess(T10, mask=fit_mask, slab_size=slab_size, **post_options)
+
+        with self._stage("output"):
+            if output_file is not None:
+                # Add the output files rather than the arrays so they are not loaded into memory until required
+                T10.flush()
+                del T10
+                self._add_output(load(output_file), name="T10", make_current=True)
+                for name in outputs:
+                    extras[name].flush()
+                    self._add_output(load(extras[name].filename), name=EXTRA_OUTPUTS[name])
+            else:
+                self._add_output(T10, grid=grid, name="T10", make_current=True)
+                for name in outputs:
+                    self._add_output(extras[name], grid=grid, name=EXTRA_OUTPUTS[name])
@@ -3,14 +3,17 @@
 //
 
 #include "T10_calculation.h"
-#include "linear_regression.h"
 
 
 // Required for M_PI etc on Windows
 #define _USE_MATH_DEFINES
 #include <cmath>
+#include <algorithm>
 #include <iostream>
-#include <complex>
+
+#ifdef _OPENMP
+    #include <omp.h>
+#endif
 
 // Even with above, sometimes M_PI is not there...
 #ifndef M_PI
@@ -19,170 +22,608 @@
 
 using namespace std;
 
-// Complex inverse cosine is part of C++11 so for Python 2.7 we need
-// to define it. See Wolfram for details. This uses the same branch cut
-// as the C++11 standard library function and has been tested for 
-// agreement
-const complex<double> I(0, 1);
-const complex<double> ONE(1, 0);
-const complex<double> PI2(M_PI / 2, 0);
-
-static complex<double> acos_impl(complex<double> z)
+// Number of threads to use for the voxel loop. Zero or negative means
+// use the OpenMP default (normally one per core)
+static int thread_count(int num_threads)
 {
-	return PI2 + I*log(I * z + sqrt(ONE - z*z));
+#ifdef _OPENMP
+    if (num_threads <= 0) {
+        return omp_get_max_threads();
+    }
+#endif
+    return num_threads > 0 ? num_threads : 1;
 }
 
-
-// TODO write a nonlinear version
 // TODO Smoothing
 
-// Perform VFA T1 mapping on a single voxel
-// Linear mapping may underestimate the T1 values
-double T10_single_linear(vector<double> &favox, vector<double> &fa_rad, ulong num_fa, double TR){
+// Number of voxels fitted together. Per-voxel quantities for a block are
+// held in fixed size arrays so no memory is allocated in the voxel loop
+static const ulong BLOCK_SIZE = 64;
 
-    vector<double> x(num_fa, 0);
-    vector<double> y(num_fa, 0);
-    double b, v1;
-    double t1;
+// Maximum number of Levenberg-Marquardt iterations for the nonlinear fit
+static const int NLLS_MAX_ITERATIONS = 100;
 
-    for (ulong ii=0; ii<num_fa; ii++){
-        x[ii] = favox[ii] / tan(fa_rad[ii]);
-        y[ii] = favox[ii] / sin(fa_rad[ii]);
-    }
+// Nonlinear fit stops when the relative reduction in the sum of squared
+// residuals falls below this
+static const double NLLS_TOLERANCE = 1e-10;
 
-    // Return intercept and gradient from linear regression.
-    pair<double, double> ab = linreg(y, x);
-    b = ab.second;
+// Limits on the Levenberg-Marquardt damping parameter
+static const double NLLS_LAMBDA_START = 1e-3;
+static const double NLLS_LAMBDA_MAX = 1e10;
 
-    // requiring gradient to be greater than 0
-    if (b > 0) {
-        v1 = log(b);
-        t1 = -TR/v1;
-    }
-    else {
-        t1 = 0;
-    }
+// T1 values (s) are clamped to the range [0, T1_MAX]
+static const double T1_MAX = 5.0;
 
+template <typename R>
+static R clamp_t1(R t1)
+{
     // TODO for testing purposes
-    if (t1 > 5.0){
-        t1 = 5.0;
+    if (t1 > T1_MAX){
+        t1 = T1_MAX;
     }
 
-    if (t1 < 0) {
+    // Also catches NaN
+    if (!(t1 >= 0)) {
         t1 = 0;
     }
-    // Optional: calculate M0 as well
     return t1;
 }
 
-// Return the afi map for the region
+// Working storage for fitting a block of voxels, allocated once per thread.
 //
-//  Arguments:
-//          afivols: nx2 Two vectors describing the two volumes
-//          fa_afi: Flip angle of AFI map in degrees
-// Ref 1: DOI 10.1002/mrm.21120
-vector <double> afimapping(vector<vector<double> > afivols, double fa_afi, vector<double> TR_afi){
+// Signals and flip angles are stored flip angle major (structure of arrays)
+// i.e. element [kk*BLOCK_SIZE + vv] is flip angle kk of voxel vv in the block.
+// This makes the loops over voxels contiguous so they can be vectorised, and
+// means each input volume is read sequentially when a block is loaded.
+template <typename R>
+struct BlockScratch {
+    vector<R> signal;
+    vector<R> sin_fa;
+    vector<R> tan_fa;
+    vector<R> fa_rad;
+
+    // Signal and flip angles of a single voxel for the nonlinear fit
+    vector<R> voxel;
+    vector<R> voxel_fa;
+
+    // Counts of voxels fitted by this thread
+    T10Counts counts;
+
+    BlockScratch(ulong num_fa) :
+        signal(num_fa*BLOCK_SIZE), sin_fa(num_fa*BLOCK_SIZE), tan_fa(num_fa*BLOCK_SIZE),
+        fa_rad(num_fa*BLOCK_SIZE), voxel(num_fa), voxel_fa(num_fa) {
+        counts.fitted = counts.clamped = counts.rejected = 0;
+        counts.scratch_bytes = (4*BLOCK_SIZE + 2) * num_fa * sizeof(R);
+    }
 
-    ulong num_voxels = afivols[0].size();
-    double TR1 = TR_afi.at(0);
-    double TR2 = TR_afi.at(1);
-    double n, r, alpha;
-    complex<double> alphac;
-    vector<double> K(num_voxels, 0);
+    // Add this thread's counts to the total, if required
+    void add_counts(const T10Outputs<R> *extra) {
+        if (extra && extra->counts) {
+            #pragma omp critical
+            {
+                extra->counts->fitted += counts.fitted;
+                extra->counts->clamped += counts.clamped;
+                extra->counts->rejected += counts.rejected;
+                extra->counts->scratch_bytes += counts.scratch_bytes;
+            }
+        }
+    }
+};
+
+// Linear regression of S/sin(a) against S/tan(a) for a block of n voxels.
+// Returns the intercept, M0 * (1 - E1), and the gradient, E1 = exp(-TR/T1)
+// of each voxel. For y = a + bx the gradient is b = Sxy/Sx, where Sx is the
+// sum of squared deviations of x from its mean and Sxy the sum of products
+// of the deviations of x and y, and the intercept is a = y_mean - b * x_mean.
+// The operations for each voxel are the same as for a single voxel
+// regression, so results do not depend on the blocking.
+template <typename R>
+static void linreg_block(const R *signal, const R *sin_fa, const R *tan_fa,
+                         ulong num_fa, ulong n, R *a, R *b){
+
+    R x_mean[BLOCK_SIZE], y_mean[BLOCK_SIZE], Sx[BLOCK_SIZE], Sxy[BLOCK_SIZE];
+
+    for (ulong vv=0; vv<n; vv++) {
+        x_mean[vv] = y_mean[vv] = Sx[vv] = Sxy[vv] = 0;
+    }
 
-    // Flip angle in radiation
-    double flip_angle = fa_afi * (M_PI/180);
+    // Calculate the means
+    for (ulong kk=0; kk<num_fa; kk++) {
+        const R *s = signal + kk*BLOCK_SIZE;
+        const R *sn = sin_fa + kk*BLOCK_SIZE;
+        const R *tn = tan_fa + kk*BLOCK_SIZE;
+        for (ulong vv=0; vv<n; vv++) {
+            x_mean[vv] += s[vv] / tn[vv];
+            y_mean[vv] += s[vv] / sn[vv];
+        }
+    }
+    for (ulong vv=0; vv<n; vv++) {
+        x_mean[vv] = x_mean[vv] / num_fa;
+        y_mean[vv] = y_mean[vv] / num_fa;
+    }
 
-    for (unsigned int ii=0; ii < num_voxels; ii++){
+    // Calculate the covariance and variance
+    for (ulong kk=0; kk<num_fa; kk++) {
+        const R *s = signal + kk*BLOCK_SIZE;
+        const R *sn = sin_fa + kk*BLOCK_SIZE;
+        const R *tn = tan_fa + kk*BLOCK_SIZE;
+        for (ulong vv=0; vv<n; vv++) {
+            R dx = s[vv] / tn[vv] - x_mean[vv];
+            R dy = s[vv] / sn[vv] - y_mean[vv];
+            Sx[vv] += dx * dx;
+            Sxy[vv] += dx * dy;
+        }
+    }
 
-//        cout << ii << endl;
+    // Calculating gradient and intercept
+    for (ulong vv=0; vv<n; vv++) {
+        b[vv] = Sxy[vv] / Sx[vv];
+        a[vv] = y_mean[vv] - b[vv] * x_mean[vv];
+    }
+}
 
-        // n = TR2/ TR1
-        n = TR2 / TR1;
+// Perform VFA T1 mapping on a single voxel from the linear regression
+// intercept a and gradient b. Linear mapping may underestimate the T1 values
+//
+// Returns the unclamped T1, and M0 calculated from the intercept
+template <typename R>
+static void T10_single_linear(R a, R b, R TR, R &m0, R &t1){
 
-        // r = Signal2/Signal1
-        r = afivols[1][ii] / afivols[0][ii];
+    // requiring gradient to be greater than 0
+    if (b > 0) {
+        t1 = -TR/log(b);
+    }
+    else {
+        t1 = 0;
+    }
 
-        // Eq 6 of Ref 1
-        complex<double> cmpl ((r*n - 1) / (n-r), 0);
-        alphac = acos_impl(cmpl);
-        alpha = alphac.real();
+    m0 = a / (1 - b);
+}
 
-        // Ration of actual flip angle and angle
-        // This correction is applied to the flip angles of the T10 calculation
-        K[ii] = alpha/flip_angle;
+// Sum of squared residuals of the SPGR signal equation
+//
+//     S = M0 sin(a) (1 - E1) / (1 - cos(a) E1),   E1 = exp(-TR/T1)
+//
+// If jtj and jtr are given, also calculate J^T J (upper triangle: M0/M0,
+// M0/T1, T1/T1) and J^T r using the analytic Jacobian with respect to M0 and T1
+template <typename R>
+static R spgr_cost(const R *favox, const R *fa_rad, ulong num_fa, R TR,
+                        R m0, R t1, R *jtj=NULL, R *jtr=NULL){
+
+    R e1 = exp(-TR/t1);
+    R de1_dt1 = e1 * TR / (t1 * t1);
+    R cost = 0;
+    if (jtj) {
+        jtj[0] = jtj[1] = jtj[2] = 0;
+        jtr[0] = jtr[1] = 0;
+    }
 
-//        cout << "k: " << K[ii] << endl;
+    for (ulong ii=0; ii<num_fa; ii++){
+        R sina = sin(fa_rad[ii]);
+        R cosa = cos(fa_rad[ii]);
+        R denom = 1 - cosa * e1;
+        R f = sina * (1 - e1) / denom;
+        R r = favox[ii] - m0 * f;
+        cost += r * r;
+
+        if (jtj) {
+            R dm0 = f;
+            R dt1 = m0 * sina * (cosa - 1) / (denom * denom) * de1_dt1;
+            jtj[0] += dm0 * dm0;
+            jtj[1] += dm0 * dt1;
+            jtj[2] += dt1 * dt1;
+            jtr[0] += dm0 * r;
+            jtr[1] += dt1 * r;
+        }
     }
+    return cost;
+}
 
-    return K;
+// Least squares M0 for a fixed T1
+template <typename R>
+static R spgr_m0(const R *favox, const R *fa_rad, ulong num_fa, R TR, R t1){
 
+    R e1 = exp(-TR/t1);
+    R sfx = 0, sff = 0;
+    for (ulong ii=0; ii<num_fa; ii++){
+        R f = sin(fa_rad[ii]) * (1 - e1) / (1 - cos(fa_rad[ii]) * e1);
+        sfx += f * favox[ii];
+        sff += f * f;
+    }
+    return sfx / sff;
 }
 
-// Run through an entire array to perform T10 mapping
-vector<double> T10mapping( vector< std::vector<double> > & favols, vector<double> & fa, double TR) {
+// Perform VFA T1 mapping on a single voxel by nonlinear least squares
+// fitting of the SPGR signal equation for M0 and T1 using Levenberg-Marquardt.
+// The fit is seeded from the linear regression intercept a and gradient b
+//
+// Returns the unclamped T1 and M0
+template <typename R>
+static void T10_single_nlls(const R *favox, const R *fa_rad, ulong num_fa, R TR,
+                            R a, R b, R &m0, R &t1){
+
+    if (a > 0 && b > 0 && b < 1 && -TR/log(b) <= T1_MAX) {
+        t1 = -TR/log(b);
+        m0 = a / (1 - b);
+    }
+    else {
+        // Linear estimate is unusable, start from a typical tissue T1
+        t1 = 1.0;
+        m0 = spgr_m0(favox, fa_rad, num_fa, TR, t1);
+    }
 
-    ulong num_fa = fa.size();
-    ulong num_voxels = favols[0].size();
+    R jtj[3], jtr[2];
+    R cost = spgr_cost(favox, fa_rad, num_fa, TR, m0, t1, jtj, jtr);
+    R lambda = NLLS_LAMBDA_START;
+    if (!(cost < HUGE_VAL)) {
+        // Also catches NaN
+        m0 = t1 = 0;
+        return;
+    }
 
-    vector<double> fa_rad (num_fa, 0);
-    vector<double> favox(num_fa, 0);
-    vector<double> t10vec(num_voxels, 0);
+    for (int it=0; it < NLLS_MAX_ITERATIONS && lambda < NLLS_LAMBDA_MAX; it++) {
 
-    // Convert flip angles to radians
-    int cc = 0;
-    for (vector<double>::iterator iter = fa.begin(); iter != fa.end(); iter++) {
-        fa_rad[cc] = (*iter * (M_PI/180));
-        cc++;
+        // Solve damped normal equations (J^T J + lambda diag(J^T J)) delta = J^T r
+        R a00 = jtj[0] * (1 + lambda);
+        R a11 = jtj[2] * (1 + lambda);
+        R a01 = jtj[1];
+        R det = a00 * a11 - a01 * a01;
+        if (!(det > 0)) {
+            lambda *= 10;
+            continue;
+        }
+        R m0_new = m0 + (a11 * jtr[0] - a01 * jtr[1]) / det;
+        R t1_new = t1 + (a00 * jtr[1] - a01 * jtr[0]) / det;
+
+        // T1 must stay positive
+        R cost_new = t1_new > 0 ? spgr_cost(favox, fa_rad, num_fa, TR, m0_new, t1_new) : cost;
+        if (cost_new < cost) {
+            bool converged = (cost - cost_new) <= NLLS_TOLERANCE * cost;
+            m0 = m0_new;
+            t1 = t1_new;
+            cost = spgr_cost(favox, fa_rad, num_fa, TR, m0, t1, jtj, jtr);
+            lambda /= 10;
+            if (converged) {
+                break;
+            }
+        }
+        else {
+            lambda *= 10;
+        }
     }
+}
+
+// Goodness of fit measures of the SPGR signal equation for fitted M0 and
+// T1, written to the additional outputs for voxel jj. The T1 standard error
+// is derived from the covariance matrix sigma^2 (J^T J)^-1. Voxels where the
+// fit failed have all outputs set to zero.
+template <typename R>
+static void T10_statistics(const R *favox, const R *fa_rad, ulong num_fa, R TR,
+                           R m0, R t1, const T10Outputs<R> *extra, ulong jj){
+
+    R m0_out = 0, r2 = 0, resvar = 0, t1_se = 0;
 
-    //cout << "t10 calculation for " << num_voxels << " voxels \n";
-    // Loop through all voxels
-    for (unsigned int jj=0; jj < num_voxels; jj++){
+    if (t1 > 0 && t1 < HUGE_VAL && m0 > -HUGE_VAL && m0 < HUGE_VAL) {
+        R jtj[3], jtr[2];
+        R ssres = spgr_cost(favox, fa_rad, num_fa, TR, m0, t1, jtj, jtr);
 
-        // Store value at each fa
-        for (unsigned int kk=0; kk < num_fa; kk++){
-            favox[kk] = favols.at(kk).at(jj);
+        R mean = 0, sstot = 0;
+        for (ulong ii=0; ii<num_fa; ii++) {
+            mean += favox[ii];
+        }
+        mean /= num_fa;
+        for (ulong ii=0; ii<num_fa; ii++) {
+            sstot += (favox[ii] - mean) * (favox[ii] - mean);
         }
 
-        // Calculating T10
-        t10vec[jj] = T10_single_linear(favox, fa_rad, num_fa, TR);
+        m0_out = m0;
+        if (sstot > 0) {
+            r2 = 1 - ssres / sstot;
+        }
+        if (num_fa > 2) {
+            resvar = ssres / (num_fa - 2);
+            R det = jtj[0] * jtj[2] - jtj[1] * jtj[1];
+            if (det > 0) {
+                t1_se = sqrt(resvar * jtj[0] / det);
+            }
+        }
     }
 
-    return t10vec;
+    if (extra->m0) extra->m0[jj] = m0_out;
+    if (extra->r2) extra->r2[jj] = r2;
+    if (extra->resvar) extra->resvar[jj] = resvar;
+    if (extra->t1_se) extra->t1_se[jj] = t1_se;
 }
 
+// Fit a block of n voxels starting at voxel start, whose signals and flip
+// angles have been loaded into the scratch buffers
+template <typename R>
+static void T10_block(BlockScratch<R> &scratch, ulong num_fa, ulong start, ulong n, R TR,
+                      R *t10, const T10Outputs<R> *extra, int method){
+
+    // B1 output is written separately
+    bool stats = extra && (extra->m0 || extra->r2 || extra->resvar || extra->t1_se);
+
+    scratch.counts.fitted += n;
+
+    R a[BLOCK_SIZE], b[BLOCK_SIZE];
+    linreg_block(&scratch.signal[0], &scratch.sin_fa[0], &scratch.tan_fa[0], num_fa, n, a, b);
+
+    for (ulong vv=0; vv<n; vv++) {
+        R m0, t1;
+        bool need_voxel = (method == T10_NLLS) || stats;
+        if (need_voxel) {
+            // Gather this voxel's signal and flip angles for the per-voxel calculations
+            for (ulong kk=0; kk<num_fa; kk++) {
+                scratch.voxel[kk] = scratch.signal[kk*BLOCK_SIZE + vv];
+                scratch.voxel_fa[kk] = scratch.fa_rad[kk*BLOCK_SIZE + vv];
+            }
+        }
 
+        if (method == T10_NLLS) {
+            T10_single_nlls(&scratch.voxel[0], &scratch.voxel_fa[0], num_fa, TR, a[vv], b[vv], m0, t1);
+        }
+        else {
+            T10_single_linear(a[vv], b[vv], TR, m0, t1);
+        }
 
-// Run through an entire array to perform T10 mapping with AFI calculation
-vector<double> T10mapping( dd favols, d fa, double TR, dd afivols, double fa_afi, d TR_afi) {
+        t10[start + vv] = clamp_t1(t1);
+        if (!(t1 > 0)) {
+            // Also catches NaN
+            scratch.counts.rejected++;
+        }
+        else if (t1 > T1_MAX) {
+            scratch.counts.clamped++;
+        }
+        if (stats) {
+            T10_statistics(&scratch.voxel[0], &scratch.voxel_fa[0], num_fa, TR, m0, t1, extra, start + vv);
+        }
+    }
+}
+
+// Load the signals of n voxels starting at voxel start into the scratch buffer
+template <typename T, typename R>
+static inline void load_block(BlockScratch<R> &scratch, const T * const *favols, const ptrdiff_t *fa_strides,
+                              ulong num_fa, ulong start, ulong n){
+    for (ulong kk=0; kk<num_fa; kk++) {
+        const T *vol = favols[kk];
+        ptrdiff_t stride = fa_strides[kk];
+        R *s = &scratch.signal[kk*BLOCK_SIZE];
+        for (ulong vv=0; vv<n; vv++) {
+            s[vv] = R(vol[(ptrdiff_t)(start + vv)*stride]);
+        }
+    }
+}
+
+// Set the flip angles (degrees) of a block of voxels, optionally scaled by the
+// ratio of actual to nominal flip angle for each voxel (k)
+template <typename R>
+static void set_block_fa(BlockScratch<R> &scratch, const double *fa, ulong num_fa, const R *k, ulong n){
+    for (ulong kk=0; kk<num_fa; kk++) {
+        R *fa_rad = &scratch.fa_rad[kk*BLOCK_SIZE];
+        R *sin_fa = &scratch.sin_fa[kk*BLOCK_SIZE];
+        R *tan_fa = &scratch.tan_fa[kk*BLOCK_SIZE];
+        for (ulong vv=0; vv<n; vv++) {
+            fa_rad[vv] = R(k ? (fa[kk] * k[vv] * (M_PI/180)) : (fa[kk] * (M_PI/180)));
+            sin_fa[vv] = sin(fa_rad[vv]);
+            tan_fa[vv] = tan(fa_rad[vv]);
+        }
+    }
+}
+
+// Ratio of actual to nominal flip angle from the AFI signals for a block
+// of n voxels starting at voxel start
+//
+//  Arguments:
+//          afivols: Pointers to the two AFI volumes
+//          afi_strides: Voxel stride of each AFI volume
+//          fa_afi: Flip angle of AFI map in degrees
+//          TR_afi: The two TRs of the AFI acquisition
+//          k: Output, space for n values
+// Ref 1: DOI 10.1002/mrm.21120
+template <typename T, typename R>
+static void afimapping(const T * const *afivols, const ptrdiff_t *afi_strides, ulong start, ulong n,
+                       double fa_afi, const double *TR_afi, R *k){
 
-    ulong num_fa = fa.size();
-    ulong num_voxels = favols[0].size();
+    // Flip angle in radiation
+    R flip_angle = R(fa_afi * (M_PI/180));
 
-    vector<double> fa_rad (num_fa, 0);
-    vector<double> favox(num_fa, 0);
-    vector<double> t10vec(num_voxels, 0);
+    // n = TR2/ TR1
+    R tr_ratio = R(TR_afi[1] / TR_afi[0]);
 
-    // AFI calculation
-    vector<double> k = afimapping(afivols, fa_afi, TR_afi);
+    const T *afi1 = afivols[0];
+    const T *afi2 = afivols[1];
+    ptrdiff_t stride1 = afi_strides[0];
+    ptrdiff_t stride2 = afi_strides[1];
 
-    //cout << "t10 calculation for " << num_voxels << " voxels \n";
-    // Loop through all voxels
-    for (unsigned int jj=0; jj < num_voxels; jj++){
+    for (ulong vv=0; vv<n; vv++){
+        ptrdiff_t ii = (ptrdiff_t)(start + vv);
 
-        for (unsigned int ii =0; ii < num_fa; ii++) {
-            fa_rad[ii] = (fa[ii] * k.at(jj) * (M_PI/180));
+        // r = Signal2/Signal1
+        R r = R(afi2[ii*stride2]) / R(afi1[ii*stride1]);
+
+        // Eq 6 of Ref 1. Outside [-1, 1] the real part of the complex inverse
+        // cosine is 0 or pi, so clamping gives the same angle. This includes a
+        // zero denominator (n == r). A zero or missing first AFI signal gives NaN,
+        // for which the ratio is set to zero so the voxel's fit fails and T1 is zero
+        R cos_alpha = (r*tr_ratio - 1) / (tr_ratio - r);
+        if (cos_alpha > 1) {
+            cos_alpha = 1;
+        }
+        else if (cos_alpha < -1) {
+            cos_alpha = -1;
         }
+        else if (cos_alpha != cos_alpha) {
+            k[vv] = 0;
+            continue;
+        }
+
+        // Ratio of actual flip angle and angle
+        // This correction is applied to the flip angles of the T10 calculation
+        k[vv] = acos(cos_alpha) / flip_angle;
+    }
+}
+
+// Number of blocks fitted between progress reports
+template <typename R>
+static ptrdiff_t chunk_blocks(const T10Outputs<R> *extra, ptrdiff_t num_blocks)
+{
+    if (!extra || !extra->progress || extra->progress->chunk_size == 0) {
+        return max(num_blocks, (ptrdiff_t)1);
+    }
+    return (ptrdiff_t) ((extra->progress->chunk_size + BLOCK_SIZE - 1) / BLOCK_SIZE);
+}
+
+// Report progress after fitting the first done voxels
+//
+// Returns non-zero if the remaining voxels should not be fitted
+template <typename R>
+static int report_progress(const T10Outputs<R> *extra, ulong done, ulong num_voxels)
+{
+    if (!extra || !extra->progress || !extra->progress->callback) {
+        return 0;
+    }
+    return extra->progress->callback(extra->progress->context, double(done) / num_voxels);
+}
 
-        // Store value at each fa
-        for (unsigned int kk=0; kk < num_fa; kk++){
-            favox[kk] = favols.at(kk).at(jj);
+// Run through an entire array to perform T10 mapping
+//
+// Voxels are independent so blocks of voxels are split between threads. Each
+// voxel is fitted identically regardless of the number of threads so
+// the output does not depend on it. If progress reporting is requested the
+// blocks are fitted in chunks, with all threads finishing a chunk before
+// progress is reported and the next chunk is started.
+template <typename T, typename R>
+void T10mapping(const T * const *favols, const ptrdiff_t *fa_strides, const double *fa, ulong num_fa,
+                ulong num_voxels, double TR, R *t10, const T10Outputs<R> *extra, int method, int num_threads) {
+
+    // Signed loop counter as required by OpenMP 2 (MSVC)
+    ptrdiff_t num_blocks = (ptrdiff_t) ((num_voxels + BLOCK_SIZE - 1) / BLOCK_SIZE);
+    ptrdiff_t chunk = chunk_blocks(extra, num_blocks);
+    int cancelled = 0;
+
+    #pragma omp parallel num_threads(thread_count(num_threads))
+    {
+        BlockScratch<R> scratch(num_fa);
+
+        // Flip angles are the same for every voxel
+        set_block_fa(scratch, fa, num_fa, (const R *) NULL, BLOCK_SIZE);
+
+        for (ptrdiff_t first=0; first < num_blocks && !cancelled; first += chunk) {
+            ptrdiff_t last = min(first + chunk, num_blocks);
+
+            #pragma omp for schedule(static)
+            for (ptrdiff_t bb=first; bb < last; bb++){
+                ulong start = bb * BLOCK_SIZE;
+                ulong n = min(BLOCK_SIZE, num_voxels - start);
+                load_block(scratch, favols, fa_strides, num_fa, start, n);
+                T10_block(scratch, num_fa, start, n, R(TR), t10, extra, method);
+                if (extra && extra->b1) {
+                    // No B1 correction
+                    fill(extra->b1 + start, extra->b1 + start + n, R(1));
+                }
+            }
+
+            #pragma omp single
+            cancelled = report_progress(extra, min((ulong) last * BLOCK_SIZE, num_voxels), num_voxels);
         }
+        scratch.add_counts(extra);
+    }
+}
 
-        // Calculating T10
-        t10vec[jj] = T10_single_linear(favox, fa_rad, num_fa, TR);
+// Run through an entire array to perform T10 mapping with AFI calculation
+template <typename T, typename R>
+void T10mapping(const T * const *favols, const ptrdiff_t *fa_strides, const double *fa, ulong num_fa,
+                ulong num_voxels, double TR,
+                const T * const *afivols, const ptrdiff_t *afi_strides, double fa_afi, const double *TR_afi,
+                R *t10, const T10Outputs<R> *extra, int method, int num_threads) {
+
+    ptrdiff_t num_blocks = (ptrdiff_t) ((num_voxels + BLOCK_SIZE - 1) / BLOCK_SIZE);
+    ptrdiff_t chunk = chunk_blocks(extra, num_blocks);
+    int cancelled = 0;
+
+    #pragma omp parallel num_threads(thread_count(num_threads))
+    {
+        BlockScratch<R> scratch(num_fa);
+
+        for (ptrdiff_t first=0; first < num_blocks && !cancelled; first += chunk) {
+            ptrdiff_t last = min(first + chunk, num_blocks);
+
+            #pragma omp for schedule(static)
+            for (ptrdiff_t bb=first; bb < last; bb++){
+                ulong start = bb * BLOCK_SIZE;
+                ulong n = min(BLOCK_SIZE, num_voxels - start);
+
+                // Flip angles corrected by the AFI flip angle ratio for each voxel. This is
+                // calculated a block at a time so the full B1 map is only stored if requested
+                R k_block[BLOCK_SIZE];
+                R *k = (extra && extra->b1) ? &extra->b1[start] : k_block;
+                afimapping(afivols, afi_strides, start, n, fa_afi, TR_afi, k);
+                set_block_fa(scratch, fa, num_fa, k, n);
+                load_block(scratch, favols, fa_strides, num_fa, start, n);
+                T10_block(scratch, num_fa, start, n, R(TR), t10, extra, method);
+            }
+
+            #pragma omp single
+            cancelled = report_progress(extra, min((ulong) last * BLOCK_SIZE, num_voxels), num_voxels);
+        }
+        scratch.add_counts(extra);
     }
+}
 
-    return t10vec;
+// Run through an entire array to perform T10 mapping with a precomputed flip
+// angle ratio map, e.g. from an earlier AFI calculation
+template <typename T, typename R>
+void T10mapping(const T * const *favols, const ptrdiff_t *fa_strides, const double *fa, ulong num_fa,
+                ulong num_voxels, double TR, const R *b1,
+                R *t10, const T10Outputs<R> *extra, int method, int num_threads) {
+
+    ptrdiff_t num_blocks = (ptrdiff_t) ((num_voxels + BLOCK_SIZE - 1) / BLOCK_SIZE);
+    ptrdiff_t chunk = chunk_blocks(extra, num_blocks);
+    int cancelled = 0;
+
+    #pragma omp parallel num_threads(thread_count(num_threads))
+    {
+        BlockScratch<R> scratch(num_fa);
+
+        for (ptrdiff_t first=0; first < num_blocks && !cancelled; first += chunk) {
+            ptrdiff_t last = min(first + chunk, num_blocks);
+
+            #pragma omp for schedule(static)
+            for (ptrdiff_t bb=first; bb < last; bb++){
+                ulong start = bb * BLOCK_SIZE;
+                ulong n = min(BLOCK_SIZE, num_voxels - start);
+                if (extra && extra->b1) {
+                    copy(b1 + start, b1 + start + n, extra->b1 + start);
+                }
+                set_block_fa(scratch, fa, num_fa, b1 + start, n);
+                load_block(scratch, favols, fa_strides, num_fa, start, n);
+                T10_block(scratch, num_fa, start, n, R(TR), t10, extra, method);
+            }
+
+            #pragma omp single
+            cancelled = report_progress(extra, min((ulong) last * BLOCK_SIZE, num_voxels), num_voxels);
+        }
+        scratch.add_counts(extra);
+    }
 }
+
+// Explicit instantiations for the voxel data types (T) and calculation
+// precisions (R) supported by the Python wrapper
+#define INSTANTIATE_T10MAPPING(T, R) \
+    template void T10mapping<T, R>(const T * const *, const ptrdiff_t *, const double *, ulong, \
+                                   ulong, double, R *, const T10Outputs<R> *, int, int); \
+    template void T10mapping<T, R>(const T * const *, const ptrdiff_t *, const double *, ulong, \
+                                   ulong, double, const T * const *, const ptrdiff_t *, double, const double *, \
+                                   R *, const T10Outputs<R> *, int, int); \
+    template void T10mapping<T, R>(const T * const *, const ptrdiff_t *, const double *, ulong, \
+                                   ulong, double, const R *, R *, const T10Outputs<R> *, int, int);
+
+INSTANTIATE_T10MAPPING(float, float)
+INSTANTIATE_T10MAPPING(double, float)
+INSTANTIATE_T10MAPPING(short, float)
+INSTANTIATE_T10MAPPING(unsigned short, float)
+INSTANTIATE_T10MAPPING(float, double)
+INSTANTIATE_T10MAPPING(double, double)
+INSTANTIATE_T10MAPPING(short, double)
+INSTANTIATE_T10MAPPING(unsigned short, double)
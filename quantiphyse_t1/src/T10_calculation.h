@@ -6,21 +6,93 @@
 #define INC_25_T10_CALCULATION_T10_CALCULATION_H
 
 #include <sys/types.h>
+#include <cstddef>
 #include <vector>
 
 typedef size_t ulong;
 
-typedef std::vector< std::vector<double> > & dd;
-typedef std::vector<double> & d;
-
+// Volumes are passed as raw pointers to their first voxel together with
+// the distance (in elements, not bytes) between consecutive voxels. This
+// lets the caller pass Numpy buffers of any supported type, including
+// non-contiguous views such as a single volume of a 4D array, without
+// copying them.
+//
+// The kernels are instantiated for float, double, short and unsigned short
+// input data (T). Calculations are done in the precision R, float or double,
+// and output is written to a caller-allocated buffer of num_voxels elements
+// of type R. Flip angles and TRs are always given as double.
+//
+// extra gives optional additional outputs, which are calculated in the
+// same pass as T1. It may be NULL if none are required.
 //
+// method selects the fitting method for each voxel - see T10Method.
 //
-// fa - flip angles (radians)
+// num_threads gives the number of threads used for the voxel loop when
+// built with OpenMP. Zero or negative means one thread per core.
+
+// Fitting methods
+//  - T10_LINEAR: Linear regression (DESPOT1). Fast but may underestimate T1
+//  - T10_NLLS: Nonlinear least squares fit of the SPGR signal equation
+enum T10Method {
+    T10_LINEAR = 0,
+    T10_NLLS = 1
+};
+
+// Counters describing a T10mapping call, summed over all threads. These
+// are added to, so should be zeroed before calling
+struct T10Counts {
+    ulong fitted;         // Voxels fitted
+    ulong clamped;        // Voxels whose T1 was clamped to the maximum
+    ulong rejected;       // Voxels whose fit failed (T1 zero, negative or NaN), set to zero
+    ulong scratch_bytes;  // Working memory allocated by the kernel over all threads
+};
+
+// Progress reporting and cancellation. Voxels are fitted in chunks of
+// chunk_size voxels (rounded up to whole blocks, zero means all voxels in one
+// chunk). After each chunk the callback is called from one thread with the
+// fraction of voxels done. If it returns non-zero the remaining chunks are
+// not fitted and their output is left unchanged
+typedef int (*T10ProgressCallback)(void *context, double fraction);
+
+struct T10Progress {
+    T10ProgressCallback callback;
+    void *context;
+    ulong chunk_size;
+};
+
+// Optional additional outputs. Any of these may be NULL if not required,
+// otherwise the maps must have space for num_voxels elements
+template <typename R>
+struct T10Outputs {
+    R *m0;      // M0 from the fitted signal equation
+    R *r2;      // Coefficient of determination (R^2) of the signal fit
+    R *resvar;  // Residual variance of the signal fit
+    R *t1_se;   // Standard error of T1
+    R *b1;      // Ratio of actual to nominal flip angle from AFI, 1 if no AFI data
+    T10Counts *counts;  // Counters for this call
+    const T10Progress *progress;  // Progress reporting, NULL if not required
+};
+
+// fa - flip angles (degrees)
 // Without AFI calculation
-std::vector<double> T10mapping( dd favols, d fa, double TR = 1.0);
+template <typename T, typename R>
+void T10mapping(const T * const *favols, const ptrdiff_t *fa_strides, const double *fa, ulong num_fa,
+                ulong num_voxels, double TR, R *t10, const T10Outputs<R> *extra = NULL,
+                int method = T10_LINEAR, int num_threads = 1);
 
 // With AFI calculation
-std::vector<double> T10mapping( dd favols, d fa, double TR, dd afivols, double fa_afi,  d TR_afi);
+template <typename T, typename R>
+void T10mapping(const T * const *favols, const ptrdiff_t *fa_strides, const double *fa, ulong num_fa,
+                ulong num_voxels, double TR,
+                const T * const *afivols, const ptrdiff_t *afi_strides, double fa_afi, const double *TR_afi,
+                R *t10, const T10Outputs<R> *extra = NULL,
+                int method = T10_LINEAR, int num_threads = 1);
 
+// With a precomputed ratio of actual to nominal flip angle for each voxel (b1)
+template <typename T, typename R>
+void T10mapping(const T * const *favols, const ptrdiff_t *fa_strides, const double *fa, ulong num_fa,
+                ulong num_voxels, double TR, const R *b1,
+                R *t10, const T10Outputs<R> *extra = NULL,
+                int method = T10_LINEAR, int num_threads = 1);
 
 #endif //INC_25_T10_CALCULATION_T10_CALCULATION_H
@@ -1,7 +1,6 @@
 #include <iostream>
 #include <tuple>
 
-#include "T10/linear_regression.h"
 #include "io_nifti.h"
 #include "T10/T10_calculation.h"
 #include "T10/plotting.h"
@@ -40,8 +39,13 @@ int main() {
     vector< vector<double> > fa_vols =  {fa3, fa6, fa9, fa15, fa24, fa35};
 
     // Perform T10 mapping
-    // vector<double> T10mapping( vector< vector<double> > & favols, vector<double> & fa);
-    t10vol = T10mapping(fa_vols, fa, TR);
+    vector<const double *> fa_ptrs;
+    vector<ptrdiff_t> fa_strides(fa_vols.size(), 1);
+    for (size_t ii=0; ii<fa_vols.size(); ii++) {
+        fa_ptrs.push_back(fa_vols[ii].data());
+    }
+    t10vol.resize(fa3.size());
+    T10mapping(fa_ptrs.data(), fa_strides.data(), fa.data(), fa.size(), fa3.size(), TR, t10vol.data());
 
     string out_path = data_folder + "T10.nii";
     save_nifti_1D_vector(out_path, t10vol, data_folder+v1);
@@ -0,0 +1,154 @@
+"""
+Quantiphyse - Slab-wise access to image data for streaming T1 mapping
+
+Large data sets are processed in slabs of consecutive z slices so that
+only one slab of each input needs to be in memory at a time. Inputs are
+read from memory-mapped NIFTI files and the output is written to a
+memory-mapped file.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import logging
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+from .engines import auto_mask, fit_masked
+
+LOG = logging.getLogger(__name__)
+
+# Offset of image data in a single-file NIFTI with no extensions
+NIFTI_DATA_OFFSET = 352
+
+class NiftiSource(object):
+    """
+    NIFTI file which is read a slab at a time without loading the whole file
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.nii = nib.load(fname, mmap=True)
+        if len(self.nii.shape) < 3:
+            raise ValueError("%s: Data must be 3D or 4D" % fname)
+        self.shape = tuple(self.nii.shape[:3])
+        self.affine = self.nii.header.get_best_affine()
+        self.nvols = self.nii.shape[3] if len(self.nii.shape) > 3 else 1
+
+    def slab(self, start, end):
+        """
+        :return: Array containing z slices ``start`` to ``end``. Only these slices
+                 are read from the file and the native data type is preserved
+                 unless the file specifies intensity scaling
+        """
+        arr = np.asanyarray(self.nii.dataobj[:, :, start:end])
+        if arr.ndim == 4 and arr.shape[3] == 1:
+            arr = np.squeeze(arr, axis=-1)
+        return arr
+
+class ArraySource(object):
+    """
+    In-memory array with the same interface as ``NiftiSource``
+    """
+
+    def __init__(self, arr):
+        self.arr = arr
+        self.shape = tuple(arr.shape[:3])
+        self.nvols = arr.shape[3] if arr.ndim > 3 else 1
+
+    def slab(self, start, end):
+        """
+        :return: View of z slices ``start`` to ``end``
+        """
+        return self.arr[:, :, start:end]
+
+def read_slab(sources, start, end):
+    """
+    Read a slab of each volume from a sequence of (source, volume index) pairs
+
+    Each source is only read once even if it contains multiple volumes
+    """
+    slabs, vols = {}, []
+    for source, idx in sources:
+        if id(source) not in slabs:
+            slabs[id(source)] = source.slab(start, end)
+        arr = slabs[id(source)]
+        vols.append(arr if idx is None else arr[..., idx])
+    return vols
+
+def slab_ranges(nz, slab_size):
+    """
+    :return: Sequence of (start, end) z slice ranges covering ``nz`` slices
+    """
+    slab_size = max(1, int(slab_size))
+    return [(start, min(start + slab_size, nz)) for start in range(0, nz, slab_size)]
+
+def fit_slabs(t10_map, slab_size, fill, fa_sources, fas, tr, out, extras=None, afi_sources=None,
+              roi_source=None, threshold=None, fit_mask=None, fit=fit_masked, progress=None, **kwargs):
+    """
+    Fit the inputs a slab of z slices at a time
+
+    :param fa_sources: Sequence of (source, volume index) pairs for the VFA volumes
+    :param out: Output T10 array, e.g. from ``create_output``
+    :param extras: Mapping from additional output name to output array
+    :param afi_sources: Sequence of (source, volume index) pairs for the AFI volumes.
+                        ``fa_afi`` and ``TR_afi`` must be given in ``kwargs``
+    :param roi_source: Source for an ROI. Only voxels in the ROI are fitted
+    :param threshold: Only fit voxels whose signal exceeds this value in any VFA volume
+    :param fit_mask: If given, the mask of fitted voxels is written to this array
+    :param fit: Function which fits each slab, with the same arguments as ``fit_masked``
+    :param progress: Function called with the start and end slices of each slab
+                     before it is read
+    :param kwargs: Additional keyword arguments for ``t10_map``
+    """
+    extras = extras or {}
+    nz = out.shape[2]
+    for start, end in slab_ranges(nz, slab_size):
+        LOG.info("Fitting slices %i-%i of %i", start, end-1, nz)
+        if progress is not None:
+            progress(start, end)
+        fa_vols = read_slab(fa_sources, start, end)
+        slab_kwargs = dict(kwargs)
+        slab_kwargs["extras"] = dict([(name, arr[:, :, start:end]) for name, arr in extras.items()])
+        if afi_sources is not None:
+            slab_kwargs["afi_vols"] = read_slab(afi_sources, start, end)
+        mask = None
+        if roi_source is not None:
+            mask = roi_source.slab(start, end) > 0
+        mask = auto_mask(threshold, fa_vols, mask)
+        if fit_mask is not None and mask is not None:
+            fit_mask[:, :, start:end] = mask
+        fit(t10_map, mask, fill, fa_vols, fas, tr, out=out[:, :, start:end], **slab_kwargs)
+
+def create_output(shape, affine, fname=None, dtype=np.float64):
+    """
+    Create a memory-mapped output array
+
+    :param shape: 3D shape of output
+    :param affine: Voxel to world transformation matrix
+    :param fname: If specified, an uncompressed NIFTI file which the array will be
+                  stored in. Otherwise an anonymous temporary file is used
+    :return: Fortran-ordered ``numpy.memmap``
+    """
+    if fname is None:
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode="w+", shape=tuple(shape), order="F")
+
+    if not fname.endswith(".nii"):
+        raise ValueError("Streamed output must be an uncompressed NIFTI file (.nii): %s" % fname)
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_data_offset(NIFTI_DATA_OFFSET)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(fname, "wb") as niftifile:
+        header.write_to(niftifile)
+        # Empty extension flag and space for the image data
+        niftifile.write(b"\0" * (NIFTI_DATA_OFFSET - niftifile.tell()))
+        niftifile.truncate(NIFTI_DATA_OFFSET + nbytes)
+
+    return np.memmap(fname, dtype=header.get_data_dtype(), mode="r+", offset=NIFTI_DATA_OFFSET,
+                     shape=tuple(shape), order="F")
@@ -7,49 +7,352 @@ Copyright (c) 2013-2018 University of Oxford
 import numpy as np
 cimport numpy as np
 
+from libc.stddef cimport ptrdiff_t
 from libcpp.vector cimport vector
 
 cdef extern from "T10_calculation.h":
-    vector[double] T10mapping (vector[vector[double]] & favols, vector[double] & fa, double TR)
-    vector[double] T10mapping (vector[vector[double]] & favols, vector[double] & fa, double TR,
-                               vector[vector[double]] & afi_vols, double fa, vector[double] & TR)
+    cdef enum T10Method:
+        T10_LINEAR
+        T10_NLLS
 
-def t10_map(fa_vols, fa, TR, afi_vols=None, fa_afi=None, TR_afi=None):
+    cdef struct T10Counts:
+        size_t fitted
+        size_t clamped
+        size_t rejected
+        size_t scratch_bytes
 
+    ctypedef int (*T10ProgressCallback)(void * context, double fraction)
+
+    cdef struct T10Progress:
+        T10ProgressCallback callback
+        void * context
+        size_t chunk_size
+
+    cdef cppclass T10Outputs[R]:
+        R * m0
+        R * r2
+        R * resvar
+        R * t1_se
+        R * b1
+        T10Counts * counts
+        const T10Progress * progress
+
+    void T10mapping[T, R](T ** favols, const ptrdiff_t * fa_strides, const double * fa, size_t num_fa,
+                          size_t num_voxels, double TR, R * t10, const T10Outputs[R] * extra,
+                          int method, int num_threads) except + nogil
+    void T10mapping[T, R](T ** favols, const ptrdiff_t * fa_strides, const double * fa, size_t num_fa,
+                          size_t num_voxels, double TR,
+                          T ** afivols, const ptrdiff_t * afi_strides, double fa_afi, const double * TR_afi,
+                          R * t10, const T10Outputs[R] * extra, int method, int num_threads) except + nogil
+    void T10mapping[T, R](T ** favols, const ptrdiff_t * fa_strides, const double * fa, size_t num_fa,
+                          size_t num_voxels, double TR, const R * b1,
+                          R * t10, const T10Outputs[R] * extra, int method, int num_threads) except + nogil
+
+# Voxel data types which can be passed to the C++ code without conversion.
+# These cover the types normally found in NIFTI files
+ctypedef fused voxel_t:
+    np.float32_t
+    np.float64_t
+    np.int16_t
+    np.uint16_t
+
+SUPPORTED_DTYPES = (np.float32, np.float64, np.int16, np.uint16)
+
+# Precisions the calculation can be done in
+ctypedef fused real_t:
+    np.float32_t
+    np.float64_t
+
+COMPUTE_DTYPES = (np.float32, np.float64)
+
+# Additional outputs which can be calculated alongside T1
+EXTRA_OUTPUTS = ("m0", "r2", "resvar", "t1_se", "b1")
+
+# Progress is reported this many times during a fit, unless the chunks of
+# voxels between reports would be smaller than PROGRESS_MIN_CHUNK
+PROGRESS_STEPS = 100
+PROGRESS_MIN_CHUNK = 4096
+
+# Fitting methods supported by the C++ code
+METHODS = {
+    "linear" : T10_LINEAR,
+    "nlls" : T10_NLLS,
+}
+
+def _common_dtype(vols, compute_dtype):
     """
-    Wrapper for the c++ T10 mapping function
+    :return: Numpy dtype that all volumes will be passed to the C++ code as.
+             If all volumes share a supported type they are passed without
+             conversion, otherwise they are converted to the calculation type
+    """
+    dtype = np.result_type(*vols)
+    for supported in SUPPORTED_DTYPES:
+        if dtype == supported:
+            return dtype
+    return compute_dtype
 
-    Args:
-        favols: List of volumes
-        fa: Corresponding flip angles of each volume
-        TR:
+def _flat_view(vol, dtype, order):
+    """
+    :return: 1D view of a volume with the given data type. No copy is
+             made unless the data type differs or the volume cannot be
+             flattened in the given order without copying
+    """
+    return np.reshape(np.asarray(vol).astype(dtype, copy=False), -1, order=order)
 
-    Returns:
+cdef _pointers(list vols, const voxel_t[:] first, vector[voxel_t *] & ptrs, vector[ptrdiff_t] & strides):
+    """
+    Get the raw data pointer and element stride of a list of flat volumes
+    """
+    cdef const voxel_t[:] vol
+    for v in vols:
+        vol = v
+        ptrs.push_back(<voxel_t *> &vol[0])
+        strides.push_back(vol.strides[0] // <ptrdiff_t> sizeof(voxel_t))
+
+cdef real_t * _ptr(real_t[:] like, arr):
+    """
+    :return: Pointer to the data of a flat output array with the same type as ``like``, or NULL if None
+    """
+    cdef real_t[:] view
+    if arr is None:
+        return NULL
+    view = arr
+    return &view[0]
+
+cdef const real_t * _const_ptr(real_t[:] like, arr):
+    """
+    :return: Pointer to the data of a flat, possibly read-only, input array with the
+             same type as ``like``, or NULL if None
+    """
+    cdef const real_t[:] view
+    if arr is None:
+        return NULL
+    view = arr
+    return &view[0]
 
+def _prepare_output(arr, shape, order, dtype):
     """
+    Allocate an output array if not given and get a flat view to pass to the C++ code
 
-    fa_vols2 = []
-    shp1 = fa_vols[0].shape
+    :return: Tuple of (output array, 1D array to write to)
+    """
+    if arr is None:
+        arr = np.empty(shape, dtype=dtype, order=order)
+    elif arr.shape != shape or arr.dtype != dtype:
+        raise ValueError("Output array must be %s with shape %s" % (np.dtype(dtype).name, str(shape)))
+    return arr, np.reshape(arr, -1, order=order)
 
-    for fa1 in fa_vols:
-        fa_vols2.append(np.ascontiguousarray(fa1.flatten()))
+def _finish_output(arr, flat, order):
+    """
+    Copy output into the output array if its layout did not match the input so
+    it could not be written directly
+    """
+    if not np.shares_memory(flat, arr):
+        arr[...] = np.reshape(flat, arr.shape, order=order)
 
-    if afi_vols is None:
-        T10array = T10mapping(fa_vols2, fa, TR)
+def _allocated_bytes(arrays, given):
+    """
+    :return: Total size of the arrays which are not views of the ``given`` arrays or each other
+    """
+    counted, nbytes = list(given), 0
+    for arr in arrays:
+        if not any([np.may_share_memory(arr, other) for other in counted]):
+            nbytes += arr.nbytes
+            counted.append(arr)
+    return nbytes
 
-    else:
-        afi_vols2 = []
+cdef int _progress_callback(void * context, double fraction) noexcept with gil:
+    """
+    Pass progress from the C++ code to the Python callback. An exception raised
+    by the callback cancels the fit and is stored so it can be re-raised
+    """
+    state = <list> context
+    try:
+        return 1 if state[0](fraction) else 0
+    except BaseException as exc:
+        state[1] = exc
+        return 1
 
-        for afi1 in afi_vols:
-            afi_vols2.append(np.ascontiguousarray(afi1.flatten()))
+def _t10_map(list fa_vols, const voxel_t[:] first, fa_list, double TR, afi_vols,
+             double fa_afi, TR_afi_list, b1, real_t[:] out, dict extras, int method, int threads,
+             dict counts, progress):
+    """
+    Call the C++ code, specialised for the data type of the volumes
+    """
+    cdef T10Progress kernel_progress
+    progress_state = [progress, None]
+    kernel_progress.callback = _progress_callback
+    kernel_progress.context = <void *> progress_state
+    kernel_progress.chunk_size = max(out.shape[0] // PROGRESS_STEPS, PROGRESS_MIN_CHUNK)
+    cdef T10Counts kernel_counts
+    kernel_counts.fitted = kernel_counts.clamped = kernel_counts.rejected = kernel_counts.scratch_bytes = 0
+    cdef T10Outputs[real_t] extra
+    extra.m0 = _ptr(out, extras.get("m0", None))
+    extra.r2 = _ptr(out, extras.get("r2", None))
+    extra.resvar = _ptr(out, extras.get("resvar", None))
+    extra.t1_se = _ptr(out, extras.get("t1_se", None))
+    extra.b1 = _ptr(out, extras.get("b1", None))
+    extra.counts = &kernel_counts if counts is not None else NULL
+    extra.progress = &kernel_progress if progress is not None else NULL
+    cdef T10Outputs[real_t] * extra_ptr = &extra
 
-        T10array = T10mapping(fa_vols2, fa, TR, afi_vols2, fa_afi, TR_afi)
+    cdef vector[double] fa = fa_list
+    cdef vector[double] TR_afi = TR_afi_list
+    cdef vector[voxel_t *] fa_ptrs, afi_ptrs
+    cdef vector[ptrdiff_t] fa_strides, afi_strides
+    _pointers(fa_vols, first, fa_ptrs, fa_strides)
+    if afi_vols is not None:
+        _pointers(afi_vols, first, afi_ptrs, afi_strides)
+    cdef const real_t * b1_ptr = _const_ptr(out, b1)
+    cdef real_t * out_ptr = &out[0]
+    cdef size_t num_voxels = out.shape[0]
 
-    T10vol = np.reshape(T10array, shp1)
+    # The kernel only uses the buffers collected above so other Python threads can
+    # run while it fits. The progress callback takes the GIL when it is called
+    with nogil:
+        if b1_ptr != NULL:
+            T10mapping(fa_ptrs.data(), fa_strides.data(), fa.data(), fa.size(),
+                       num_voxels, TR, b1_ptr, out_ptr, extra_ptr, method, threads)
+        elif afi_ptrs.empty():
+            T10mapping(fa_ptrs.data(), fa_strides.data(), fa.data(), fa.size(),
+                       num_voxels, TR, out_ptr, extra_ptr, method, threads)
+        else:
+            T10mapping(fa_ptrs.data(), fa_strides.data(), fa.data(), fa.size(),
+                       num_voxels, TR,
+                       afi_ptrs.data(), afi_strides.data(), fa_afi, TR_afi.data(),
+                       out_ptr, extra_ptr, method, threads)
 
-    return T10vol
+    if progress_state[1] is not None:
+        raise progress_state[1]
 
+    if counts is not None:
+        for name, value in (("fitted", kernel_counts.fitted), ("clamped", kernel_counts.clamped),
+                            ("rejected", kernel_counts.rejected), ("bytes_allocated", kernel_counts.scratch_bytes)):
+            counts[name] = counts.get(name, 0) + value
 
+def t10_map(fa_vols, fa, TR, afi_vols=None, fa_afi=None, TR_afi=None, out=None, threads=None, method="linear",
+            extras=None, b1=None, counts=None, progress=None, dtype="float64"):
+    """
+    Wrapper for the c++ T10 mapping function
 
+    Volumes are passed to the C++ code directly without copying provided they
+    have one of the supported data types (float32, float64, int16, uint16) and
+    share the same memory layout (e.g. individual volumes of a C or Fortran
+    ordered 4D array)
 
+    The GIL is released while the voxels are fitted, so calls from multiple
+    Python threads run concurrently
+
+    With ``dtype="float32"`` the fit is calculated in single precision and
+    the outputs are float32, which halves the memory used by the outputs and
+    working storage. On synthetic phantoms (T1 0.1-5s, TR 5ms, 5 flip angles)
+    T1 and M0 differ from the float64 calculation by less than 5e-4 relative
+    for the linear fit. For ``nlls`` they differ by less than 2e-4 relative
+    on noiseless data. With noisy data 99% of voxels agree within 5e-3, but
+    a few poorly conditioned voxels may converge to a different solution.
+    Fit statistics involve differences of similar values so are less accurate
+
+    Args:
+        fa_vols: List of volumes
+        fa: Corresponding flip angles of each volume
+        TR: Repetition time (s)
+        afi_vols: Optional list of the two AFI volumes for B1 correction
+        fa_afi: Flip angle of AFI acquisition
+        TR_afi: Sequence of the two TRs of the AFI acquisition (s)
+        out: Optional preallocated array of type ``dtype`` with the same shape
+             as the volumes which the T10 map will be written to. This is written
+             directly if it has the same memory layout as the volumes
+        threads: Number of threads to use. If not specified, use one
+                 thread per core. The output does not depend on the
+                 number of threads
+        method: Fitting method, ``linear`` for the linear (DESPOT1) fit or
+                ``nlls`` for a nonlinear least squares fit of the SPGR
+                signal equation, seeded from the linear fit
+        extras: Optional dictionary whose keys name additional outputs to
+                calculate in the same pass: ``m0``, ``r2`` (coefficient of
+                determination of the signal fit), ``resvar`` (residual
+                variance), ``t1_se`` (standard error of T1) and ``b1``
+                (ratio of actual to nominal flip angle from the AFI data, 1
+                if AFI correction is not used). Values may
+                be preallocated arrays of type ``dtype`` or None, and are
+                replaced with the output maps
+        b1: Optional precomputed map of the ratio of actual to nominal
+            flip angle, e.g. the ``b1`` output of an earlier run, used
+            instead of AFI volumes
+        counts: Optional dictionary which counts are added to: ``fitted``
+                (voxels fitted), ``clamped`` (voxels whose T1 was clamped
+                to the maximum), ``rejected`` (voxels where the fit failed
+                and T1 is zero) and ``bytes_allocated`` (memory allocated for
+                outputs, data type conversions and kernel working storage)
+        progress: Optional callable which is called with the fraction of voxels
+                  fitted after each chunk of voxels. If it returns True the
+                  remaining voxels are not fitted and the output is incomplete.
+                  Exceptions raised by it also stop the fit and are re-raised
+        dtype: Precision of the calculation and outputs, ``float64`` or ``float32``
+
+    Returns:
+        T10 map with the same shape as the input volumes
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown fitting method: %s" % method)
+    compute_dtype = np.dtype(dtype)
+    if compute_dtype not in COMPUTE_DTYPES:
+        raise ValueError("Unsupported calculation type: %s" % dtype)
+    if len(fa_vols) != len(fa):
+        raise ValueError("Number of flip angles (%i) does not match number of volumes (%i)" % (len(fa), len(fa_vols)))
+    if afi_vols is not None and (len(afi_vols) != 2 or len(TR_afi) != 2):
+        raise ValueError("AFI correction requires two volumes and two TRs")
+    if afi_vols is not None and b1 is not None:
+        raise ValueError("Cannot specify both AFI volumes and a B1 map")
+    for name in (extras or {}):
+        if name not in EXTRA_OUTPUTS:
+            raise ValueError("Unknown output: %s" % name)
+
+    fa_vols = [np.asarray(vol) for vol in fa_vols]
+    shape = fa_vols[0].shape
+    all_vols = list(fa_vols)
+    if afi_vols is not None:
+        afi_vols = [np.asarray(vol) for vol in afi_vols]
+        all_vols += afi_vols
+    if b1 is not None:
+        b1 = np.asarray(b1)
+    for vol in all_vols + ([b1] if b1 is not None else []):
+        if vol.shape != shape:
+            raise ValueError("Volumes do not all have the same shape: %s, %s" % (shape, vol.shape))
+
+    # Flatten in the native order of the data so slices of Fortran-ordered
+    # arrays (as loaded from NIFTI) do not need to be copied
+    order = "F" if fa_vols[0].flags.f_contiguous and not fa_vols[0].flags.c_contiguous else "C"
+    dtype = _common_dtype(all_vols, compute_dtype)
+
+    given = all_vols + [arr for arr in [b1, out] + list((extras or {}).values()) if arr is not None]
+    out, out_flat = _prepare_output(out, shape, order, compute_dtype)
+    extras_flat = {}
+    for name in list(extras or {}):
+        extras[name], extras_flat[name] = _prepare_output(extras[name], shape, order, compute_dtype)
+    if out.size == 0:
+        return out
+
+    fa_flat = [_flat_view(vol, dtype, order) for vol in fa_vols]
+    afi_flat = None
+    if afi_vols is not None:
+        afi_flat = [_flat_view(vol, dtype, order) for vol in afi_vols]
+        TR_afi = [float(t) for t in TR_afi]
+    else:
+        TR_afi, fa_afi = [], 0
+    if b1 is not None:
+        b1 = _flat_view(b1, compute_dtype, order)
 
+    if threads is None:
+        threads = 0
+    if counts is not None:
+        arrays = [out, out_flat] + list((extras or {}).values()) + list(extras_flat.values()) + fa_flat + (afi_flat or [])
+        if b1 is not None:
+            arrays.append(b1)
+        counts["bytes_allocated"] = counts.get("bytes_allocated", 0) + _allocated_bytes(arrays, given)
+    _t10_map(fa_flat, fa_flat[0], fa, TR, afi_flat, fa_afi, TR_afi, b1, out_flat, extras_flat, METHODS[method], threads,
+             counts, progress)
+    _finish_output(out, out_flat, order)
+    for name in extras_flat:
+        _finish_output(extras[name], extras_flat[name], order)
+    return out
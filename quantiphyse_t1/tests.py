@@ -1,8 +1,68 @@
 import unittest 
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
+import numpy as np
+import nibabel as nib
+
+from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+from quantiphyse.processes import Process
+from quantiphyse.utils import QpException
 from quantiphyse.test.widget_test import WidgetTest
 
+from PySide2 import QtCore, QtWidgets
+
 from .widgets import T10Widget
+from .process import T10Process, RESAMPLE_CACHE
+from . import fabber_process, process as process_module
+from . import numpy_model, dictionary_model
+from .b1_cache import B1Cache, B1_CACHE, b1_key
+from .cache import ArrayCache, data_key
+from .batch import run_batch
+from .cli import main as cli_main, run_t10
+from .engines import EXTRA_OUTPUTS, linear_estimates
+from .loading import read_header, load_files
+from .postprocess import postprocess, gaussian_smooth
+
+try:
+    from . import t1_model
+except ImportError:
+    t1_model = None
+
+def vfa_phantom(shape, fas, tr, b1=None, noise=0, seed=0):
+    """
+    Generate synthetic SPGR signal volumes with random T1 and M0
+
+    :return: Tuple of (list of VFA volumes, true T1 map, true M0 map)
+    """
+    rng = np.random.RandomState(seed)
+    t1 = rng.uniform(0.3, 3.0, shape)
+    m0 = rng.uniform(500, 2000, shape)
+    if b1 is None:
+        b1 = np.ones(shape)
+    e1 = np.exp(-tr / t1)
+    vols = []
+    for fa in fas:
+        alpha = np.radians(fa) * b1
+        vol = m0 * np.sin(alpha) * (1 - e1) / (1 - np.cos(alpha) * e1)
+        if noise:
+            vol += rng.normal(0, noise, shape)
+        vols.append(vol)
+    return vols, t1, m0
+
+def afi_phantom(b1, fa_afi, tr_afi, s0=1000.0):
+    """
+    Generate synthetic AFI signal volumes for a given B1 map
+    """
+    n = tr_afi[1] / tr_afi[0]
+    alpha = np.radians(fa_afi) * b1
+    s1 = np.full(b1.shape, s0)
+    return [s1, s1 * (1 + n * np.cos(alpha)) / (n + np.cos(alpha))]
 
 class T10WidgetTest(WidgetTest):
 
@@ -46,8 +106,998 @@ class T10WidgetTest(WidgetTest):
         self.assertFalse(self.w.clampMin.isEnabled())
         self.assertFalse(self.error)
 
+    def testMissingFile(self):
+        # A file removed after it was added to the list is reported by name
+        filename = os.path.join(tempfile.gettempdir(), "missing_fa5.nii")
+        self.w.fatable.table.insertRow(0)
+        self.w.fatable.table.setItem(0, 0, QtWidgets.QTableWidgetItem(filename))
+        self.w.fatable.table.setItem(0, 1, QtWidgets.QTableWidgetItem("5"))
+        with self.assertRaises(QpException) as context:
+            self.w.fatable.get_images()
+        self.assertTrue(filename in str(context.exception))
+
         # def testGenerateNoVolume(self):
    #     self.assertRaises(Exception, self.w.generate)
 
+@unittest.skipIf(t1_model is None, "Compiled T1 model not available")
+class T10EngineTest(unittest.TestCase):
+    """
+    Check the Numpy and C++ fitting engines agree
+    """
+    FAS = [2, 5, 10, 15, 20]
+    TR = 0.005
+
+    def testLinear(self):
+        vols, t1, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=5)
+        cpp = t1_model.t10_map(vols, self.FAS, self.TR)
+        npy = numpy_model.t10_map(vols, self.FAS, self.TR)
+        self.assertTrue(np.allclose(cpp, npy, rtol=0, atol=1e-9))
+
+    def testNoiseless(self):
+        vols, t1, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR)
+        npy = numpy_model.t10_map(vols, self.FAS, self.TR)
+        self.assertTrue(np.allclose(npy, t1))
+
+    def testAfi(self):
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (10, 11, 12))
+        vols, t1, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1)
+        afi_vols = afi_phantom(b1, 60, [0.02, 0.1])
+        cpp = t1_model.t10_map(vols, self.FAS, self.TR, afi_vols=afi_vols, fa_afi=60, TR_afi=[0.02, 0.1])
+        npy = numpy_model.t10_map(vols, self.FAS, self.TR, afi_vols=afi_vols, fa_afi=60, TR_afi=[0.02, 0.1])
+        self.assertTrue(np.allclose(cpp, npy, rtol=0, atol=1e-9))
+        self.assertTrue(np.allclose(npy, t1))
+
+    def testB1Output(self):
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (10, 11, 12))
+        vols, _, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1)
+        afi_vols = afi_phantom(b1, 60, [0.02, 0.1])
+        # Voxels with no AFI signal are not fitted
+        afi_vols[0][0, 0, :] = 0
+        afi_vols[1][0, 0, :2] = 0
+        cpp_extras, npy_extras = {"b1" : None}, {"b1" : None}
+        cpp = t1_model.t10_map(vols, self.FAS, self.TR, afi_vols=afi_vols, fa_afi=60, TR_afi=[0.02, 0.1],
+                               extras=cpp_extras)
+        npy = numpy_model.t10_map(vols, self.FAS, self.TR, afi_vols=afi_vols, fa_afi=60, TR_afi=[0.02, 0.1],
+                                  extras=npy_extras)
+        self.assertTrue(np.allclose(cpp_extras["b1"][1:], b1[1:]))
+        self.assertTrue(np.all(cpp_extras["b1"][0, 0] == 0))
+        self.assertTrue(np.all(cpp[0, 0] == 0))
+        self.assertTrue(np.allclose(cpp_extras["b1"], npy_extras["b1"], rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(cpp, npy, rtol=0, atol=1e-9))
+
+    def testB1Map(self):
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (10, 11, 12))
+        vols, _, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1, noise=5)
+        afi_vols = afi_phantom(b1, 60, [0.02, 0.1])
+        afi = t1_model.t10_map(vols, self.FAS, self.TR, afi_vols=afi_vols, fa_afi=60, TR_afi=[0.02, 0.1])
+        b1_map = numpy_model.afi_ratio(afi_vols, 60, [0.02, 0.1])
+        cpp = t1_model.t10_map(vols, self.FAS, self.TR, b1=b1_map)
+        npy = numpy_model.t10_map(vols, self.FAS, self.TR, b1=b1_map)
+        self.assertTrue(np.allclose(cpp, afi, rtol=0, atol=1e-9))
+        self.assertTrue(np.allclose(npy, afi, rtol=0, atol=1e-9))
+
+    def testNlls(self):
+        vols, t1, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR)
+        nlls = t1_model.t10_map(vols, self.FAS, self.TR, method="nlls")
+        self.assertTrue(np.allclose(nlls, t1))
+
+        # With noise the nonlinear fit should be more accurate than the linear fit
+        vols, t1, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=5)
+        linear = t1_model.t10_map(vols, self.FAS, self.TR)
+        nlls = t1_model.t10_map(vols, self.FAS, self.TR, method="nlls")
+        self.assertLess(np.mean(np.abs(nlls - t1)), np.mean(np.abs(linear - t1)))
+
+    def testExtraOutputs(self):
+        vols, t1, m0 = vfa_phantom((10, 11, 12), self.FAS, self.TR)
+        extras = dict([(name, None) for name in t1_model.EXTRA_OUTPUTS])
+        t1_model.t10_map(vols, self.FAS, self.TR, extras=extras)
+        self.assertTrue(np.allclose(extras["m0"], m0))
+        self.assertTrue(np.allclose(extras["r2"], 1))
+        self.assertTrue(np.allclose(extras["resvar"], 0))
+
+        vols, t1, m0 = vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=5)
+        cpp_extras = dict([(name, None) for name in t1_model.EXTRA_OUTPUTS])
+        npy_extras = dict([(name, None) for name in t1_model.EXTRA_OUTPUTS])
+        t1_model.t10_map(vols, self.FAS, self.TR, extras=cpp_extras)
+        numpy_model.t10_map(vols, self.FAS, self.TR, extras=npy_extras)
+        for name in t1_model.EXTRA_OUTPUTS:
+            self.assertTrue(np.allclose(cpp_extras[name], npy_extras[name], rtol=1e-6, atol=1e-9))
+
+    def testCounts(self):
+        vols, _, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=50)
+        cpp_counts, npy_counts = {}, {}
+        t1_model.t10_map(vols, self.FAS, self.TR, counts=cpp_counts)
+        npy = numpy_model.t10_map(vols, self.FAS, self.TR, counts=npy_counts)
+        self.assertEqual(cpp_counts["fitted"], npy.size)
+        self.assertEqual(cpp_counts["rejected"], np.count_nonzero(npy == 0))
+        self.assertEqual(cpp_counts["clamped"], np.count_nonzero(npy == numpy_model.T1_MAX))
+        for name in ("fitted", "clamped", "rejected"):
+            self.assertEqual(cpp_counts[name], npy_counts[name])
+        self.assertTrue(cpp_counts["bytes_allocated"] >= npy.nbytes)
+
+    def testProgress(self):
+        vols, _, _ = vfa_phantom((50, 50, 50), self.FAS, self.TR)
+        for engine in (t1_model, numpy_model):
+            fractions = []
+            engine.t10_map(vols, self.FAS, self.TR, progress=lambda frac: fractions.append(frac))
+            self.assertGreater(len(fractions), 1)
+            self.assertEqual(fractions, sorted(fractions))
+            self.assertEqual(fractions[-1], 1)
+
+            # Returning True cancels the remaining voxels
+            counts = {}
+            engine.t10_map(vols, self.FAS, self.TR, counts=counts, progress=lambda frac: True)
+            self.assertLess(counts["fitted"], vols[0].size)
+
+        def _fail(frac):
+            raise RuntimeError("Cancelled")
+        self.assertRaises(RuntimeError, t1_model.t10_map, vols, self.FAS, self.TR, progress=_fail)
+
+    def testReference(self):
+        # Output of the kernel before voxels were fitted in blocks, for 8 voxels
+        # with T1 0.25-4.5s and M0 1000, signals rounded to 0.1
+        signals = [[33.9, 32.9, 31.8, 30.5, 29.2, 28.1, 25.6, 22.5],
+                   [73.3, 63.2, 54.2, 45.6, 39.3, 34.6, 26.6, 19.7],
+                   [99.1, 69.1, 50.7, 37.4, 29.7, 24.6, 17.2, 11.8],
+                   [96.3, 59.0, 40.2, 28.3, 21.8, 17.7, 12.1, 8.2],
+                   [85.8, 48.9, 32.2, 22.1, 16.9, 13.6, 9.2, 6.2]]
+        t1 = [0.2501812340351669, 0.4993255399545071, 0.8000122006324707, 1.2028246848630102,
+              1.5955262575843292, 2.0054418384399617, 3.003460122561654, 4.480805437115801]
+        m0 = [1000.173347346243, 999.4539769265866, 999.5526796663937, 1001.5338089050233,
+              998.6107212380379, 1001.9747093363649, 1001.9191886958813, 996.2729471173122]
+        vols = [np.array(signal) for signal in signals]
+        extras = {"m0" : None}
+        self.assertTrue(np.allclose(t1_model.t10_map(vols, self.FAS, self.TR, extras=extras), t1, rtol=1e-14, atol=0))
+        self.assertTrue(np.allclose(extras["m0"], m0, rtol=1e-14, atol=0))
+
+        # Results do not depend on where voxels fall in the blocks
+        vols, _, _ = vfa_phantom((130,), self.FAS, self.TR, noise=5)
+        for method in ("linear", "nlls"):
+            whole = t1_model.t10_map(vols, self.FAS, self.TR, method=method)
+            for start, end in ((0, 1), (1, 64), (0, 64), (3, 68), (63, 130)):
+                part = t1_model.t10_map([vol[start:end] for vol in vols], self.FAS, self.TR, method=method)
+                self.assertTrue(np.array_equal(part, whole[start:end]))
+
+    def testThreads(self):
+        # The output does not depend on the number of threads
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (10, 11, 12))
+        vols, _, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1, noise=5)
+        afi = {"afi_vols" : afi_phantom(b1, 60, [0.02, 0.1]), "fa_afi" : 60, "TR_afi" : [0.02, 0.1]}
+        for method in ("linear", "nlls"):
+            for kwargs in ({}, afi):
+                extras = {"m0" : None, "t1_se" : None}
+                serial = t1_model.t10_map(vols, self.FAS, self.TR, method=method, threads=1, extras=extras, **kwargs)
+                for threads in (2, 3, 8):
+                    threaded_extras = {"m0" : None, "t1_se" : None}
+                    threaded = t1_model.t10_map(vols, self.FAS, self.TR, method=method, threads=threads,
+                                                extras=threaded_extras, **kwargs)
+                    self.assertTrue(np.array_equal(serial, threaded))
+                    for name in extras:
+                        self.assertTrue(np.array_equal(extras[name], threaded_extras[name]))
+
+    def testConcurrent(self):
+        # The GIL is released during the fit so calls from multiple threads run concurrently
+        from multiprocessing.pool import ThreadPool
+        phantoms = [vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=5, seed=seed)[0] for seed in range(4)]
+        serial = [t1_model.t10_map(vols, self.FAS, self.TR, threads=1) for vols in phantoms]
+        pool = ThreadPool(4)
+        try:
+            concurrent = pool.map(lambda vols: t1_model.t10_map(vols, self.FAS, self.TR, threads=1), phantoms)
+        finally:
+            pool.terminate()
+        for t10_serial, t10_concurrent in zip(serial, concurrent):
+            self.assertTrue(np.array_equal(t10_serial, t10_concurrent))
+
+    def testFloat32(self):
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (10, 11, 12))
+        vols, t1, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1)
+        afi = {"afi_vols" : afi_phantom(b1, 60, [0.02, 0.1]), "fa_afi" : 60, "TR_afi" : [0.02, 0.1]}
+        for engine, method, kwargs in ((t1_model, "linear", {}), (t1_model, "linear", afi), (t1_model, "nlls", afi),
+                                       (numpy_model, "linear", afi)):
+            extras64, extras32 = {"m0" : None}, {"m0" : None}
+            t10_64 = engine.t10_map(vols, self.FAS, self.TR, method=method, extras=extras64, **kwargs)
+            t10_32 = engine.t10_map(vols, self.FAS, self.TR, method=method, extras=extras32, dtype="float32", **kwargs)
+            self.assertEqual(t10_32.dtype, np.float32)
+            self.assertEqual(extras32["m0"].dtype, np.float32)
+            # Documented accuracy relative to the float64 calculation
+            self.assertLess(np.max(np.abs(t10_32 - t10_64) / t10_64), 5e-4)
+            self.assertLess(np.max(np.abs(extras32["m0"] - extras64["m0"]) / extras64["m0"]), 5e-4)
+
+        vols, t1, _ = vfa_phantom(b1.shape, self.FAS, self.TR, noise=5)
+        int_vols = [np.round(vol).astype(np.int16) for vol in vols]
+        t10_64 = t1_model.t10_map(int_vols, self.FAS, self.TR)
+        t10_32 = t1_model.t10_map(int_vols, self.FAS, self.TR, dtype="float32")
+        fitted = (t10_64 > 0) & (t10_64 < numpy_model.T1_MAX)
+        self.assertLess(np.max(np.abs(t10_32 - t10_64)[fitted] / t10_64[fitted]), 5e-4)
+
+    def testLinearEstimates(self):
+        vols, t1, m0 = vfa_phantom((10, 11, 12), self.FAS, self.TR)
+        vols[0][0, 0, 0] = -vols[0][0, 0, 0]
+        t1_est, m0_est = linear_estimates(vols, self.FAS, self.TR)
+        self.assertTrue(np.all(t1_est > 0) and np.all(m0_est > 0))
+        self.assertTrue(np.allclose(t1_est[1:], t1[1:]))
+        self.assertTrue(np.allclose(m0_est[1:], m0[1:]))
+
+    def testIntegerData(self):
+        vols, _, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR)
+        vols = [vol.astype(np.int16) for vol in vols]
+        cpp = t1_model.t10_map(vols, self.FAS, self.TR)
+        npy = numpy_model.t10_map(vols, self.FAS, self.TR)
+        self.assertTrue(np.allclose(cpp, npy, rtol=0, atol=1e-9))
+
+    def testInputTypes(self):
+        # Supported types are fitted without conversion, with the same result as float64 input
+        vols, _, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=5)
+        vols = [np.clip(np.round(vol), 0, None) for vol in vols]
+        counts = {}
+        reference = t1_model.t10_map(vols, self.FAS, self.TR, out=np.empty(vols[0].shape), counts=counts)
+        # Only the kernel's working storage is allocated
+        scratch = counts["bytes_allocated"]
+        for dtype in (np.float32, np.int16, np.uint16):
+            counts = {}
+            t10 = t1_model.t10_map([vol.astype(dtype) for vol in vols], self.FAS, self.TR, counts=counts,
+                                   out=np.empty(reference.shape))
+            self.assertTrue(np.array_equal(t10, reference))
+            self.assertEqual(counts["bytes_allocated"], scratch)
+
+    def testVolumeSlices(self):
+        # Volumes of C and Fortran ordered 4D arrays are fitted in place
+        vols, _, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=5)
+        counts = {}
+        reference = t1_model.t10_map(vols, self.FAS, self.TR, out=np.empty(vols[0].shape), counts=counts)
+        scratch = counts["bytes_allocated"]
+        for order in ("C", "F"):
+            data = np.array(np.stack(vols, axis=-1), order=order)
+            counts = {}
+            out = np.empty(reference.shape, order=order)
+            t10 = t1_model.t10_map([data[..., idx] for idx in range(len(self.FAS))], self.FAS, self.TR,
+                                   out=out, counts=counts)
+            self.assertTrue(t10 is out)
+            self.assertTrue(np.array_equal(t10, reference))
+            self.assertEqual(counts["bytes_allocated"], scratch)
+
+        # An output with a different layout is still filled in
+        data = np.asfortranarray(np.stack(vols, axis=-1))
+        out = np.empty(reference.shape, order="C")
+        t10 = t1_model.t10_map([data[..., idx] for idx in range(len(self.FAS))], self.FAS, self.TR, out=out)
+        self.assertTrue(t10 is out)
+        self.assertTrue(np.array_equal(out, reference))
+
+class DictionaryEngineTest(unittest.TestCase):
+    """
+    Check dictionary matching against the phantom T1 and the other engines
+    """
+    FAS = [2, 5, 10, 15, 20]
+    TR = 0.005
+
+    def testNoiseless(self):
+        vols, t1, m0 = vfa_phantom((10, 11, 12), self.FAS, self.TR)
+        extras = {"m0" : None}
+        matched = dictionary_model.t10_map(vols, self.FAS, self.TR, extras=extras)
+        self.assertTrue(np.allclose(matched, t1, rtol=1e-3, atol=0))
+        self.assertTrue(np.allclose(extras["m0"], m0, rtol=1e-3, atol=0))
+
+    def testAfi(self):
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (10, 11, 12))
+        vols, t1, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1)
+        afi_vols = afi_phantom(b1, 60, [0.02, 0.1])
+        afi = dictionary_model.t10_map(vols, self.FAS, self.TR, afi_vols=afi_vols, fa_afi=60, TR_afi=[0.02, 0.1])
+        b1_map = dictionary_model.t10_map(vols, self.FAS, self.TR, b1=numpy_model.afi_ratio(afi_vols, 60, [0.02, 0.1]))
+        self.assertTrue(np.allclose(afi, t1, rtol=1e-3, atol=0))
+        self.assertTrue(np.allclose(afi, b1_map))
+
+    def testAfiRejected(self):
+        # Voxels with zero AFI signal have no flip angle ratio so are rejected like the other engines
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (4, 5, 6))
+        vols, t1, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1)
+        afi_vols = [np.array(vol) for vol in afi_phantom(b1, 60, [0.02, 0.1])]
+        for vol in afi_vols:
+            vol[0, 0, 0] = 0
+        b1_map = numpy_model.afi_ratio(afi_vols, 60, [0.02, 0.1])
+        b1_map[0, 0, 1] = np.nan
+        for kwargs in ({"afi_vols" : afi_vols, "fa_afi" : 60, "TR_afi" : [0.02, 0.1]}, {"b1" : b1_map}):
+            extras, counts = {"m0" : None, "r2" : None, "t1_se" : None}, {}
+            t10 = dictionary_model.t10_map(vols, self.FAS, self.TR, extras=extras, counts=counts, **kwargs)
+            rejected = np.zeros(b1.shape, dtype=bool)
+            rejected[0, 0, :1 if "afi_vols" in kwargs else 2] = True
+            self.assertTrue(np.all(t10[rejected] == 0))
+            self.assertTrue(np.allclose(t10[~rejected], t1[~rejected], rtol=1e-3, atol=0))
+            self.assertEqual(counts["rejected"], np.count_nonzero(rejected))
+            self.assertEqual(counts["clamped"], 0)
+            for name, arr in extras.items():
+                self.assertTrue(np.all(np.isfinite(arr)))
+                self.assertTrue(np.all(arr[rejected] == 0))
+
+    def testNoise(self):
+        # Should be as accurate as the nonlinear fit, and more accurate than the linear fit
+        vols, t1, _ = vfa_phantom((10, 11, 12), self.FAS, self.TR, noise=5)
+        linear = numpy_model.t10_map(vols, self.FAS, self.TR)
+        matched = dictionary_model.t10_map(vols, self.FAS, self.TR)
+        self.assertLess(np.mean(np.abs(matched - t1)), np.mean(np.abs(linear - t1)))
+        if t1_model is not None:
+            nlls = t1_model.t10_map(vols, self.FAS, self.TR, method="nlls")
+            self.assertTrue(np.allclose(np.mean(np.abs(matched - t1)), np.mean(np.abs(nlls - t1)), rtol=0.01))
+
+    def testCache(self):
+        first = dictionary_model.signal_dictionary(self.FAS, self.TR, b1_grid=(0.5, 1.5, 11))
+        self.assertEqual(first.shape, (11, dictionary_model.DEFAULT_T1_GRID[2], len(self.FAS)))
+        self.assertTrue(np.allclose(np.sum(np.square(first), axis=2), 1))
+        self.assertTrue(dictionary_model.signal_dictionary(self.FAS, self.TR, b1_grid=(0.5, 1.5, 11)) is first)
+        self.assertFalse(dictionary_model.signal_dictionary(self.FAS, self.TR * 2, b1_grid=(0.5, 1.5, 11)) is first)
+
+class T10ProcessTest(unittest.TestCase):
+    """
+    Check the T10 process reuses the previous fit when only post-processing changes
+    """
+    FAS = [2, 5, 10, 15]
+    TR = 0.005
+
+    def setUp(self):
+        self.ivm = ImageVolumeManagement()
+        self.grid = DataGrid((8, 9, 10), np.identity(4))
+        vols, self.t1, _ = vfa_phantom(self.grid.shape, self.FAS, self.TR)
+        for fa, vol in zip(self.FAS, vols):
+            self.ivm.add(NumpyData(vol, grid=self.grid, name="fa%i" % fa))
+
+    def _run(self, process, **kwargs):
+        options = {"tr" : self.TR*1000, "vfa" : dict([("fa%i" % fa, fa) for fa in self.FAS]), "engine" : "numpy"}
+        options.update(kwargs)
+        process.run(options)
+        return self.ivm.data["T10"].raw()
+
+    def testReuseFit(self):
+        process = T10Process(self.ivm)
+        t10 = self._run(process, clamp={"min" : 0, "max" : 2})
+        self.assertFalse(process.stats["reused"])
+        self.assertTrue(np.allclose(t10, np.clip(self.t1, 0, 2)))
+
+        t10 = self._run(process, clamp={"min" : 0, "max" : 1}, threads=2)
+        self.assertTrue(process.stats["reused"])
+        self.assertTrue(np.allclose(t10, np.clip(self.t1, 0, 1)))
+        t10 = self._run(process)
+        self.assertTrue(process.stats["reused"])
+        self.assertTrue(np.allclose(t10, self.t1))
+
+        # Changes to the fit options or input data require a new fit
+        self._run(process, outputs=["m0"])
+        self.assertFalse(process.stats["reused"])
+        self.ivm.add(NumpyData(self.ivm.data["fa2"].raw() * 2, grid=self.grid, name="fa2"))
+        self._run(process, outputs=["m0"])
+        self.assertFalse(process.stats["reused"])
+        self._run(process, outputs=["m0"], **{"reuse-fit" : False})
+        self.assertFalse(process.stats["reused"])
+
+    def testReuseModifiedOutput(self):
+        # Changes to the output data must not affect the fit kept for reuse. The arrays
+        # passed to the ivm are modified, as the ivm may not copy them
+        process = T10Process(self.ivm)
+        added = {}
+        add_output = process._add_output
+        def _add_output(data, **kwargs):
+            added[kwargs["name"]] = data
+            add_output(data, **kwargs)
+        process._add_output = _add_output
+        for dtype in ("float32", "float64"):
+            self._run(process, dtype=dtype, outputs=["m0"])
+            fitted, m0 = added["T10"].copy(), added["M0"].copy()
+            added["T10"][...] = -1
+            added["M0"][...] = -1
+            self._run(process, dtype=dtype, outputs=["m0"], clamp={"min" : 0, "max" : 2})
+            self.assertTrue(process.stats["reused"])
+            self.assertTrue(np.array_equal(added["T10"], np.clip(fitted, 0, 2)))
+            self.assertTrue(np.array_equal(added["M0"], m0))
+
+    def testPostprocess(self):
+        roi = np.zeros(self.grid.shape, dtype=np.int32)
+        roi[2:6, 2:7, 1:9] = 1
+        self.ivm.add(NumpyData(roi, grid=self.grid, name="roi", roi=True))
+        post = {"smooth" : {"sigma" : 1.0, "masked" : True}, "clamp" : {"min" : 0.5, "max" : 2.5}}
+        in_memory = self._run(T10Process(self.ivm), roi="roi", **post)
+        slabs = self._run(T10Process(self.ivm), roi="roi", slab=3, **post)
+        self.assertTrue(np.allclose(in_memory, slabs))
+        # Background is not smoothed but is clamped
+        self.assertTrue(np.all(in_memory[roi == 0] == 0.5))
+        self.assertTrue(np.all(in_memory <= 2.5))
+
+    def testMask(self):
+        roi = np.zeros(self.grid.shape, dtype=np.int32)
+        roi[1:7, 2:8, 3:9] = 1
+        self.ivm.add(NumpyData(roi, grid=self.grid, name="roi", roi=True))
+        # Background voxels with no signal in any volume
+        background = np.zeros(self.grid.shape, dtype=bool)
+        background[:4, :, 5:] = True
+        for fa in self.FAS:
+            vol = self.ivm.data["fa%i" % fa].raw().copy()
+            vol[background] = 0
+            self.ivm.add(NumpyData(vol, grid=self.grid, name="fa%i" % fa))
+
+        for slab in (None, 3):
+            for options, fitted in (({"roi" : "roi"}, roi > 0),
+                                    ({"auto-mask" : 1}, ~background),
+                                    ({"roi" : "roi", "auto-mask" : 1}, (roi > 0) & ~background)):
+                options = dict(options, fill=-1, slab=slab, outputs=["m0"])
+                t10 = self._run(T10Process(self.ivm), **options)
+                signal = fitted & ~background
+                self.assertTrue(np.allclose(t10[signal], self.t1[signal]))
+                # Fitted voxels with no signal fail
+                self.assertTrue(np.all(t10[fitted & background] == 0))
+                self.assertTrue(np.all(t10[~fitted] == -1))
+                # Additional outputs are zero outside the mask
+                self.assertTrue(np.all(self.ivm.data["M0"].raw()[~fitted] == 0))
+
+    def _add_afi(self):
+        """
+        Replace the VFA data with noisy data with B1 inhomogeneity and add AFI data
+
+        :return: AFI options
+        """
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, self.grid.shape)
+        vols, _, _ = vfa_phantom(self.grid.shape, self.FAS, self.TR, b1=b1, noise=5)
+        for fa, vol in zip(self.FAS, vols):
+            self.ivm.add(NumpyData(vol, grid=self.grid, name="fa%i" % fa))
+        self.ivm.add(NumpyData(np.stack(afi_phantom(b1, 60, [0.02, 0.1]), axis=-1), grid=self.grid, name="afi"))
+        return {"afi" : {"afi" : [20, 100]}, "fa-afi" : 60}
+
+    def testSlabs(self):
+        outputs = ["m0", "r2", "b1"]
+        afi = dict(self._add_afi(), outputs=outputs)
+        in_memory = self._run(T10Process(self.ivm), **afi)
+        in_memory_extras = dict([(name, self.ivm.data[EXTRA_OUTPUTS[name]].raw().copy()) for name in outputs])
+        slabs = self._run(T10Process(self.ivm), slab=3, **afi)
+        self.assertTrue(np.array_equal(in_memory, slabs))
+        for name in outputs:
+            self.assertTrue(np.array_equal(in_memory_extras[name], self.ivm.data[EXTRA_OUTPUTS[name]].raw()))
+
+    def testB1Cache(self):
+        afi = dict(self._add_afi(), engine="cpp")
+        try:
+            B1_CACHE.clear()
+            start = (B1_CACHE.hits, B1_CACHE.misses)
+            uncached = self._run(T10Process(self.ivm), **dict(afi, **{"b1-cache" : False}))
+            self.assertEqual((B1_CACHE.hits, B1_CACHE.misses), start)
+
+            # On by default, keyed by the AFI data set so the second run finds the map
+            cached = self._run(T10Process(self.ivm), **afi)
+            self.assertEqual((B1_CACHE.hits, B1_CACHE.misses), (start[0], start[1] + 1))
+            self.assertTrue(np.allclose(cached, uncached, rtol=0, atol=1e-9))
+            self._run(T10Process(self.ivm), **afi)
+            self.assertEqual((B1_CACHE.hits, B1_CACHE.misses), (start[0] + 1, start[1] + 1))
+
+            # Replacing the AFI data set means the map is recalculated
+            self.ivm.add(NumpyData(self.ivm.data["afi"].raw() * 1.1, grid=self.grid, name="afi"))
+            self._run(T10Process(self.ivm), **afi)
+            self.assertEqual((B1_CACHE.hits, B1_CACHE.misses), (start[0] + 1, start[1] + 2))
+
+            # Slab maps are never cached
+            self._run(T10Process(self.ivm), slab=3, **afi)
+            self.assertEqual((B1_CACHE.hits, B1_CACHE.misses), (start[0] + 1, start[1] + 2))
+        finally:
+            B1_CACHE.clear()
+
+    def testResampleCache(self):
+        RESAMPLE_CACHE.clear()
+        try:
+            # Inputs already on the output grid are used directly
+            roi = np.ones(self.grid.shape, dtype=np.int32)
+            self.ivm.add(NumpyData(roi, grid=self.grid, name="roi", roi=True))
+            self._run(T10Process(self.ivm), roi="roi")
+            self.assertEqual(RESAMPLE_CACHE.nbytes, 0)
+
+            coarse = DataGrid((4, 9, 10), np.diag([2, 1, 1, 1]))
+            self.ivm.add(NumpyData(np.ones(coarse.shape, dtype=np.int32), grid=coarse, name="roi", roi=True))
+            self._run(T10Process(self.ivm), roi="roi")
+            self.assertGreater(RESAMPLE_CACHE.nbytes, 0)
+        finally:
+            RESAMPLE_CACHE.clear()
+
+    def testOutputFile(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            output_file = os.path.join(outdir, "T10.nii")
+            t10 = self._run(T10Process(self.ivm), slab=3, outputs=["m0"], **{"output-file" : output_file})
+            self.assertTrue(np.allclose(t10, self.t1))
+            for fname, expected in ((output_file, t10), (os.path.join(outdir, "M0.nii"), self.ivm.data["M0"].raw())):
+                # Uncompressed so outputs are written through a memory map
+                self.assertEqual(os.path.getsize(fname), 352 + t10.size * 8)
+                nii = nib.load(fname)
+                self.assertTrue(isinstance(nii.dataobj.get_unscaled(), np.memmap))
+                self.assertTrue(np.array_equal(nii.get_fdata(), expected))
+            self.assertRaises(QpException, self._run, T10Process(self.ivm), slab=3,
+                              **{"output-file" : os.path.join(outdir, "T10.nii.gz")})
+        finally:
+            shutil.rmtree(outdir)
+
+    def testDictionary(self):
+        t10 = self._run(T10Process(self.ivm), engine="dictionary", **{"t1-grid" : [0.05, 5, 500]})
+        self.assertTrue(np.allclose(t10, self.t1, rtol=1e-3, atol=0))
+        self.assertRaises(QpException, self._run, T10Process(self.ivm), **{"t1-grid" : [0.05, 5, 500]})
+
+class BlockingT10Process(T10Process):
+    """
+    T10 process whose run waits for the ``block`` event option, if given
+    """
+
+    def _run(self, options):
+        block = options.pop("block", None)
+        if block is not None:
+            block.wait()
+            self._check_cancelled()
+        T10Process._run(self, options)
+
+class BackgroundRunTest(unittest.TestCase):
+    """
+    Check a cancelled background run cannot affect a new run of the same process
+    """
+    FAS = [2, 5, 10, 15]
+    TR = 0.005
+
+    def setUp(self):
+        self.app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+        self.ivm = ImageVolumeManagement()
+        grid = DataGrid((4, 5, 6), np.identity(4))
+        vols, self.t1, _ = vfa_phantom(grid.shape, self.FAS, self.TR)
+        for fa, vol in zip(self.FAS, vols):
+            self.ivm.add(NumpyData(vol, grid=grid, name="fa%i" % fa))
+        self.process = BlockingT10Process(self.ivm, background=True)
+        self.finished = []
+        self.process.sig_finished.connect(lambda status, log, exc: self.finished.append(status))
+        self.block = threading.Event()
+
+    def tearDown(self):
+        self.block.set()
+
+    def _execute(self, **kwargs):
+        options = {"tr" : self.TR*1000, "vfa" : dict([("fa%i" % fa, fa) for fa in self.FAS]), "engine" : "numpy"}
+        options.update(kwargs)
+        self.process.execute(options)
+
+    def _wait(self, count, timeout=10):
+        start = time.time()
+        while len(self.finished) < count and time.time() - start < timeout:
+            self.app.processEvents()
+            time.sleep(0.01)
+        self.app.processEvents()
+
+    def testRerun(self):
+        self._execute(block=self.block)
+        self.process.cancel()
+        self.assertEqual(self.finished, [Process.CANCELLED])
+
+        # The new run waits for the cancelled one to stop, which must not
+        # continue fitting or complete the new run
+        rerun_block = threading.Event()
+        threading.Timer(0.2, self.block.set).start()
+        try:
+            self._execute(block=rerun_block)
+            self._wait(2, timeout=0.5)
+            self.assertEqual(self.finished, [Process.CANCELLED])
+        finally:
+            rerun_block.set()
+        self._wait(2)
+        self.assertEqual(self.finished, [Process.CANCELLED, Process.SUCCEEDED])
+        self.assertTrue(np.allclose(self.ivm.data["T10"].raw(), self.t1))
+
+    def testQueuedCompletion(self):
+        # The first run finishes, but its completion is only delivered after a new run has started
+        self._execute()
+        self.process._thread.join()
+        rerun_block = threading.Event()
+        try:
+            self._execute(block=rerun_block)
+            self._wait(1, timeout=0.5)
+            self.assertEqual(self.finished, [])
+            self.assertEqual(self.process.status, Process.RUNNING)
+        finally:
+            rerun_block.set()
+        self._wait(1)
+        self.assertEqual(self.finished, [Process.SUCCEEDED])
+        self.assertTrue(np.allclose(self.ivm.data["T10"].raw(), self.t1))
+
+    def testStillRunning(self):
+        timeout = process_module.STOP_TIMEOUT
+        process_module.STOP_TIMEOUT = 0.1
+        try:
+            self._execute(block=self.block)
+            self.process.cancel()
+            self._execute()
+            self.assertEqual(self.process.status, Process.FAILED)
+            self.assertTrue(isinstance(self.process.exception, QpException))
+            self.assertEqual(self.finished, [Process.CANCELLED, Process.FAILED])
+        finally:
+            process_module.STOP_TIMEOUT = timeout
+
+        self.block.set()
+        self._execute()
+        self._wait(3)
+        self.assertEqual(self.finished, [Process.CANCELLED, Process.FAILED, Process.SUCCEEDED])
+
+class PostprocessTest(unittest.TestCase):
+    """
+    Check in-place slab-wise post-processing matches whole-volume filtering
+    """
+
+    def testSmooth(self):
+        from scipy.ndimage import gaussian_filter
+        rng = np.random.RandomState(0)
+        arr = rng.uniform(size=(7, 8, 11))
+        for sigma, slab_size in ((0.5, 1), (1.3, 2), (2.0, 20)):
+            smoothed = arr.copy()
+            gaussian_smooth(smoothed, sigma, truncate=3, slab_size=slab_size)
+            self.assertTrue(np.allclose(smoothed, gaussian_filter(arr, sigma=sigma, truncate=3)))
+
+        # Masked voxels are only smoothed with each other and others are unchanged
+        mask = rng.uniform(size=arr.shape) > 0.3
+        smoothed = arr.copy()
+        gaussian_smooth(smoothed, 1.0, truncate=3, mask=mask, slab_size=2)
+        expected = gaussian_filter(arr * mask, 1.0, truncate=3) / gaussian_filter(mask.astype(float), 1.0, truncate=3)
+        self.assertTrue(np.allclose(smoothed[mask], expected[mask]))
+        self.assertTrue(np.all(smoothed[~mask] == arr[~mask]))
+
+    def testNonfinite(self):
+        arr = np.ones((4, 5, 6), dtype=np.float32)
+        arr[0, 0, 0], arr[1, 2, 3] = np.nan, np.inf
+        postprocess(arr, clamp={"min" : 0, "max" : 0.5}, nan_value=0, slab_size=2)
+        self.assertEqual(arr[0, 0, 0], 0)
+        self.assertEqual(arr[1, 2, 3], 0)
+        self.assertEqual(arr[3, 3, 3], 0.5)
+
+class FakeFabberProcess(Process):
+    """
+    Stands in for the Fabber process: outputs the first volume of the data in the ROI
+    """
+    PROCESS_NAME = "Fabber"
+
+    def run(self, options):
+        data = self.get_data(options)
+        roi = self.get_roi(options, data.grid)
+        if options.pop("fail", False):
+            raise RuntimeError("Failed")
+        self.ivm.add(data.raw()[..., 0] * (roi.raw() > 0), grid=data.grid, name="mean_T1")
+
+class FabberT1ProcessTest(unittest.TestCase):
+    """
+    Check the voxels are split into chunks for Fabber and the outputs stitched together
+    """
+
+    def setUp(self):
+        self._get_plugins = fabber_process.get_plugins
+        fabber_process.get_plugins = lambda *args: [FakeFabberProcess]
+        self.ivm = ImageVolumeManagement()
+        self.grid = DataGrid((6, 7, 8), np.identity(4))
+        self.data = np.random.RandomState(0).uniform(1, 2, size=(6, 7, 8, 3))
+        self.ivm.add(NumpyData(self.data, grid=self.grid, name="vfa"))
+        roi = np.zeros(self.grid.shape, dtype=np.int32)
+        roi[1:5, 2:6, 1:7] = 1
+        self.ivm.add(NumpyData(roi, grid=self.grid, name="roi", roi=True))
+        self.roi = roi > 0
+
+    def tearDown(self):
+        fabber_process.get_plugins = self._get_plugins
+
+    def testSplitMask(self):
+        masks = fabber_process.split_mask(self.roi, 5)
+        self.assertEqual(len(masks), 5)
+        self.assertTrue(np.all(sum([mask.astype(int) for mask in masks]) == self.roi))
+        self.assertTrue(max([np.count_nonzero(mask) for mask in masks]) - min([np.count_nonzero(mask) for mask in masks]) <= 1)
+
+    def testChunks(self):
+        process = fabber_process.FabberT1Process(self.ivm)
+        progress, names = [], set()
+        process.sig_progress.connect(progress.append)
+        self.ivm.sig_all_data.connect(names.update)
+        process.execute({"data" : "vfa", "roi" : "roi", "chunks" : 3})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(self.ivm.data["mean_T1"].raw(), self.data[..., 0] * self.roi))
+        self.assertEqual(progress[-1], 1)
+        # Chunk ROIs and outputs are never added to the user's ivm
+        self.assertEqual(sorted(names), ["mean_T1", "roi", "vfa"])
+
+        # Outputs replace those of a previous run
+        self.data[..., 0] *= 2
+        self.ivm.add(NumpyData(self.data, grid=self.grid, name="vfa"))
+        process.execute({"data" : "vfa", "roi" : "roi", "chunks" : 2})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(self.ivm.data["mean_T1"].raw(), self.data[..., 0] * self.roi))
+        self.assertEqual(sorted(names), ["mean_T1", "roi", "vfa"])
+
+    def testFailure(self):
+        process = fabber_process.FabberT1Process(self.ivm)
+        process.execute({"data" : "vfa", "roi" : "roi", "chunks" : 3, "fail" : True})
+        self.assertEqual(process.status, Process.FAILED)
+        self.assertEqual(sorted(self.ivm.data.keys()), ["roi", "vfa"])
+
+    def testInitLinear(self):
+        app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+        seen = []
+        class InitFabberProcess(FakeFabberProcess):
+            def run(self, options):
+                seen.append((options["PSP_byname1"], options["PSP_byname2"],
+                             self.ivm.data[options["PSP_byname1_image"]].raw(),
+                             self.ivm.data[options["PSP_byname2_image"]].raw()))
+                FakeFabberProcess.run(self, options)
+        fabber_process.get_plugins = lambda *args: [InitFabberProcess]
+
+        finished = []
+        process = fabber_process.FabberT1Process(self.ivm)
+        process.sig_finished.connect(lambda status, log, exc: finished.append(status))
+        options = {"data" : "vfa", "roi" : "roi", "chunks" : 3, "fa1" : 2, "fa2" : 5, "fa3" : 10, "tr" : 0.005}
+        process.execute(dict(options, **{"init-linear" : True}))
+        start = time.time()
+        while not finished and time.time() - start < 10:
+            app.processEvents()
+            time.sleep(0.01)
+        self.assertEqual(finished, [Process.SUCCEEDED])
+
+        # Each chunk starts from the linear fit, which is not added to the user's ivm
+        arr = self.ivm.data["vfa"].raw()
+        t1, m0 = linear_estimates([arr[..., idx] for idx in range(3)], [2, 5, 10], 0.005)
+        self.assertEqual(len(seen), 3)
+        for param_t1, param_m0, init_t1, init_m0 in seen:
+            self.assertEqual((param_t1, param_m0), ("T1", "sig0"))
+            self.assertTrue(np.allclose(init_t1, t1))
+            self.assertTrue(np.allclose(init_m0, m0))
+        self.assertEqual(sorted(self.ivm.data.keys()), ["mean_T1", "roi", "vfa"])
+
+        # Cancelled while calculating the estimates, so no chunks are run
+        del seen[:], finished[:]
+        process.execute(dict(options, **{"init-linear" : True}))
+        process.cancel()
+        start = time.time()
+        while time.time() - start < 0.5:
+            app.processEvents()
+            time.sleep(0.01)
+        self.assertEqual(finished, [Process.CANCELLED])
+        self.assertEqual(seen, [])
+
+        # Flip angles must match the data
+        options = dict(options, **{"init-linear" : True})
+        del options["fa3"]
+        process.execute(options)
+        self.assertEqual(process.status, Process.FAILED)
+        self.assertEqual(seen, [])
+
+class B1CacheTest(unittest.TestCase):
+    """
+    Check B1 maps are reused from the cache
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.afi_vols = [afi_phantom(rng.uniform(0.8, 1.2, (8, 9, 10)), 60, [0.02, 0.1]) for _ in range(3)]
+
+    def testHit(self):
+        cache = B1Cache()
+        b1 = cache.get(self.afi_vols[0], 60, [0.02, 0.1])
+        self.assertTrue(np.allclose(b1, numpy_model.afi_ratio(self.afi_vols[0], 60, [0.02, 0.1])))
+        self.assertTrue(cache.get(self.afi_vols[0], 60, [0.02, 0.1]) is b1)
+        self.assertFalse(cache.get(self.afi_vols[0], 50, [0.02, 0.1]) is b1)
+        self.assertFalse(cache.get(self.afi_vols[0], 60, [0.02, 0.12]) is b1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+
+    def testEviction(self):
+        # Room for two maps
+        cache = B1Cache(max_bytes=2*8*9*10*8)
+        first = [cache.get(afi_vols, 60, [0.02, 0.1]) for afi_vols in self.afi_vols[:2]]
+        self.assertTrue(cache.get(self.afi_vols[0], 60, [0.02, 0.1]) is first[0])
+        cache.get(self.afi_vols[2], 60, [0.02, 0.1])
+        # Least recently used map is evicted
+        self.assertTrue(cache.get(self.afi_vols[0], 60, [0.02, 0.1]) is first[0])
+        self.assertFalse(cache.get(self.afi_vols[1], 60, [0.02, 0.1]) is first[1])
+
+    def testSourceKey(self):
+        cache = B1Cache()
+        b1 = cache.get(self.afi_vols[0], 60, [0.02, 0.1], source_key="afi")
+        # The source key identifies the data, so the volumes are not looked at
+        self.assertTrue(cache.get(self.afi_vols[1], 60, [0.02, 0.1], source_key="afi") is b1)
+        self.assertFalse(cache.get(self.afi_vols[0], 60, [0.02, 0.1]) is b1)
+        self.assertFalse(cache.get(self.afi_vols[0], 50, [0.02, 0.1], source_key="afi") is b1)
+
+    def testLayout(self):
+        # Volumes of a 4D array and Fortran ordered volumes are hashed without a
+        # contiguous copy, and give the same key as contiguous volumes
+        vols = self.afi_vols[0]
+        stacked = np.stack(vols, axis=-1)
+        key = b1_key(vols, 60, [0.02, 0.1])
+        self.assertEqual(b1_key([stacked[..., 0], stacked[..., 1]], 60, [0.02, 0.1]), key)
+        self.assertEqual(b1_key([np.asfortranarray(vol) for vol in vols], 60, [0.02, 0.1]), key)
+        self.assertNotEqual(b1_key([vols[0], vols[1] * 1.1], 60, [0.02, 0.1]), key)
+
+    def testDisk(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            b1 = B1Cache().get(self.afi_vols[0], 60, [0.02, 0.1], cache_dir=cache_dir)
+            cache = B1Cache()
+            self.assertTrue(np.array_equal(cache.get(self.afi_vols[0], 60, [0.02, 0.1], cache_dir=cache_dir), b1))
+            self.assertEqual(cache.hits, 1)
+
+            # Maps found by source key in memory are stored on disk by their data
+            cache = B1Cache()
+            self.assertTrue(np.array_equal(cache.get(self.afi_vols[0], 60, [0.02, 0.1], cache_dir=cache_dir,
+                                                     source_key="afi"), b1))
+            self.assertEqual(cache.hits, 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+class ArrayCacheTest(unittest.TestCase):
+    """
+    Check the memory-bounded array cache used for resampled data
+    """
+
+    def testEviction(self):
+        cache = ArrayCache(max_bytes=2*800)
+        arrays = [np.zeros(100) for _ in range(3)]
+        for idx in range(2):
+            cache.put(idx, arrays[idx])
+        self.assertTrue(cache.get(0) is arrays[0])
+        cache.put(2, arrays[2])
+        self.assertTrue(cache.get(1) is None)
+        self.assertTrue(cache.get(0) is arrays[0])
+        self.assertEqual(cache.nbytes, 1600)
+        self.assertFalse(arrays[0].flags.writeable)
+
+        # Too big to cache
+        cache.put(3, np.zeros(1000))
+        self.assertTrue(cache.get(3) is None)
+        cache.resize(800)
+        self.assertEqual(cache.nbytes, 800)
+
+    def testDataKey(self):
+        class Data(object):
+            fname = None
+        data, other = Data(), Data()
+        self.assertEqual(data_key(data), data_key(data))
+        self.assertNotEqual(data_key(data), data_key(other))
+
+class LoadingTest(unittest.TestCase):
+    """
+    Check header-only inspection and concurrent loading of input files
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testLoad(self):
+        arrays = [np.random.RandomState(idx).uniform(size=(4, 5, 6, idx+1)) for idx in range(4)]
+        fnames = []
+        for idx, arr in enumerate(arrays):
+            fnames.append(os.path.join(self.tempdir, "vol%i.nii.gz" % idx))
+            nib.save(nib.Nifti1Image(arr, np.identity(4)), fnames[-1])
+
+        self.assertEqual(read_header(fnames[0]), ((4, 5, 6), 1))
+        self.assertEqual(read_header(fnames[2]), ((4, 5, 6), 3))
+        for threads in (1, None):
+            loaded = load_files(fnames, threads)
+            for arr, data in zip(arrays, loaded):
+                self.assertTrue(np.allclose(np.squeeze(arr), data.raw()))
+
+class BatchTest(unittest.TestCase):
+    """
+    Check multiple subjects are fitted and written to disk
+    """
+    FAS = [2, 5, 10, 15]
+    TR = 0.005
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testBatch(self):
+        subjects, t1s = [], []
+        for idx in range(2):
+            vols, t1, _ = vfa_phantom((8, 9, 10), self.FAS, self.TR, seed=idx)
+            indir = os.path.join(self.tempdir, "in%i" % idx)
+            os.makedirs(indir)
+            nib.save(nib.Nifti1Image(np.stack(vols, -1), np.identity(4)), os.path.join(indir, "vfa.nii"))
+            subjects.append({"indir" : indir, "tr" : self.TR*1000, "vfa" : {"vfa.nii" : self.FAS}, "outputs" : ["m0"]})
+            t1s.append(t1)
+        subjects.append({"id" : "missing", "tr" : self.TR*1000, "vfa" : {"missing.nii" : self.FAS}})
+
+        results = run_batch(subjects, outdir=os.path.join(self.tempdir, "out"), processes=2, slab=3)
+        self.assertEqual([result["id"] for result in results], ["subject1", "subject2", "missing"])
+        for result, t1 in zip(results[:2], t1s):
+            self.assertTrue(result["error"] is None)
+            self.assertEqual(sorted(result["outputs"].keys()), ["M0", "T10"])
+            t10 = nib.load(result["outputs"]["T10"]).get_fdata()
+            self.assertTrue(np.allclose(t10, t1))
+        self.assertTrue(results[2]["error"] is not None)
+
+class ManifestTest(unittest.TestCase):
+    """
+    Check the plugin manifest classes are only imported when used
+    """
+
+    def testLazy(self):
+        from . import QP_MANIFEST
+        process = QP_MANIFEST["processes"][0]
+        self.assertEqual(process.__name__, "T10Process")
+        self.assertEqual(process.PROCESS_NAME, T10Process.PROCESS_NAME)
+        self.assertTrue(process.resolve() is T10Process)
+        process = QP_MANIFEST["processes"][1]
+        self.assertEqual(process.PROCESS_NAME, fabber_process.FabberT1Process.PROCESS_NAME)
+        self.assertTrue(process.resolve() is fabber_process.FabberT1Process)
+        test = QP_MANIFEST["widget-tests"][0]
+        self.assertEqual(unittest.defaultTestLoader.getTestCaseNames(test),
+                         unittest.defaultTestLoader.getTestCaseNames(T10WidgetTest))
+
+    def testNotImported(self):
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = "import sys, quantiphyse_t1; quantiphyse_t1.QP_MANIFEST; " + \
+               "LIGHT = ['quantiphyse_t1.lazy', 'quantiphyse_t1.names']; " + \
+               "print([m for m in sys.modules if m.startswith('quantiphyse_t1.') and m not in LIGHT])"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=path)
+        self.assertEqual(output.decode("utf-8").strip(), "[]")
+
+class CliTest(unittest.TestCase):
+    """
+    Check the command line tool fits NIFTI files without importing Qt
+    """
+    FAS = [2, 5, 10, 15]
+    TR = 0.005
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testFit(self):
+        vols, t1, m0 = vfa_phantom((8, 9, 10), self.FAS, self.TR)
+        nib.save(nib.Nifti1Image(np.stack(vols, -1), np.identity(4)), os.path.join(self.tempdir, "vfa.nii.gz"))
+        with open(os.path.join(self.tempdir, "spec.yml"), "w") as spec_file:
+            spec_file.write("tr: %f\nvfa:\n  vfa.nii.gz: %s\noutputs: [m0]\n" % (self.TR*1000, self.FAS))
+
+        outdir = os.path.join(self.tempdir, "out")
+        self.assertEqual(cli_main([os.path.join(self.tempdir, "spec.yml"), "--outdir", outdir, "--slab", "3",
+                                   "--clamp", "0", "2"]), 0)
+        self.assertTrue(np.allclose(nib.load(os.path.join(outdir, "T10.nii.gz")).get_fdata(), np.clip(t1, 0, 2)))
+        self.assertTrue(np.allclose(nib.load(os.path.join(outdir, "M0.nii.gz")).get_fdata(), m0))
+        self.assertEqual(cli_main(["--vfa", "missing.nii", "2", "--tr", "5", "--outdir", outdir]), 1)
+
+    def testAfi(self):
+        # AFI data in separate 3D files, with TRs given as a number or a list, must
+        # be treated the same by the command line tool and T10Process
+        b1 = np.random.RandomState(1).uniform(0.8, 1.2, (8, 9, 10))
+        vols, t1, _ = vfa_phantom(b1.shape, self.FAS, self.TR, b1=b1)
+        afi_vols = afi_phantom(b1, 60, [0.02, 0.1])
+        ivm = ImageVolumeManagement()
+        grid = DataGrid(b1.shape, np.identity(4))
+        for name, vol in [("vfa%i" % fa, vol) for fa, vol in zip(self.FAS, vols)] + [("afi1", afi_vols[0]), ("afi2", afi_vols[1])]:
+            nib.save(nib.Nifti1Image(vol, np.identity(4)), os.path.join(self.tempdir, name + ".nii"))
+            ivm.add(NumpyData(vol, grid=grid, name=name))
+
+        options = {"tr" : self.TR*1000, "vfa" : dict([("vfa%i" % fa, fa) for fa in self.FAS]),
+                   "afi" : {"afi1" : 20, "afi2" : [100]}, "fa-afi" : 60, "engine" : "numpy"}
+        T10Process(ivm).run(dict(options))
+        self.assertTrue(np.allclose(ivm.data["T10"].raw(), t1))
+
+        cli_options = dict(options)
+        cli_options["vfa"] = dict([(name + ".nii", fa) for name, fa in options["vfa"].items()])
+        cli_options["afi"] = dict([(name + ".nii", afi_tr) for name, afi_tr in options["afi"].items()])
+        outdir = os.path.join(self.tempdir, "out")
+        os.makedirs(outdir)
+        files = run_t10(cli_options, indir=self.tempdir, outdir=outdir)
+        t10 = nib.load(files["T10"]).get_fdata()
+        self.assertTrue(np.allclose(t10, t1))
+        # Data in the ivm is single precision
+        self.assertTrue(np.allclose(t10, ivm.data["T10"].raw(), rtol=1e-5))
+
+    def testNoQt(self):
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = "import sys, quantiphyse_t1.cli, quantiphyse_t1.batch; " + \
+               "print([m for m in sys.modules if m.startswith(('PySide2', 'quantiphyse.'))])"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=path)
+        self.assertEqual(output.decode("utf-8").strip(), "[]")
+
+        # The process only depends on Qt through the Quantiphyse base class
+        qt_names = [name for name, value in vars(process_module).items()
+                    if getattr(value, "__name__", "").startswith("PySide2")]
+        self.assertEqual(qt_names, [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -12,12 +12,10 @@ import re
 from PySide2 import QtGui, QtCore, QtWidgets
 
 from quantiphyse.gui.widgets import QpWidget, HelpButton, BatchButton, OverlayCombo, ChoiceOption, NumericOption, NumberList, LoadNumbers, OrderList, OrderListButtons, Citation, TitleWidget, RunBox
-from quantiphyse.data import load
 from quantiphyse.utils import get_plugins, QpException
 
 from ._version import __version__
-
-from .process import T10Process
+from .names import FABBER_T1_PROCESS
 
 FAB_CITE_TITLE = "Variational Bayesian inference for a non-linear forward model"
 FAB_CITE_AUTHOR = "Chappell MA, Groves AR, Whitcher B, Woolrich MW."
@@ -135,7 +133,18 @@ class FabberT1Widget(QpWidget):
         grid.addLayout(hbox, 4, 1)
         
         self.tr = NumericOption("TR (ms)", grid, ypos=5, default=4.108, minval=0, step=0.1, decimals=3)
-        
+
+        # Starting from the linear fit, voxels converge in a few iterations
+        self.warm_start = QtWidgets.QCheckBox("Initialize from linear T1 fit")
+        self.warm_start.stateChanged.connect(self.update_ui)
+        grid.addWidget(self.warm_start, 6, 0, 1, 2)
+        self.min_fchange = NumericOption("Stop when free energy changes by less than", grid, ypos=7, default=0.01,
+                                         minval=0, step=0.01, decimals=4)
+        self.max_iterations = NumericOption("Maximum iterations", grid, ypos=8, default=20, minval=1, maxval=1000,
+                                            intonly=True)
+        # Chunks of voxels are fitted in separate worker processes
+        self.chunks = NumericOption("Parallel chunks", grid, ypos=9, default=1, minval=1, maxval=256, intonly=True)
+
         grid.setColumnStretch(3, 1)
 
         vbox.addLayout(grid)
@@ -158,6 +167,9 @@ class FabberT1Widget(QpWidget):
         self.singlevol_add.setVisible(not multivol)
         self.singlevol_clear.setVisible(not multivol)
 
+        self.min_fchange.label.setEnabled(self.warm_start.isChecked())
+        self.min_fchange.spin.setEnabled(self.warm_start.isChecked())
+
     def add_vol(self):
         used = [self.singlevol_table.item(i, 0).text() for i in range(self.singlevol_table.rowCount())]
         dlg = ChooseDataDialog(self, self.ivm, used)
@@ -170,11 +182,18 @@ class FabberT1Widget(QpWidget):
     def clear_vols(self):
         self.singlevol_table.setRowCount(0)
 
+    def _use_t1_process(self):
+        # Chunking and the linear initial estimates are done by the FabberT1 process
+        return self.chunks.value() > 1 or self.warm_start.isChecked()
+
     def get_process(self):
+        if self._use_t1_process():
+            from .fabber_process import FabberT1Process
+            return FabberT1Process(self.ivm)
         return self.FabberProcess(self.ivm)
 
     def batch_options(self):
-        return "Fabber", self.get_rundata()
+        return FABBER_T1_PROCESS if self._use_t1_process() else "Fabber", self.get_rundata()
 
     def get_rundata(self):
         rundata = {}
@@ -182,7 +201,7 @@ class FabberT1Widget(QpWidget):
         rundata["save-mean"] = ""
         rundata["save-model-fit"] = ""
         rundata["noise"] = "white"
-        rundata["max-iterations"] = "20"
+        rundata["max-iterations"] = str(self.max_iterations.value())
         rundata["model"] = "vfa"
         rundata["tr"] = self.tr.spin.value()/1000
 
@@ -201,6 +220,12 @@ class FabberT1Widget(QpWidget):
                 rundata["data"].append(self.singlevol_table.item(r, 0).text())
                 rundata["fa%i" % (r+1)] = float(self.singlevol_table.item(r, 1).text())
 
+        if self._use_t1_process():
+            rundata["chunks"] = self.chunks.value()
+        if self.warm_start.isChecked():
+            rundata["init-linear"] = True
+            rundata["convergence"] = "fchange"
+            rundata["min-fchange"] = self.min_fchange.value()
         return rundata
 
 class NumberInput(QtWidgets.QHBoxLayout):
@@ -241,6 +266,9 @@ class SourceImageList(QtWidgets.QVBoxLayout):
         self.header_text = header_text
         self.val_range = val_range
         self.dir = None
+        # Data loaded from each file, with the file modification time, so files
+        # are only read again if they change
+        self._loaded = {}
         self.table = QtWidgets.QTableWidget()
         self.table.setColumnCount(2)
         self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
@@ -264,9 +292,11 @@ class SourceImageList(QtWidgets.QVBoxLayout):
         3D (currently - 4D may be possible but must be handled differently)
         and must have shape consistent with the main volume
         """
+        from .loading import read_header
         try:
-            f = load(filename)
-            if len(f.grid.shape) not in (3, 4):
+            # Only the header is read here, the data is loaded when the T1 map is generated
+            shape, nvols = read_header(filename)
+            if len(shape) not in (3, 4):
                 QtWidgets.QMessageBox.warning(None, "Invalid file", "File must be 3D or 4D volumes",
                                           QtWidgets.QMessageBox.Close)
                 return 0
@@ -275,7 +305,7 @@ class SourceImageList(QtWidgets.QVBoxLayout):
                                       QtWidgets.QMessageBox.Close)
             return 0
 
-        return f.nvols
+        return nvols
 
     def _load_image(self, filename):
         # Try to guess the value from the filename - if it ends in a number, go with that
@@ -355,15 +385,33 @@ class SourceImageList(QtWidgets.QVBoxLayout):
         """
         :return: Tuple of (sequence of data names, sequence of flip angles in data)
         """
+        rows = [(self.table.item(i, 0).text(), self.table.item(i, 1).text()) for i in range(self.table.rowCount())]
+        filenames = [filename for filename, _ in rows]
+        mtimes = {}
+        for filename in filenames:
+            try:
+                mtimes[filename] = os.path.getmtime(filename)
+            except OSError:
+                raise QpException("File not found: %s" % filename)
+        self._loaded = dict([(filename, loaded) for filename, loaded in self._loaded.items()
+                             if filename in mtimes and loaded[0] == mtimes[filename]])
+
+        # Files which have not already been loaded are read concurrently
+        from .loading import load_files
+        to_load = [filename for filename in set(filenames) if filename not in self._loaded]
+        for filename, vol in zip(to_load, load_files(to_load)):
+            self._loaded[filename] = (mtimes[filename], vol)
+
         vols = []
         vals = []
-        for i in range(self.table.rowCount()):
-            filename = self.table.item(i, 0).text()
-            file_vals = [float(v) for v in self.table.item(i, 1).text().split(",")]
+        for filename, text in rows:
+            file_vals = [float(v) for v in text.split(",")]
             # NB need to pass main volume affine to ensure consistant orientation
-            vol = load(filename)
-            vol.name = "fa%i" % file_vals[0]
-            self.ivm.add(vol)
+            vol = self._loaded[filename][1]
+            name = "fa%i" % file_vals[0]
+            if self.ivm.data.get(name, None) is not vol:
+                vol.name = name
+                self.ivm.add(vol)
             # FIXME need to check dimensions against volume?
             vols.append(vol.name)
             vals.append(file_vals)
@@ -445,17 +493,17 @@ class T10Widget(QpWidget):
         hbox.addStretch(1)
         layout.addLayout(hbox)
 
-        hbox = QtWidgets.QHBoxLayout()
-        self.gen = QtWidgets.QPushButton('Generate T1 map', self)
-        self.gen.clicked.connect(self._generate)
-        hbox.addWidget(self.gen)
-        hbox.addStretch(1)
-        layout.addLayout(hbox)
+        # Fitting runs in the background so the GUI remains responsive and can be cancelled.
+        # The same process is used for each run so changes to smoothing and clamping
+        # reuse the previous fit. The process module is imported here rather than at
+        # startup as it loads the compiled model and scipy
+        from .process import T10Process
+        self.process = T10Process(self.ivm, background=True)
+        self.run = RunBox(self.get_process, self.get_rundata, title="Generate T1 map", btn_label="Generate T1 map")
+        layout.addWidget(self.run)
 
         self.fatable.ivm = self.ivm
         self.trtable.ivm = self.ivm
-
-        self.process = T10Process(self.ivm)
         
     def _smooth_changed(self):
         self.sigma.setEnabled(self.smooth.isChecked())
@@ -468,24 +516,22 @@ class T10Widget(QpWidget):
         self.clampMin.setEnabled(self.clamp.isChecked())
         self.clampMax.setEnabled(self.clamp.isChecked())
 
-    def _generate(self):
+    def get_process(self):
+        return self.process
+
+    def get_rundata(self):
         if self.ivm.main is None:
-            QtWidgets.QMessageBox.warning(self, "No volume", "Load a volume before generating T1 map", QtWidgets.QMessageBox.Close)
-            return
+            raise QpException("Load a volume before generating T1 map")
         elif not self.trinp.valid:
-            QtWidgets.QMessageBox.warning(self, "Invalid TR", "TR value is invalid", QtWidgets.QMessageBox.Close)
-            return
+            raise QpException("TR value is invalid")
         elif self.preclin.isChecked() and not self.fainp.valid:
-            QtWidgets.QMessageBox.warning(self, "Invalid FA", "FA value for B0 correction is invalid", QtWidgets.QMessageBox.Close)
-            return
+            raise QpException("FA value for B0 correction is invalid")
 
         options = {"tr" : self.trinp.val}
 
         fa_vols, fa_angles = self.fatable.get_images()
         if not fa_vols:
-            QtWidgets.QMessageBox.warning(self, "No FA images", "Load FA images before generating T1 map",
-                                      QtWidgets.QMessageBox.Close)
-            return
+            raise QpException("Load FA images before generating T1 map")
 
         vfa = {}
         for vol, fa in zip(fa_vols, fa_angles):
@@ -497,18 +543,17 @@ class T10Widget(QpWidget):
 
             afi_vols, afi_trs = self.trtable.get_images()
             if not afi_vols:
-                QtWidgets.QMessageBox.warning(self, "No AFI images", "Load AFI images before using B0 correction",
-                                          QtWidgets.QMessageBox.Close)
-                return
+                raise QpException("Load AFI images before using B0 correction")
             afi = {}
             for vol, tr in zip(afi_vols, afi_trs):
                 afi[vol] = tr
             options["afi"] = afi
 
-        if self.smooth.isChecked():
-            options["smooth"] = {"sigma" : self.sigma.value(), "truncate" : self.truncate.value()}
+            # Smoothing is part of the B0 correction options
+            if self.smooth.isChecked():
+                options["smooth"] = {"sigma" : self.sigma.value(), "truncate" : self.truncate.value()}
+
         if self.clamp.isChecked():
             options["clamp"] = {"min" : self.clampMin.value(), "max" : self.clampMax.value()}
 
-        self.process.run(options)
-        
+        return options
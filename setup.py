@@ -92,16 +92,20 @@ def get_extensions(rootdir):
     compile_args = []
     link_args = []
 
+    # OpenMP is used to parallelise the voxel loop. The default Apple
+    # compiler does not support it so the code is built serial on Mac
     if sys.platform.startswith('win'):
-        compile_args.append('/EHsc')
+        compile_args += ['/EHsc', '/openmp']
     elif sys.platform.startswith('darwin'):
         compile_args += ["-mmacosx-version-min=10.9"]
         link_args += ["-stdlib=libc++", "-mmacosx-version-min=10.9"]
+    else:
+        compile_args.append('-fopenmp')
+        link_args.append('-fopenmp')
 
     # T1 map generation extension
     extensions.append(Extension("%s.t1_model" % MODULE,
                                 sources=['%s/t1_model.pyx' % MODULE,
-                                         '%s/src/linear_regression.cpp' % MODULE,
                                          '%s/src/T10_calculation.cpp' % MODULE],
                                 include_dirs=['%s/src/' % MODULE,
                                               numpy.get_include()],
@@ -130,6 +134,9 @@ kwargs = {
         'quantiphyse_plugins' : [
             '%s = %s:QP_MANIFEST' % (MODULE, MODULE),
         ],
+        'console_scripts' : [
+            'quantiphyse-t1 = %s.cli:main' % MODULE,
+        ],
     },
     'classifiers' : [
         'Development Status :: 3 - Alpha',